@@ -4,45 +4,123 @@
 # Simple MiniGPT-4 client
 # start with: python api-client-example.py
 # server must be running (see api-server.py)
+# an asyncio version (AsyncMiniGPT4_Client) is available in utils/minigpt4_client.py
 
 import requests
+import urllib3
 import json
+import threading
+import time
 from os.path import exists
 
-class MiniGPT4_Client:
-    def __init__(self):
-        self.url = 'http://localhost:5000'
-        self.debug = True
+# connection pool shared by every MiniGPT4_Client in this process (keep-alive connections
+# are reused across requests and across client instances)
+http_lock = threading.Lock()
+http_sessions = {}
+def shared_http_session(pool_size=32):
+    with http_lock:
+        if pool_size not in http_sessions:
+            http = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            http.mount('http://', adapter)
+            http.mount('https://', adapter)
+            http_sessions[pool_size] = http
+        return http_sessions[pool_size]
+
+# whether a server response means "busy, try again later"
+def server_busy(status, text):
+    if status in (429, 503):
+        return True
+    return 'currently working on another request' in text
+
+# whether a request that failed with a connection error can be sent again: GETs always can,
+# anything else only if the connection was never made (refused, or timed out connecting), since
+# a request that failed later may already have been acted on (e.g. a question added to the
+# conversation before the connection dropped)
+def retry_safe(method, error):
+    if method.upper() == 'GET' or isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], 'reason', None) if len(error.args) > 0 else None
+    return isinstance(reason, urllib3.exceptions.NewConnectionError)
+
+# image file contents and mime type for an upload
+def read_image(img):
+    mime = 'image/jpeg'
+    if img.lower().endswith('.png'):
+        mime = 'image/png'
+    with open(img, 'rb') as f:
+        return f.read(), mime
 
-    # reset the MiniGPT-4 session
+class MiniGPT4_Client:
+    # timeout is (connect, read) seconds; busy responses and connection errors are retried (other
+    # than GETs, only errors connecting, see retry_safe)
+    # up to retries times, waiting backoff seconds and doubling each time (or the server's Retry-After)
+    def __init__(self, debug=True, url='http://localhost:5000', timeout=(5, 600), retries=5, backoff=0.5, http=None):
+        self.url = url.rstrip('/')
+        # server-side session id, assigned by the server on the first upload
+        self.session = ''
+        self.debug = debug
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.http = http if http is not None else shared_http_session()
+
+    # sends a request over the pooled session, retrying while the server is busy
+    def request(self, method, path, **kwargs):
+        delay = self.backoff
+        for attempt in range(self.retries + 1):
+            try:
+                r = self.http.request(method, self.url + path, timeout=self.timeout, **kwargs)
+            except requests.exceptions.ConnectionError as e:
+                if attempt == self.retries or not retry_safe(method, e):
+                    raise
+                wait = delay
+            else:
+                if attempt == self.retries or not server_busy(r.status_code, r.text if not kwargs.get('stream') else ''):
+                    return r
+                wait = max(delay, float(r.headers.get('Retry-After', 0)))
+                r.close()
+            if self.debug:
+                print('Server busy; retrying in ' + str(round(wait, 2)) + ' seconds...')
+            time.sleep(wait)
+            delay *= 2
+
+    # get the MiniGPT-4 server status
     def server_status(self):
         if self.debug:
             print('\nRequesting server status...')
-        url = self.url + '/api/v1/status'
-        r = requests.request("GET", url)
+        r = self.request("GET", '/api/v1/status')
         return r.text
 
     # reset the MiniGPT-4 session
     def server_reset(self):
         if self.debug:
             print('\nRequesting server reset...')
-        url = self.url + '/api/v1/reset'
-        r = requests.request("GET", url)
+        payload = {"session": self.session}
+        r = self.request("GET", '/api/v1/reset', params=payload)
+        return r.text
+
+    # discard this client's server-side session
+    def server_close(self):
+        if self.debug:
+            print('\nClosing server session...')
+        payload = {"session": self.session}
+        r = self.request("GET", '/api/v1/close', params=payload)
+        self.session = ''
         return r.text
 
     # send an image to MiniGPT-4
     # img is the image filename including path
+    # the first upload creates a server session; later uploads replace the image in it
     def upload(self, img):
         if self.debug:
             print('\nUploading image to server (' + img + ')...')
         if exists(img):
-            url = self.url + '/api/v1/upload'
-            payload = {}
-            mime = 'image/jpeg'
-            if img.lower().endswith('.png'):
-                mime = 'image/png'
-            files = [ ('file', (img, open(img,'rb'), mime)) ]
-            r = requests.request("POST", url, data=payload, files=files)
+            payload = {"session": self.session}
+            data, mime = read_image(img)
+            files = [ ('file', (img, data, mime)) ]
+            r = self.request("POST", '/api/v1/upload', data=payload, files=files)
+            self.update_session(r.text)
             return r.text
         else:
             print('Error: attempt to upload image that does not exist: ' + img)
@@ -52,17 +130,78 @@ class MiniGPT4_Client:
     def ask(self, message):
         if self.debug:
             print('\nSending query to server ("' + message + '")...')
-        url = self.url + '/api/v1/ask'
-        payload = {"message": message}
-        r = requests.request("POST", url, data=payload)
+        payload = {"message": message, "session": self.session}
+        r = self.request("POST", '/api/v1/ask', data=payload)
+        return r.text
+
+    # ask the MiniGPT-4 server a question and receive the answer as it is generated
+    # yields parsed JSON lines: {"token": ...} pieces, then a final {"done": true, "response": ...}
+    # line that also reports time to first token and tokens/sec
+    def ask_stream(self, message):
+        if self.debug:
+            print('\nSending streaming query to server ("' + message + '")...')
+        payload = {"message": message, "session": self.session, "stream": '1'}
+        with self.request("POST", '/api/v1/ask', data=payload, stream=True) as r:
+            if 'application/x-ndjson' not in r.headers.get('Content-Type', ''):
+                # error responses (e.g. queue full) are plain JSON
+                parsed = json.loads(r.text)
+                parsed['done'] = True
+                yield parsed
+                return
+            for line in r.iter_lines(decode_unicode=True):
+                if line:
+                    yield json.loads(line)
+
+    # send an image plus a list of questions in a single request
+    # prompts is a list of strings or {"prompt": ..., "followups": [...]} dicts (see /api/v1/analyze)
+    # the server closes the session afterwards unless keep is True
+    def analyze(self, img, prompts, keep=False):
+        if self.debug:
+            print('\nSending image and ' + str(len(prompts)) + ' questions to server (' + img + ')...')
+        if exists(img):
+            payload = {"prompts": json.dumps(prompts), "keep": '1' if keep else '0'}
+            data, mime = read_image(img)
+            files = [ ('file', (img, data, mime)) ]
+            r = self.request("POST", '/api/v1/analyze', data=payload, files=files)
+            if keep:
+                self.update_session(r.text)
+            return r.text
+        else:
+            print('Error: attempt to upload image that does not exist: ' + img)
+            return ''
+
+    # upload several images in one request; the server encodes them together and starts a new
+    # session for each one (returned in request order in the response's "images" list)
+    # images that don't exist are skipped; the client's own session is left unchanged
+    def upload_batch(self, imgs):
+        files = []
+        for img in imgs:
+            if exists(img):
+                data, mime = read_image(img)
+                files.append(('file', (img, data, mime)))
+            else:
+                print('Error: attempt to upload image that does not exist: ' + img)
+        if len(files) == 0:
+            return ''
+        if self.debug:
+            print('\nUploading ' + str(len(files)) + ' images to server...')
+        r = self.request("POST", '/api/v1/upload_batch', files=files)
         return r.text
 
     # tell the MiniGPT-4 server to shut down
     def server_shutdown(self):
-        url = self.url + '/api/v1/shutdown'
-        r = requests.request("GET", url)
+        r = self.request("GET", '/api/v1/shutdown')
         return r.text
 
+    # remember the session id returned by the server
+    def update_session(self, r):
+        try:
+            parsed = json.loads(r)
+        except ValueError:
+            return
+        if parsed.get('success') and parsed.get('session'):
+            self.session = parsed['session']
+
     # r is a reponse from the MiniGPT-4 server
     def debug_response(self, r):
         if r != None and r != '':
@@ -98,3 +237,12 @@ if __name__ == '__main__':
 
     r = client.ask('write a short description for this image')
     client.debug_response(r)
+
+    # stream an answer as it is generated
+    print('\nStreaming response:')
+    for chunk in client.ask_stream('describe the setting of this image in detail'):
+        if 'token' in chunk:
+            print(chunk['token'], end='', flush=True)
+        else:
+            print('\n')
+            client.debug_response(json.dumps(chunk))
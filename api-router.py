@@ -0,0 +1,377 @@
+# Copyright 2021 - 2023, Bill Kennedy (https://github.com/rbbrdckybk/MiniGPT-4)
+# SPDX-License-Identifier: MIT
+
+# MiniGPT-4 router
+# serves the same API as api-server.py in front of several MiniGPT-4 workers (one per GPU or host)
+# sessions stick to the worker holding their image; new sessions go to the least busy healthy worker
+# requires api-server.py's packages (it serves requests the same way) plus requests
+
+# spawn one worker per local GPU:
+# python api-router.py --spawn 2
+# or attach to servers that are already running:
+# python api-router.py --worker http://gpu1:5000 --worker http://gpu2:5000
+
+import argparse
+import atexit
+import importlib
+import os
+import shlex
+import signal
+import subprocess
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+import requests
+from flask import Flask, Response, jsonify, request
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+api_server = importlib.import_module('api-server')
+
+# response headers passed back to the client
+PASS_HEADERS = ('Content-Type', 'Retry-After')
+
+
+# one MiniGPT-4 server behind the router
+class Worker:
+    def __init__(self, url, process=None):
+        self.url = url.rstrip('/')
+        self.process = process
+        self.healthy = False
+        # queued + running requests as last reported by the worker
+        self.depth = 0
+        # requests the router currently has outstanding against this worker (updated under the
+        # router's lock: see Router.begin & Router.end)
+        self.in_flight = 0
+        self.last_check = 0
+        self.last_error = ''
+        # set once the process has been asked to shut down
+        self.stopping = False
+
+    def load(self):
+        return self.depth + self.in_flight
+
+    def status(self):
+        return {
+            "url": self.url,
+            "healthy": self.healthy,
+            "depth": self.depth,
+            "in_flight": self.in_flight,
+            "spawned": self.process is not None,
+            "last_error": self.last_error
+        }
+
+
+# tracks workers, their health and which worker owns each session
+class Router:
+    def __init__(self, workers, health_interval=2.0, max_routes=100000):
+        self.workers = workers
+        self.health_interval = health_interval
+        self.max_routes = max_routes
+        self.http = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=len(workers), pool_maxsize=64)
+        self.http.mount('http://', adapter)
+        self.http.mount('https://', adapter)
+        # session id -> Worker, least recently used first
+        self.routes = OrderedDict()
+        # most recently uploaded session, for clients that don't send a session id
+        self.default_session = ''
+        self.lock = threading.Lock()
+        self.checker = threading.Thread(target=self.check_loop, name='health-check', daemon=True)
+
+    def start(self):
+        self.checker.start()
+
+    def check_loop(self):
+        while True:
+            for worker in self.workers:
+                self.check(worker)
+            time.sleep(self.health_interval)
+
+    def check(self, worker):
+        try:
+            r = self.http.get(worker.url + '/api/v1/status', timeout=(2, 5))
+            parsed = r.json()
+            queue = parsed.get('queue', {})
+            worker.depth = queue.get('depth', 0) + queue.get('running', 0)
+            worker.healthy = r.status_code == 200 and parsed.get('success', False)
+            worker.last_error = '' if worker.healthy else parsed.get('message', '')
+        except Exception as e:
+            worker.healthy = False
+            worker.last_error = str(e)
+        if worker.process is not None and worker.process.poll() is not None:
+            worker.healthy = False
+            worker.last_error = 'worker process exited with code ' + str(worker.process.returncode)
+        worker.last_check = time.time()
+
+    # least loaded healthy worker, or None
+    def pick(self):
+        healthy = [w for w in self.workers if w.healthy]
+        if len(healthy) == 0:
+            return None
+        with self.lock:
+            return min(healthy, key=lambda w: w.load())
+
+    # a request to worker has started / finished
+    def begin(self, worker):
+        with self.lock:
+            worker.in_flight += 1
+
+    def end(self, worker):
+        with self.lock:
+            worker.in_flight -= 1
+
+    def owner(self, session_id):
+        with self.lock:
+            worker = self.routes.get(session_id)
+            if worker is not None:
+                self.routes.move_to_end(session_id)
+            return worker
+
+    def remember(self, session_id, worker):
+        with self.lock:
+            self.routes[session_id] = worker
+            self.routes.move_to_end(session_id)
+            self.default_session = session_id
+            while len(self.routes) > self.max_routes:
+                self.routes.popitem(last=False)
+
+    def forget(self, session_id):
+        with self.lock:
+            self.routes.pop(session_id, None)
+            if self.default_session == session_id:
+                self.default_session = ''
+
+
+# launch a local MiniGPT-4 worker on the given GPU & port
+def spawn_worker(server, gpu_id, host, port, extra_args):
+    cmd = [sys.executable, server, '--gpu-id', str(gpu_id), '--host', host, '--port', str(port)] + extra_args
+    print('Starting worker: ' + ' '.join(cmd))
+    # in its own session, so Ctrl-C in the terminal reaches only the router, which then stops
+    # each worker exactly once (a second signal makes a worker give up on its drain)
+    return subprocess.Popen(cmd, start_new_session=True)
+
+# ask spawned workers to drain & exit; each is signalled only once
+def signal_workers():
+    with router.lock:
+        for worker in router.workers:
+            if worker.process is not None and worker.process.poll() is None and not worker.stopping:
+                worker.stopping = True
+                worker.process.terminate()
+
+# stop spawned workers, waiting up to timeout seconds for them to finish draining before
+# killing any that are still running
+def stop_workers(timeout):
+    signal_workers()
+    deadline = time.time() + timeout
+    for worker in router.workers:
+        if worker.process is None:
+            continue
+        try:
+            worker.process.wait(timeout=max(0, deadline - time.time()))
+        except subprocess.TimeoutExpired:
+            print('Warning: worker ' + worker.url + ' did not stop in time; killing it...')
+            worker.process.kill()
+            worker.process.wait()
+
+# stops the HTTP server started in __main__ (see api-server.py's make_http_server)
+stop_server = None
+
+# used by the shutdown handler and SIGINT/SIGTERM: tells the workers to drain and stops serving
+# (the atexit hook then waits for the workers)
+def kill():
+    signal_workers()
+    stop_server()
+
+def handle_signal(signum, frame):
+    threading.Thread(target=kill, daemon=True).start()
+
+
+# Flask setup
+app = Flask('MiniGPT-4 router')
+router = None
+
+def error_response(message, status, retry_after=None):
+    r = jsonify({ "success": False, "message": message })
+    r.status_code = status
+    if retry_after is not None:
+        r.headers['Retry-After'] = str(retry_after)
+    return r
+
+# sends the current request to a worker and relays the (possibly streamed) response
+# a session id is added to the query string when the router had to fill it in
+def forward(worker, path, session_id=''):
+    body = request.get_data(cache=True)
+    params = request.args.to_dict(flat=False)
+    if session_id != '' and request_session_id() == '':
+        params['session'] = session_id
+    headers = {}
+    if request.content_type:
+        headers['Content-Type'] = request.content_type
+    stream = str(request_value('stream')) in ('1', 'true', 'True')
+    router.begin(worker)
+    try:
+        r = router.http.request(request.method, worker.url + path, params=params, data=body, headers=headers,
+                                stream=stream, timeout=(5, None))
+    except requests.exceptions.RequestException as e:
+        router.end(worker)
+        worker.healthy = False
+        worker.last_error = str(e)
+        return None
+    if stream and r.status_code == 200:
+        def relay():
+            try:
+                for chunk in r.iter_content(chunk_size=None):
+                    yield chunk
+            finally:
+                r.close()
+                router.end(worker)
+        return Response(relay(), status=r.status_code, headers=dict((k, r.headers[k]) for k in PASS_HEADERS if k in r.headers))
+    router.end(worker)
+    response = Response(r.content, status=r.status_code, headers=dict((k, r.headers[k]) for k in PASS_HEADERS if k in r.headers))
+    if path in ('/api/v1/upload', '/api/v1/analyze', '/api/v1/upload_batch') and r.status_code == 200:
+        try:
+            parsed = r.json()
+        except ValueError:
+            parsed = {}
+        if parsed.get('success') and parsed.get('session'):
+            router.remember(parsed['session'], worker)
+        for image in parsed.get('images', []):
+            if image.get('success') and image.get('session'):
+                router.remember(image['session'], worker)
+    return response
+
+# a field sent by the client (form, query string or JSON body), or '' if it isn't given
+def request_value(name):
+    request.get_data(cache=True)
+    value = request.values.get(name, '')
+    if value == '' and request.is_json:
+        value = (request.get_json(silent=True) or {}).get(name, '')
+    return value
+
+# session id sent by the client
+def request_session_id():
+    return request_value('session')
+
+# routes a request that belongs to an existing session (or the default session)
+def forward_to_owner(path):
+    session_id = request_session_id() or router.default_session
+    worker = router.owner(session_id) if session_id != '' else None
+    if worker is None:
+        if path == '/api/v1/reset' and session_id == '':
+            return jsonify({ "success": True, "message": "MiniGPT-4 session has been reset..." })
+        return jsonify({ "success": False, "message": "Unknown or expired session; upload an image first!" })
+    if not worker.healthy:
+        router.forget(session_id)
+        return error_response("The worker holding this session is unavailable; upload the image again!", 503)
+    r = forward(worker, path, session_id)
+    if r is None:
+        return error_response("The worker holding this session is unavailable; upload the image again!", 503)
+    return r
+
+# routes a request that starts a new session (or replaces the image in an existing one)
+def forward_new(path):
+    session_id = request_session_id()
+    worker = router.owner(session_id) if session_id != '' else None
+    if worker is None or not worker.healthy:
+        worker = router.pick()
+    if worker is None:
+        return error_response("No MiniGPT-4 workers are available!", 503, 5)
+    r = forward(worker, path)
+    if r is None:
+        return error_response("MiniGPT-4 worker " + worker.url + " is unavailable!", 503, 1)
+    return r
+
+# aggregate status of all workers
+@app.route('/api/v1/status', methods=['GET'])
+def status():
+    workers = [w.status() for w in router.workers]
+    healthy = sum(1 for w in router.workers if w.healthy)
+    session_id = request.args.get('session', '')
+    worker = router.owner(session_id) if session_id != '' else None
+    if worker is not None and worker.healthy:
+        return forward(worker, '/api/v1/status')
+    message = str(healthy) + ' of ' + str(len(workers)) + ' MiniGPT-4 workers are ready!'
+    with router.lock:
+        sessions = len(router.routes)
+    return jsonify({ "success": healthy > 0, "message": message, "workers": workers, "sessions": sessions })
+
+# shut down the router and any workers it started
+@app.route('/api/v1/shutdown', methods=['GET'])
+def shutdown():
+    print('Attempting to shut down...')
+    threading.Timer(0.5, kill).start()
+    return jsonify({ "success": True, "message": "Attempting to shut down MiniGPT-4 router..." })
+
+@app.route('/api/v1/upload', methods=['POST'])
+def upload_file():
+    return forward_new('/api/v1/upload')
+
+# every image in a batch lands on the same worker, so it can encode them together
+@app.route('/api/v1/upload_batch', methods=['POST'])
+def upload_batch():
+    return forward_new('/api/v1/upload_batch')
+
+@app.route('/api/v1/analyze', methods=['POST'])
+def analyze():
+    return forward_new('/api/v1/analyze')
+
+@app.route('/api/v1/ask', methods=['POST'])
+def ask():
+    return forward_to_owner('/api/v1/ask')
+
+@app.route('/api/v1/reset', methods=['GET', 'POST'])
+def reset():
+    return forward_to_owner('/api/v1/reset')
+
+@app.route('/api/v1/close', methods=['GET', 'POST'])
+def close():
+    session_id = request_session_id()
+    r = forward_to_owner('/api/v1/close')
+    if session_id != '':
+        router.forget(session_id)
+    return r
+
+
+# entry point
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="MiniGPT-4 router")
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen on.")
+    parser.add_argument("--port", type=int, default=5000, help="port to listen on.")
+    parser.add_argument("--worker", action='append', default=[], help="URL of a running MiniGPT-4 server to route to (repeatable).")
+    parser.add_argument("--spawn", type=int, default=0, help="number of local workers to start, one per GPU.")
+    parser.add_argument("--gpus", default='', help="comma-separated GPU ids for spawned workers (default 0..N-1).")
+    parser.add_argument("--worker-base-port", type=int, default=5100, help="first port used by spawned workers.")
+    parser.add_argument("--worker-args", default='', help="extra arguments passed to spawned workers, e.g. \"--cfg-path eval_configs/minigpt4_eval.yaml\".")
+    parser.add_argument("--server", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'api-server.py'), help="path to api-server.py for spawned workers.")
+    parser.add_argument("--health-interval", type=float, default=2.0, help="seconds between worker health checks.")
+    parser.add_argument("--worker-stop-timeout", type=float, default=130, help="seconds to wait for spawned workers to drain when shutting down before killing them (keep above their --drain-timeout).")
+    parser.add_argument("--http-server", default="auto", choices=['auto', 'waitress', 'werkzeug'], help="HTTP server to use; auto picks waitress if it is installed.")
+    parser.add_argument("--threads", type=int, default=32, help="request handling threads (waitress); each streamed answer holds one.")
+    parser.add_argument("--connection-limit", type=int, default=200, help="maximum number of open client connections (waitress).")
+    args = parser.parse_args()
+
+    workers = [Worker(url) for url in args.worker]
+    gpus = [int(g) for g in args.gpus.split(',') if g.strip() != ''] or list(range(args.spawn))
+    for i in range(args.spawn):
+        port = args.worker_base_port + i
+        process = spawn_worker(args.server, gpus[i % len(gpus)], '127.0.0.1', port, shlex.split(args.worker_args))
+        workers.append(Worker('http://127.0.0.1:' + str(port), process))
+    if len(workers) == 0:
+        print('Error: specify at least one --worker URL or --spawn N!')
+        sys.exit(1)
+
+    router = Router(workers, args.health_interval)
+    atexit.register(stop_workers, args.worker_stop_timeout)
+    router.start()
+    http_server, run, stop_server = api_server.make_http_server(app, args.host, args.port, args.http_server, args.threads, args.connection_limit,
+                                                                ident='MiniGPT-4 router')
+    signal.signal(signal.SIGINT, handle_signal)
+    signal.signal(signal.SIGTERM, handle_signal)
+    print('Routing MiniGPT-4 on http://' + args.host + ':' + str(args.port) + ' (' + http_server + ')...')
+    run()
+    print('MiniGPT-4 router stopped.')
+    # another Ctrl-C while waiting for the workers gives up on them
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
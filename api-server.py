@@ -2,55 +2,1208 @@
 # SPDX-License-Identifier: MIT
 
 # Simple MiniGPT-4 server
-# requires Flask: pip install Flask
+# requires Flask: pip install Flask (waitress is used to serve requests if installed: pip install waitress)
 # start with: python api-server.py
+# or under another WSGI server (one worker process; the model is loaded once per process):
+# gunicorn --workers 1 --threads 16 --bind 127.0.0.1:5000 'api-server:create_app("--cfg-path eval_configs/minigpt4_eval.yaml")'
 # see api-client-example.py for client example
+# without a GPU (simulated model, for load testing): python api-server.py --backend fake
 
 import argparse
+import base64
+import hashlib
+import heapq
+import io
+import itertools
+import math
 import os
 import random
+import re
 import json
+import queue
+import shlex
 import signal
 import threading
-import shutil
+import time
+import uuid
+import zlib
+from collections import OrderedDict
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from os.path import exists
 from pathlib import Path
 
-import numpy as np
-import torch
-import torch.backends.cudnn as cudnn
+from flask import Flask, Response, g, jsonify, request
+from PIL import Image
 
-from minigpt4.common.config import Config
-from minigpt4.common.dist_utils import get_rank
-from minigpt4.common.registry import registry
-from minigpt4.conversation.conversation import Chat, CONV_VISION
 
-# imports modules for registration
-from minigpt4.datasets.builders import *
-from minigpt4.models import *
-from minigpt4.processors import *
-from minigpt4.runners import *
-from minigpt4.tasks import *
+# a single client conversation: its own copy of the conversation template
+# plus the encoded embedding(s) of the image it uploaded
+class Session:
+    def __init__(self, session_id, new_conversation):
+        self.id = session_id
+        self.new_conversation = new_conversation
+        self.chat_state = new_conversation()
+        self.img_list = []
+        # content hash of each image in img_list; identifies image positions in the prefix cache
+        self.img_keys = []
+        # attention key/value state for this conversation's last prompt (see PrefixCache)
+        self.prefix_cache = None
+        # prompt size of the last answer: total positions and how many came from the prefix cache
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+        # stage timings of the last upload or answer, for timing=1 responses
+        self.timing = {}
+        self.created = time.time()
+        self.last_used = self.created
+        # serializes ask/answer pairs within this conversation
+        self.lock = threading.Lock()
+
+    def touch(self):
+        self.last_used = time.time()
+
+    # clears the conversation and image but keeps the session alive
+    def reset(self):
+        self.chat_state = self.new_conversation()
+        self.img_list = []
+        self.img_keys = []
+        self.prefix_cache = None
+
+    # approximate memory held by this session's image embeddings, in bytes (what
+    # --session-memory-mb caps; prefix caches have their own --kv-cache-mb budget)
+    def memory_bytes(self):
+        total = 0
+        for emb in self.img_list:
+            total += tensor_nbytes(emb)
+        return total
+
+
+# table of active sessions with LRU/TTL eviction and an optional memory cap
+# new_conversation returns an empty conversation for new sessions (see MiniGPT4.new_conversation)
+class SessionManager:
+    def __init__(self, new_conversation, max_sessions=64, ttl=3600, max_memory_mb=0):
+        self.new_conversation = new_conversation
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.max_memory = int(max_memory_mb * 1024 * 1024)
+        self.sessions = OrderedDict()
+        self.lock = threading.Lock()
+        # most recently uploaded session; used by clients that don't send a session id
+        self.default_id = None
+        self.evicted = 0
+
+    def create(self):
+        return self.add(self.new())
+
+    # a session that isn't in the table yet; add() it once its upload has been accepted, so a
+    # request turned away (queue full, bad image) never evicts anyone else's session
+    def new(self):
+        return Session(uuid.uuid4().hex, self.new_conversation)
+
+    def add(self, session):
+        with self.lock:
+            self.sessions[session.id] = session
+            self.default_id = session.id
+            self.evict()
+        return session
+
+    # returns the requested session (or the default one if no id is given), None if unknown
+    def get(self, session_id=None):
+        with self.lock:
+            self.expire()
+            if session_id is None or session_id == '':
+                session_id = self.default_id
+            session = self.sessions.get(session_id) if session_id is not None else None
+            if session is not None:
+                self.sessions.move_to_end(session.id)
+                session.touch()
+            return session
+
+    def remove(self, session_id):
+        with self.lock:
+            session = self.sessions.pop(session_id, None)
+            if session_id == self.default_id:
+                self.default_id = None
+            if session is not None:
+                session.prefix_cache = None
+            return session is not None
+
+    def memory_bytes(self):
+        return sum(s.memory_bytes() for s in self.sessions.values())
+
+    # drop sessions that have been idle for longer than the TTL; caller holds the lock
+    def expire(self):
+        if self.ttl <= 0:
+            return
+        cutoff = time.time() - self.ttl
+        for session_id in [k for k, s in self.sessions.items() if s.last_used < cutoff]:
+            self.drop(session_id)
+
+    # enforce session count & memory limits, least recently used first; caller holds the lock
+    def evict(self):
+        self.expire()
+        while len(self.sessions) > 1 and len(self.sessions) > self.max_sessions > 0:
+            self.drop(next(iter(self.sessions)))
+        if self.max_memory > 0:
+            while len(self.sessions) > 1 and self.memory_bytes() > self.max_memory:
+                self.drop(next(iter(self.sessions)))
+
+    def drop(self, session_id):
+        session = self.sessions.pop(session_id, None)
+        if session is not None:
+            session.prefix_cache = None
+        if session_id == self.default_id:
+            self.default_id = None
+        self.evicted += 1
+        print('Evicted MiniGPT-4 session ' + session_id + '...')
+
+    def stats(self):
+        with self.lock:
+            return {
+                "sessions": len(self.sessions),
+                "max_sessions": self.max_sessions,
+                "memory_mb": round(self.memory_bytes() / (1024 * 1024), 2),
+                "evicted": self.evicted
+            }
+
+
+# content-addressed cache of encoded image embeddings, keyed by the SHA-256 of the image bytes
+# an in-memory LRU tier, backed by an optional on-disk tier in the backend's format
+# (.npy files for the real model)
+class EmbeddingCache:
+    def __init__(self, max_entries=256, disk_dir='', backend=None):
+        self.max_entries = max_entries
+        self.disk_dir = disk_dir
+        self.backend = backend
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        if self.disk_dir != '':
+            Path(self.disk_dir).mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def key(data):
+        return hashlib.sha256(data).hexdigest()
+
+    def disk_path(self, key):
+        return os.path.join(self.disk_dir, key + self.backend.embedding_ext)
+
+    # whether key can be served without encoding (doesn't count as a lookup)
+    def contains(self, key):
+        with self.lock:
+            if key in self.entries:
+                return True
+        return self.disk_dir != '' and exists(self.disk_path(key))
+
+    # returns the cached embedding on the model's device, or None
+    def get(self, key):
+        with self.lock:
+            emb = self.entries.get(key)
+            if emb is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return emb
+        if self.disk_dir != '' and exists(self.disk_path(key)):
+            try:
+                emb = self.backend.load_embedding(self.disk_path(key))
+            except Exception as e:
+                print('Error: unable to read cached embedding (' + self.disk_path(key) + '): ' + str(e))
+                emb = None
+            if emb is not None:
+                with self.lock:
+                    self.disk_hits += 1
+                    self.remember(key, emb)
+                return emb
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, emb):
+        with self.lock:
+            self.remember(key, emb)
+        if self.disk_dir != '' and not exists(self.disk_path(key)):
+            try:
+                self.save(self.disk_path(key), emb)
+            except Exception as e:
+                print('Error: unable to write cached embedding (' + self.disk_path(key) + '): ' + str(e))
+
+    # add to the memory tier, evicting least recently used entries; caller holds the lock
+    def remember(self, key, emb):
+        if self.max_entries <= 0:
+            return
+        self.entries[key] = emb
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    # written to a temporary file first so a crash never leaves a partial entry behind
+    def save(self, path, emb):
+        temp = path + '.' + uuid.uuid4().hex + '.tmp'
+        with open(temp, 'wb') as f:
+            self.backend.save_embedding(f, emb)
+        os.replace(temp, path)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_ratio": round((self.hits + self.disk_hits) / lookups, 3) if lookups > 0 else 0.0
+            }
+
+
+# answers to deterministic (greedy) questions, keyed by a hash of everything that decides the
+# answer: the model, the image content hashes, the full conversation prompt and the sampling
+# settings (see MiniGPT4.response_key); an in-memory LRU tier plus an optional on-disk tier
+class ResponseCache:
+    def __init__(self, max_entries=1024, disk_dir=''):
+        self.max_entries = max_entries
+        self.disk_dir = disk_dir
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        if self.disk_dir != '':
+            Path(self.disk_dir).mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def key(parts):
+        return hashlib.sha256(json.dumps(parts).encode()).hexdigest()
+
+    def enabled(self):
+        return self.max_entries > 0 or self.disk_dir != ''
+
+    def disk_path(self, key):
+        return os.path.join(self.disk_dir, key + '.json')
+
+    # returns the cached entry ({"response": ..., "prompt_tokens": ...}), or None
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry
+        if self.disk_dir != '' and exists(self.disk_path(key)):
+            try:
+                with open(self.disk_path(key), 'r', encoding='utf-8') as f:
+                    entry = json.load(f)
+            except Exception as e:
+                print('Error: unable to read cached response (' + self.disk_path(key) + '): ' + str(e))
+                entry = None
+            if entry is not None:
+                with self.lock:
+                    self.disk_hits += 1
+                    self.remember(key, entry)
+                return entry
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, entry):
+        with self.lock:
+            self.remember(key, entry)
+        if self.disk_dir != '':
+            # written to a temporary file first so a crash never leaves a partial entry behind
+            path = self.disk_path(key)
+            temp = path + '.' + uuid.uuid4().hex + '.tmp'
+            try:
+                with open(temp, 'w', encoding='utf-8') as f:
+                    json.dump(entry, f)
+                os.replace(temp, path)
+            except Exception as e:
+                print('Error: unable to write cached response (' + path + '): ' + str(e))
+
+    # add to the memory tier, evicting least recently used entries; caller holds the lock
+    def remember(self, key, entry):
+        if self.max_entries <= 0:
+            return
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_ratio": round((self.hits + self.disk_hits) / lookups, 3) if lookups > 0 else 0.0
+            }
+
+
+# the user message an uploaded image starts a conversation with (Chat.upload_img)
+IMAGE_MESSAGE = "<Img><ImageHere></Img>"
+
+# token id sequences that end a MiniGPT-4 answer ('###'), and LLaMA's end-of-sequence id
+STOP_WORDS_IDS = [[835], [2277, 29937]]
+EOS_TOKEN_ID = 2
+
+# size of a torch tensor (or anything else with an nbytes attribute), in bytes
+def tensor_nbytes(x):
+    if hasattr(x, 'element_size'):
+        return x.element_size() * x.nelement()
+    return x.nbytes
+
+# attention key/value state for an already-processed prompt prefix
+# keys has one entry per position: a token id, or (image hash, index) for image embedding positions,
+# so a new prompt can reuse the cached state for however many leading positions it shares
+class PrefixCache:
+    def __init__(self, keys, past):
+        self.keys = keys
+        # one (key, value) pair per layer, each shaped [1, heads, len(keys), head_dim]
+        self.past = past
+
+    def common_length(self, keys):
+        n = min(len(self.keys), len(keys))
+        i = 0
+        while i < n and self.keys[i] == keys[i]:
+            i += 1
+        return i
+
+    def nbytes(self):
+        return sum(tensor_nbytes(k) + tensor_nbytes(v) for k, v in self.past)
+
+
+# sampling settings for one answer (Chat.answer's defaults: top_p=0.9, temperature=1.0, single beam)
+# temperature 0 picks the most likely token at every step, so the same prompt always gets the
+# same answer and can be served from the ResponseCache; use_cache=False leaves the cache out
+# entirely (the answer is neither looked up nor stored)
+class GenerationParams:
+    def __init__(self, max_new_tokens=300, temperature=1.0, top_p=0.9, num_beams=1, use_cache=True):
+        self.max_new_tokens = max_new_tokens
+        self.temperature = temperature
+        self.top_p = top_p
+        self.num_beams = num_beams
+        self.use_cache = use_cache
+
+    def deterministic(self):
+        return self.temperature == 0
+
+    # the settings that decide a deterministic answer, for ResponseCache keys
+    def key(self):
+        return [self.num_beams, self.temperature, self.max_new_tokens]
+
+
+# per-row bookkeeping for one batched generation
+class GenerationRow:
+    def __init__(self, session, keys, embs, stream=None, params=None):
+        self.session = session
+        self.keys = keys
+        self.embs = embs
+        self.stream = stream
+        self.params = params if params is not None else GenerationParams()
+        # prompt positions actually fed to the model; prompts that are too long skip the first start
+        self.start = 0
+        self.length = len(keys)
+        self.cache = None
+        self.cached = 0
+        # prompt state kept by the backend for the session's next turn
+        self.prefix = None
+        self.tokens = []
+        self.done = False
+
+
+# hands the text of an answer to a streaming HTTP response as it is generated
+# the model worker pushes the answer-so-far; the request thread iterates over new pieces
+class TokenStream:
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.sent = ''
+        self.tokens = 0
+        self.first_token = None
+
+    # called by the model worker after every generated token
+    def push(self, text):
+        self.tokens += 1
+        if self.first_token is None:
+            self.first_token = time.time()
+        if text.startswith(self.sent) and len(text) > len(self.sent):
+            self.queue.put(text[len(self.sent):])
+            self.sent = text
+
+    def close(self):
+        self.queue.put(None)
+
+    def __iter__(self):
+        while True:
+            piece = self.queue.get()
+            if piece is None:
+                return
+            yield piece
+
+
+# Prometheus-style metrics, served in the text exposition format by /metrics
+# label values are passed as a tuple matching the metric's label names
+class Counter:
+    type = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = labels
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, labels=()):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            return [(self.name, dict(zip(self.label_names, labels)), value) for labels, value in sorted(self.values.items())]
+
+class Histogram:
+    type = 'histogram'
+    # seconds; from a few milliseconds (decode, queue wait) up to long generations
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        with self.lock:
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[i] += 1
+                    break
+            self.sum += value
+            self.count += 1
+
+    def samples(self):
+        with self.lock:
+            out = []
+            total = 0
+            for bound, count in zip(self.buckets, self.counts):
+                total += count
+                out.append((self.name + '_bucket', { "le": str(bound) }, total))
+            out.append((self.name + '_bucket', { "le": "+Inf" }, self.count))
+            out.append((self.name + '_sum', {}, self.sum))
+            out.append((self.name + '_count', {}, self.count))
+            return out
+
+# a value read from elsewhere (queue depth, cache counters, ...) whenever metrics are scraped
+# fn returns a number, or None to leave the metric out
+class Collected:
+    def __init__(self, name, help, type, fn):
+        self.name = name
+        self.help = help
+        self.type = type
+        self.fn = fn
+
+    def samples(self):
+        value = self.fn()
+        return [] if value is None else [(self.name, {}, value)]
+
+class Metrics:
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            try:
+                samples = metric.samples()
+            except Exception as e:
+                print('Error: unable to collect metric ' + metric.name + ': ' + str(e))
+                continue
+            if len(samples) == 0:
+                continue
+            lines.append('# HELP ' + metric.name + ' ' + metric.help)
+            lines.append('# TYPE ' + metric.name + ' ' + metric.type)
+            for name, labels, value in samples:
+                if len(labels) > 0:
+                    name += '{' + ','.join(k + '="' + str(v).replace('\\', '\\\\').replace('"', '\\"') + '"' for k, v in labels.items()) + '}'
+                lines.append(name + ' ' + str(value))
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+REQUESTS = metrics.add(Counter('minigpt4_requests_total', 'HTTP requests by endpoint and status code.', ('endpoint', 'status')))
+DECODE_SECONDS = metrics.add(Histogram('minigpt4_image_decode_seconds', 'Time spent decoding uploaded images.'))
+ENCODE_SECONDS = metrics.add(Histogram('minigpt4_image_encode_seconds', 'Time spent encoding image batches with the visual encoder.'))
+ENCODE_BATCH_SIZE = metrics.add(Histogram('minigpt4_image_encode_batch_size', 'Number of images encoded per batch.', (1, 2, 4, 8, 16, 32, 64)))
+QUEUE_SECONDS = metrics.add(Histogram('minigpt4_queue_wait_seconds', 'Time jobs spend waiting in the request queue.'))
+PREFILL_SECONDS = metrics.add(Histogram('minigpt4_prefill_seconds', 'Time to process a batch of prompts, up to the first generated token.'))
+GENERATE_SECONDS = metrics.add(Histogram('minigpt4_generate_seconds', 'Time spent generating answer tokens after the first, per batch.'))
+BATCH_SIZE = metrics.add(Histogram('minigpt4_batch_size', 'Number of questions answered per batch.', (1, 2, 4, 8, 16, 32)))
+GENERATED_TOKENS = metrics.add(Counter('minigpt4_generated_tokens_total', 'Answer tokens generated.'))
+
+
+# raised by JobQueue.submit when the queue is at capacity
+class QueueFull(Exception):
+    def __init__(self, retry_after):
+        super().__init__('MiniGPT-4 request queue is full')
+        self.retry_after = retry_after
+
+
+# a unit of model work submitted by a request handler and run by the model worker
+# jobs either carry their own fn, or a kind + payload handled by a registered batch handler
+class Job:
+    def __init__(self, fn=None, session_id='', priority=0, kind=None, payload=None):
+        self.id = uuid.uuid4().hex
+        self.fn = fn
+        self.session_id = session_id
+        self.priority = priority
+        self.kind = kind
+        self.payload = payload
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.batch_size = 1
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+    # block until the worker has run this job; re-raises any error from the job
+    def wait(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+    def finish(self, result=None, error=None):
+        self.result = result
+        self.error = error
+        self.finished = time.time()
+        self.done.set()
+
+
+# batching policy for one kind of job: fn receives a list of payloads and returns
+# one result (or exception) per payload, in the same order
+class Batcher:
+    def __init__(self, fn, max_size=4, max_wait=0.01):
+        self.fn = fn
+        self.max_size = max(1, max_size)
+        self.max_wait = max(0.0, max_wait)
+
+
+# bounded priority queue feeding a single model worker thread
+# higher priority runs first; equal priorities run in submission (FIFO) order
+# jobs of a batched kind that arrive within the batcher's wait window run together
+class JobQueue:
+    def __init__(self, max_depth=32):
+        self.max_depth = max_depth
+        self.heap = []
+        self.counter = itertools.count()
+        self.cond = threading.Condition()
+        self.batchers = {}
+        self.running = []
+        self.completed = 0
+        self.rejected = 0
+        self.batches = 0
+        # moving averages of batch run time and size, used to estimate Retry-After
+        self.avg_seconds = 1.0
+        self.avg_batch = 1.0
+        self.worker = threading.Thread(target=self.run, name='minigpt4-worker', daemon=True)
+
+    def start(self):
+        self.worker.start()
+
+    def register_batcher(self, kind, batcher):
+        self.batchers[kind] = batcher
+
+    def submit(self, fn=None, session_id='', priority=0, kind=None, payload=None):
+        job = Job(fn, session_id, priority, kind, payload)
+        with self.cond:
+            if self.max_depth > 0 and len(self.heap) >= self.max_depth:
+                self.rejected += 1
+                raise QueueFull(self.retry_after())
+            heapq.heappush(self.heap, (-priority, next(self.counter), job))
+            self.cond.notify_all()
+        return job
+
+    # seconds a client should wait before retrying, based on the current backlog
+    def retry_after(self):
+        return max(1, math.ceil(self.avg_seconds * (len(self.heap) / self.avg_batch + 1)))
+
+    # 1-based position of the first queued job of a session, 0 if one is running, None if it has none
+    def position(self, session_id):
+        with self.cond:
+            for job in self.running:
+                if job.session_id == session_id:
+                    return 0
+            for i, (_, _, job) in enumerate(sorted(self.heap)):
+                if job.session_id == session_id:
+                    return i + 1
+        return None
+
+    def busy(self):
+        return len(self.running) > 0 or len(self.heap) > 0
+
+    # move queued jobs that can share a batch with the current ones out of the heap
+    # a session's jobs must run in order, so only a session's first queued job can be taken:
+    # every job walked past (whatever its kind) holds back the later jobs of its session
+    # caller holds the lock
+    def take_compatible(self, batch, max_size):
+        sessions = set(job.session_id for job in batch)
+        taken = []
+        for entry in sorted(self.heap):
+            job = entry[2]
+            if len(batch) + len(taken) >= max_size:
+                break
+            seen = job.session_id != '' and job.session_id in sessions
+            if job.kind == batch[0].kind and not seen:
+                taken.append(entry)
+            if job.session_id != '':
+                sessions.add(job.session_id)
+        if len(taken) > 0:
+            ids = set(id(entry[2]) for entry in taken)
+            self.heap = [entry for entry in self.heap if id(entry[2]) not in ids]
+            heapq.heapify(self.heap)
+            batch.extend(entry[2] for entry in taken)
+
+    # pick the jobs to run next, starting with first (already popped); waits up to the
+    # batcher's window for more compatible jobs to arrive; caller holds the lock
+    def collect_batch(self, first):
+        batch = [first]
+        batcher = self.batchers.get(first.kind)
+        if batcher is None or batcher.max_size == 1:
+            return batch
+        deadline = time.time() + batcher.max_wait
+        while True:
+            self.take_compatible(batch, batcher.max_size)
+            remaining = deadline - time.time()
+            if len(batch) >= batcher.max_size or remaining <= 0:
+                return batch
+            self.cond.wait(remaining)
+
+    def run(self):
+        while True:
+            with self.cond:
+                while len(self.heap) == 0:
+                    self.cond.wait()
+                job = heapq.heappop(self.heap)[2]
+                batch = self.collect_batch(job)
+                self.running = batch
+            self.execute(batch)
+            with self.cond:
+                self.running = []
+                self.completed += len(batch)
+                self.batches += 1
+                self.avg_seconds = 0.8 * self.avg_seconds + 0.2 * (batch[0].finished - batch[0].started)
+                self.avg_batch = 0.8 * self.avg_batch + 0.2 * len(batch)
+
+    def execute(self, batch):
+        started = time.time()
+        for job in batch:
+            job.started = started
+            job.batch_size = len(batch)
+            QUEUE_SECONDS.observe(started - job.submitted)
+        batcher = self.batchers.get(batch[0].kind)
+        try:
+            if batcher is None:
+                results = [batch[0].fn()]
+            else:
+                results = batcher.fn([job.payload for job in batch])
+        except Exception as e:
+            print('Error: MiniGPT-4 job failed: ' + str(e))
+            results = [e] * len(batch)
+        for job, result in zip(batch, results):
+            if isinstance(result, Exception):
+                job.finish(error=result)
+            else:
+                job.finish(result=result)
+
+    def stats(self):
+        with self.cond:
+            return {
+                "depth": len(self.heap),
+                "max_depth": self.max_depth,
+                "running": len(self.running),
+                "completed": self.completed,
+                "rejected": self.rejected,
+                "batches": self.batches,
+                "avg_batch_size": round(self.avg_batch, 2),
+                "avg_batch_seconds": round(self.avg_seconds, 3)
+            }
+
+
+# MiniGPT-4 conversation template (SeparatorStyle.SINGLE), for backends that run
+# without the official package; same prompt layout as minigpt4's CONV_VISION
+class Conversation:
+    def __init__(self, system, roles, messages=None, sep='###'):
+        self.system = system
+        self.roles = roles
+        self.messages = messages if messages is not None else []
+        self.sep = sep
+
+    def append_message(self, role, message):
+        self.messages.append([role, message])
+
+    def get_prompt(self):
+        ret = self.system + self.sep
+        for role, message in self.messages:
+            if message:
+                ret += role + ': ' + message + self.sep
+            else:
+                ret += role + ':'
+        return ret
+
+    def copy(self):
+        return Conversation(self.system, self.roles, [[role, message] for role, message in self.messages], self.sep)
+
+CONV_VISION_FAKE = Conversation(
+    system='Give the following image: <Img>ImageContent</Img>. You will be able to see the image once I provide it to you. Please answer my questions.',
+    roles=('Human', 'Assistant'))
+
+
+# model backends
+# a backend owns the model and does the tensor work; MiniGPT4 (below) keeps sessions,
+# caches and conversation handling, and only talks to the model through this interface:
+#   load(progress)                         load the model, calling progress(stage) as it goes
+#   new_conversation()                     empty copy of the conversation template
+#   input_size                             side of the square images the encoder takes, in pixels
+#   preprocess(image)                      PIL image -> encoder input (CPU only, thread-safe)
+#   encode_batch(inputs)                   preprocessed images -> one image embedding each, in one pass
+#   prompt_inputs(conv, img_list, img_keys) -> (position keys, input embeddings) for a prompt
+#   generate(rows, add_token, keep_prefix)  batched decode with each row's own row.params; calls
+#                                          add_token(row, token) for each new token until every
+#                                          row is done, and sets row.prefix when keep_prefix is set
+#   truncate_prefix(cache, length)         PrefixCache holding only the first length positions
+#   decode_tokens(tokens)                  token ids -> text
+#   memory_stats()                         device memory use in bytes ("allocated", "reserved", "peak")
+#   save_embedding(f, emb) / load_embedding(path)   embedding cache disk format
+
+# the real thing: Vicuna + Q-Former on a CUDA device
+# torch and the official MiniGPT-4 package are only imported once the model is loaded
+class MiniGPT4Backend:
+    name = 'minigpt4'
+    embedding_ext = '.npy'
+
+    def __init__(self, args):
+        self.args = args
+        self.device = 'cuda:{}'.format(args.gpu_id)
+        self.model = None
+        self.vis_processor = None
+        self.conv_template = None
+        self.input_size = 224
+
+    def load(self, progress):
+        progress('importing MiniGPT-4')
+        from minigpt4.common.config import Config
+        from minigpt4.common.registry import registry
+        from minigpt4.conversation.conversation import CONV_VISION
+
+        # imports modules for registration: only what Config and the lookups below use
+        # (dataset builders for the config, the model & processor classes); runners and tasks
+        # are for training
+        import minigpt4.datasets.builders
+        import minigpt4.models
+        import minigpt4.processors
+
+        progress('reading config')
+        cfg = Config(self.args)
+        model_config = cfg.model_cfg
+        model_config.device_8bit = self.args.gpu_id
+        model_cls = registry.get_model_class(model_config.arch)
+        progress('loading model')
+        self.model = model_cls.from_config(model_config).to(self.device)
+
+        progress('loading vision processor')
+        vis_processor_cfg = cfg.datasets_cfg.cc_sbu_align.vis_processor.train
+        self.vis_processor = registry.get_processor_class(vis_processor_cfg.name).from_config(vis_processor_cfg)
+        self.input_size = vis_processor_cfg.get('image_size', 224)
+        self.conv_template = CONV_VISION
+
+    def new_conversation(self):
+        return self.conv_template.copy()
+
+    # same as Chat.upload_img, split into the CPU part and a batched GPU part
+    def preprocess(self, image):
+        return self.vis_processor(image)
+
+    def encode_batch(self, inputs):
+        import torch
+        with torch.no_grad():
+            images = torch.stack(inputs).to(self.device)
+            embs, _ = self.model.encode_img(images)
+            # copy each row out so a session's embedding doesn't keep the whole batch alive
+            embs = [embs[i:i + 1].clone() for i in range(len(inputs))]
+        # wait for the GPU so encode timings measure the actual work
+        torch.cuda.synchronize(self.device)
+        return embs
+
+    # token ids / image positions and input embeddings for a whole prompt
+    # (same layout as Chat.get_context_emb)
+    def prompt_inputs(self, conv, img_list, img_keys):
+        import torch
+        model = self.model
+        prompt_segs = conv.get_prompt().split('<ImageHere>')
+        if len(prompt_segs) != len(img_list) + 1:
+            raise ValueError('Unmatched numbers of image placeholders and images.')
+        keys = []
+        embs = []
+        with torch.no_grad():
+            for i, seg in enumerate(prompt_segs):
+                # only add bos to the first seg
+                seg_tokens = model.llama_tokenizer(seg, return_tensors="pt", add_special_tokens=i == 0).to(self.device).input_ids
+                keys.extend(seg_tokens[0].tolist())
+                embs.append(model.llama_model.model.embed_tokens(seg_tokens))
+                if i < len(img_list):
+                    img = img_list[i]
+                    keys.extend((img_keys[i], p) for p in range(img.shape[1]))
+                    embs.append(img)
+        return keys, torch.cat(embs, dim=1)
+
+    # prefill the uncached part of every prompt in one forward pass, then sample until
+    # every row has produced a stop word; rows are left-padded to line up and padding
+    # is masked out (which also covers the gap between a row's cache and its new positions)
+    def generate(self, rows, add_token, keep_prefix):
+        import torch
+        with torch.no_grad():
+            llama = self.model.llama_model
+            device = rows[0].embs.device
+            cached = max(row.cached for row in rows)
+            new = max(row.length - row.cached for row in rows)
+
+            inputs = []
+            mask = torch.zeros((len(rows), cached + new), dtype=torch.long, device=device)
+            positions = torch.ones((len(rows), new), dtype=torch.long, device=device)
+            for r, row in enumerate(rows):
+                embs = row.embs[:, row.start + row.cached:]
+                count = embs.shape[1]
+                inputs.append(torch.cat([embs.new_zeros((1, new - count, embs.shape[2])), embs], dim=1))
+                mask[r, cached - row.cached:cached] = 1
+                mask[r, cached + new - count:] = 1
+                positions[r, new - count:] = torch.arange(row.cached, row.cached + count, device=device)
+
+            past = self.batch_past(rows, cached) if cached > 0 else None
+            out = llama(inputs_embeds=torch.cat(inputs, dim=0), attention_mask=mask, position_ids=positions,
+                        past_key_values=past, use_cache=True, return_dict=True)
+            if keep_prefix:
+                self.split_prefixes(rows, out.past_key_values, mask)
+
+            logits = out.logits[:, -1, :]
+            past = out.past_key_values
+            last = positions[:, -1]
+            for _ in range(max(row.params.max_new_tokens for row in rows)):
+                next_tokens = self.sample(logits, rows)
+                for r, row in enumerate(rows):
+                    if not row.done:
+                        add_token(row, next_tokens[r].item())
+                if all(row.done for row in rows):
+                    break
+                last = last + 1
+                mask = torch.cat([mask, mask.new_ones((len(rows), 1))], dim=1)
+                out = llama(inputs_embeds=llama.model.embed_tokens(next_tokens.unsqueeze(1)), attention_mask=mask,
+                            position_ids=last.unsqueeze(1), past_key_values=past, use_cache=True, return_dict=True)
+                logits = out.logits[:, -1, :]
+                past = out.past_key_values
+
+    # left-pad each row's cached keys/values to a common length and stack them into one batch
+    def batch_past(self, rows, length):
+        import torch
+        template = next(row.cache.past for row in rows if row.cached > 0)
+        past = []
+        for layer, (k0, v0) in enumerate(template):
+            keys = []
+            values = []
+            for row in rows:
+                shape = (1, k0.shape[1], length - row.cached, k0.shape[3])
+                if row.cached > 0:
+                    k, v = row.cache.past[layer]
+                    keys.append(torch.cat([k.new_zeros(shape), k[:, :, :row.cached]], dim=2))
+                    values.append(torch.cat([v.new_zeros(shape), v[:, :, :row.cached]], dim=2))
+                else:
+                    keys.append(k0.new_zeros(shape))
+                    values.append(v0.new_zeros(shape))
+            past.append((torch.cat(keys, dim=0), torch.cat(values, dim=0)))
+        return tuple(past)
+
+    # copy each row's unpadded prompt state out of the batch so the next turn can reuse it
+    def split_prefixes(self, rows, past, mask):
+        for r, row in enumerate(rows):
+            if row.keys is None:
+                continue
+            columns = mask[r].nonzero().squeeze(1)
+            row.prefix = PrefixCache(row.keys, tuple((k[r:r + 1, :, columns].contiguous(), v[r:r + 1, :, columns].contiguous()) for k, v in past))
 
-from flask import Flask, jsonify, request
-from werkzeug.utils import secure_filename
+    def truncate_prefix(self, cache, length):
+        return PrefixCache(cache.keys[:length], tuple((k[:, :, :length].contiguous(), v[:, :, :length].contiguous()) for k, v in cache.past))
+
+    # nucleus sampling over the last position's logits, one token per row with that row's
+    # temperature & top_p; rows with temperature 0 take the most likely token
+    def sample(self, logits, rows):
+        import torch
+        device = logits.device
+        temperature = torch.tensor([max(row.params.temperature, 1e-5) for row in rows], device=device).unsqueeze(1)
+        top_p = torch.tensor([row.params.top_p for row in rows], device=device).unsqueeze(1)
+        probs = torch.softmax(logits.float() / temperature, dim=-1)
+        sorted_probs, sorted_idx = torch.sort(probs, dim=-1, descending=True)
+        # drop tokens once the more likely ones already cover top_p of the mass
+        sorted_probs[(torch.cumsum(sorted_probs, dim=-1) - sorted_probs) > top_p] = 0
+        choice = torch.multinomial(sorted_probs, num_samples=1)
+        sampled = sorted_idx.gather(-1, choice).squeeze(1)
+        greedy = torch.tensor([row.params.temperature == 0 for row in rows], device=device)
+        return torch.where(greedy, logits.argmax(dim=-1), sampled)
+
+    def decode_tokens(self, tokens):
+        return self.model.llama_tokenizer.decode(tokens, add_special_tokens=False)
+
+    # GPU memory use, in bytes
+    def memory_stats(self):
+        import torch
+        return {
+            "allocated": torch.cuda.memory_allocated(self.device),
+            "reserved": torch.cuda.memory_reserved(self.device),
+            "peak": torch.cuda.max_memory_allocated(self.device)
+        }
+
+    # numpy has no bfloat16, so those embeddings are stored as their raw int16 bits
+    def save_embedding(self, f, emb):
+        import numpy as np
+        import torch
+        emb = emb.detach().cpu()
+        if emb.dtype == torch.bfloat16:
+            emb = emb.view(torch.int16)
+        np.save(f, emb.numpy())
+
+    # read straight into one array that the tensor shares; it goes to the device right away, so
+    # memory-mapping the file would save nothing
+    def load_embedding(self, path):
+        import numpy as np
+        import torch
+        emb = torch.from_numpy(np.load(path))
+        if emb.dtype == torch.int16:
+            emb = emb.view(torch.bfloat16)
+        return emb.to(self.device)
+
+
+# stand-in for a tensor in the fake backend: just a number of positions and a size in bytes
+# (sized like MiniGPT-4 13B: 5120-wide bf16 hidden states, 40 layers)
+class FakeTensor:
+    def __init__(self, positions, position_bytes):
+        self.positions = positions
+        self.position_bytes = position_bytes
+        self.nbytes = positions * position_bytes
+
+FAKE_IMAGE_POSITIONS = 32
+FAKE_EMBEDDING_BYTES = 5120 * 2
+FAKE_KV_BYTES = 40 * 5120 * 2
+FAKE_WORDS = ['a', 'photo', 'of', 'the', 'red', 'old', 'small', 'house', 'tree', 'sky', 'people', 'street', 'dog',
+              'beach', 'mountain', 'city', 'night', 'water', 'car', 'light', 'green', 'with', 'and', 'in', ',', '.']
+# first token id used for FAKE_WORDS; ids below are LLaMA's special tokens
+FAKE_WORD_BASE = 100
+
+# CPU-only backend for load testing the HTTP, queue, session and cache layers without a GPU
+# encoding and generation just take the configured time: --fake-encode-ms per image batch,
+# --fake-prefill-tokens-per-sec for uncached prompt positions, and one decode step per token
+# at --fake-tokens-per-sec for the whole batch (as on a GPU); answers are --fake-answer-tokens
+# words chosen from a hash of the prompt, so the same conversation always gets the same answer
+class FakeBackend:
+    name = 'fake'
+    embedding_ext = '.json'
+
+    def __init__(self, args):
+        self.args = args
+        self.device = 'cpu'
+        self.input_size = 224
+
+    def load(self, progress):
+        print('Using fake MiniGPT-4 backend (no model loaded)...')
+        if self.args.fake_load_seconds > 0:
+            progress('loading model')
+            time.sleep(self.args.fake_load_seconds)
+
+    def new_conversation(self):
+        return CONV_VISION_FAKE.copy()
+
+    def preprocess(self, image):
+        return image.size
+
+    # each extra image in a batch costs --fake-encode-batch-cost of a single encode
+    def encode_batch(self, inputs):
+        time.sleep(self.args.fake_encode_ms / 1000 * (1 + (len(inputs) - 1) * self.args.fake_encode_batch_cost))
+        return [FakeTensor(FAKE_IMAGE_POSITIONS, FAKE_EMBEDDING_BYTES) for _ in inputs]
+
+    # word/punctuation "tokens" hashed into LLaMA's vocabulary size
+    def prompt_inputs(self, conv, img_list, img_keys):
+        prompt_segs = conv.get_prompt().split('<ImageHere>')
+        if len(prompt_segs) != len(img_list) + 1:
+            raise ValueError('Unmatched numbers of image placeholders and images.')
+        keys = []
+        for i, seg in enumerate(prompt_segs):
+            if i == 0:
+                keys.append(1)
+            keys.extend(zlib.crc32(piece.encode()) % 32000 for piece in re.findall(r"\w+|[^\w\s]", seg))
+            if i < len(img_list):
+                keys.extend((img_keys[i], p) for p in range(img_list[i].positions))
+        return keys, None
+
+    def generate(self, rows, add_token, keep_prefix):
+        prefill = sum(row.length - row.cached for row in rows)
+        time.sleep(prefill / self.args.fake_prefill_tokens_per_sec)
+        answers = []
+        for row in rows:
+            if keep_prefix and row.keys is not None:
+                row.prefix = PrefixCache(row.keys, ((FakeTensor(len(row.keys), FAKE_KV_BYTES // 2), FakeTensor(len(row.keys), FAKE_KV_BYTES // 2)),))
+            rng = random.Random(zlib.crc32(row.session.chat_state.get_prompt().encode()))
+            answers.append([FAKE_WORD_BASE + rng.randrange(len(FAKE_WORDS)) for _ in range(self.args.fake_answer_tokens)] + STOP_WORDS_IDS[0])
+        for step in range(max(row.params.max_new_tokens for row in rows)):
+            time.sleep(1 / self.args.fake_tokens_per_sec)
+            for row, answer in zip(rows, answers):
+                if not row.done:
+                    add_token(row, answer[step] if step < len(answer) else EOS_TOKEN_ID)
+            if all(row.done for row in rows):
+                break
+
+    def truncate_prefix(self, cache, length):
+        return PrefixCache(cache.keys[:length], tuple((FakeTensor(length, k.position_bytes), FakeTensor(length, v.position_bytes)) for k, v in cache.past))
+
+    def decode_tokens(self, tokens):
+        words = []
+        for token in tokens:
+            if token == STOP_WORDS_IDS[0][0]:
+                words.append('###')
+            elif FAKE_WORD_BASE <= token < FAKE_WORD_BASE + len(FAKE_WORDS):
+                words.append(FAKE_WORDS[token - FAKE_WORD_BASE])
+        return ' '.join(words).replace(' ,', ',').replace(' .', '.')
+
+    def memory_stats(self):
+        return {}
+
+    def save_embedding(self, f, emb):
+        f.write(json.dumps({ "positions": emb.positions, "position_bytes": emb.position_bytes }).encode())
+
+    def load_embedding(self, path):
+        with open(path, 'r') as f:
+            data = json.load(f)
+        return FakeTensor(data['positions'], data['position_bytes'])
+
+BACKENDS = { 'minigpt4': MiniGPT4Backend, 'fake': FakeBackend }
+
+
+# decode image bytes to RGB
+# draft_size > 0 lets the JPEG decoder produce a 1/2, 1/4 or 1/8 scale image directly (DCT
+# scaling), no smaller than draft_size on either side: a 50 MP photo is never decoded in full
+# when the encoder only looks at 224x224; other formats are decoded in full
+# max_side > 0 then shrinks the image so its longest side fits
+# max_pixels takes the place of PIL's own decompression-bomb check (both only read the image
+# header), which disable_pil_pixel_limit turns off at startup
+# depends on nothing but its arguments, so it can run in a --decode-processes worker
+def decode_image_data(data, max_pixels=0, max_side=0, draft_size=0):
+    image = Image.open(io.BytesIO(data))
+    w, h = image.size
+    if max_pixels > 0 and w * h > max_pixels:
+        raise ValueError('image is too large (' + str(w) + 'x' + str(h) + ' pixels)')
+    if draft_size > 0:
+        image.draft('RGB', (draft_size, draft_size))
+    if max_side > 0 and max(image.size) > max_side:
+        image.thumbnail((max_side, max_side), Image.BICUBIC)
+    return image.convert('RGB')
+
+# PIL refuses images over ~179 MP on its own, whatever --max-image-pixels says; the server
+# checks --max-image-pixels itself instead (see decode_image_data)
+def disable_pil_pixel_limit():
+    Image.MAX_IMAGE_PIXELS = None
+
+# decode processes leave Ctrl-C to the server, which drains before shutting them down, and
+# check image sizes the same way it does
+def init_decode_process():
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    disable_pil_pixel_limit()
 
 
 # MiniGPT-4 basic implementation
+# the loaded model is shared; all per-conversation state lives in a Session
 class MiniGPT4:
-    def __init__(self):
-        self.chat = self.init()
-        self.chat_state = None
-        self.img_list = []
-        #self.num_beams = 1
-        #self.temperature = 1
-        self.busy = False
+    # argv is a list of command-line arguments (default: sys.argv)
+    def __init__(self, argv=None):
+        self.args = self.parse_args(argv)
+        # the model itself is loaded in the background by start_loading()
+        self.backend = BACKENDS[self.args.backend](self.args)
+        self.state = 'loading'
+        self.stage = ''
+        self.error = ''
+        self.load_started = None
+        self.load_finished = None
+        disable_pil_pixel_limit()
+        # with --decode-processes, image decoding runs in separate processes (spawned, not forked,
+        # as this one has threads) so it isn't held back by the GIL
+        self.decode_pool = None
+        if self.args.decode_processes > 0:
+            self.decode_pool = ProcessPoolExecutor(max_workers=self.args.decode_processes, mp_context=multiprocessing.get_context('spawn'),
+                                                   initializer=init_decode_process)
+        self.embeddings = EmbeddingCache(self.args.embedding_cache_size, self.args.embedding_cache_dir, self.backend)
+        self.responses = ResponseCache(self.args.response_cache_size, self.args.response_cache_dir)
+        # prefix caches: one shared by every conversation (the system prompt), plus one per
+        # session kept in LRU order within --kv-cache-mb
+        self.system_prefix = None
+        self.kv_budget = int(self.args.kv_cache_mb * 1024 * 1024)
+        self.kv_sessions = OrderedDict()
+        self.kv_lock = threading.Lock()
+        self.prefill_tokens = 0
+        self.reused_tokens = 0
+        # when the current batch produced its first token (ends the prefill stage)
+        self.first_token = None
+        # off while warming up, so the synthetic answer doesn't show in /metrics
+        self.record_metrics = True
 
     # handle optional user-supplied command-line arguments
-    def parse_args(self):
+    def parse_args(self, argv=None):
         parser = argparse.ArgumentParser(description="Demo")
         parser.add_argument("--cfg-path", default="eval_configs/minigpt4_eval.yaml", help="path to configuration file.")
         parser.add_argument("--gpu-id", type=int, default=0, help="specify the gpu to load the model.")
+        parser.add_argument("--backend", default="minigpt4", choices=list(BACKENDS), help="model backend; 'fake' simulates the model on CPU for load testing.")
+        parser.add_argument("--fake-encode-ms", type=float, default=40, help="fake backend: time to encode an image.")
+        parser.add_argument("--fake-encode-batch-cost", type=float, default=0.2, help="fake backend: time each extra image adds to an encode batch, as a fraction of --fake-encode-ms.")
+        parser.add_argument("--fake-prefill-tokens-per-sec", type=float, default=4000, help="fake backend: prompt processing speed.")
+        parser.add_argument("--fake-tokens-per-sec", type=float, default=25, help="fake backend: generation speed (per batch).")
+        parser.add_argument("--fake-answer-tokens", type=int, default=40, help="fake backend: length of every answer.")
+        parser.add_argument("--fake-load-seconds", type=float, default=0, help="fake backend: time taken to load the model.")
+        parser.add_argument("--warmup", action='store_true', help="answer one dummy question after loading so the first request isn't slower than the rest.")
+        parser.add_argument("--host", default="127.0.0.1", help="address to listen on.")
+        parser.add_argument("--port", type=int, default=5000, help="port to listen on.")
+        parser.add_argument("--http-server", default="auto", choices=['auto', 'waitress', 'werkzeug'], help="HTTP server to use; auto picks waitress if it is installed.")
+        parser.add_argument("--threads", type=int, default=16, help="request handling threads (waitress).")
+        parser.add_argument("--connection-limit", type=int, default=100, help="maximum number of open client connections (waitress).")
+        parser.add_argument("--drain-timeout", type=float, default=120, help="seconds to wait for queued and running requests to finish when shutting down.")
+        parser.add_argument("--max-message-chars", type=int, default=4000, help="reject questions longer than this (0 = no limit).")
+        parser.add_argument("--max-sessions", type=int, default=64, help="maximum number of concurrent sessions kept in memory.")
+        parser.add_argument("--session-ttl", type=int, default=3600, help="seconds of inactivity before a session is discarded (0 = never).")
+        parser.add_argument("--session-memory-mb", type=float, default=0, help="cap on memory used by session image embeddings (0 = unlimited).")
+        parser.add_argument("--queue-depth", type=int, default=32, help="maximum number of waiting requests before new ones are rejected with 429 (0 = unbounded).")
+        parser.add_argument("--embedding-cache-size", type=int, default=256, help="number of encoded images kept in memory for repeat uploads (0 = disabled).")
+        parser.add_argument("--embedding-cache-dir", default="", help="optional directory for a persistent on-disk embedding cache (use one directory per model).")
+        parser.add_argument("--max-upload-mb", type=float, default=64, help="largest accepted upload request, in MB.")
+        parser.add_argument("--max-image-pixels", type=int, default=200000000, help="reject images with more pixels than this (0 = no limit).")
+        parser.add_argument("--max-image-side", type=int, default=0, help="downscale uploaded images so their longest side is at most this many pixels (0 = keep original size).")
+        parser.add_argument("--kv-cache-mb", type=float, default=1024, help="memory budget for reusing attention state of previous turns across asks (0 = disabled).")
+        parser.add_argument("--max-batch-size", type=int, default=4, help="maximum number of questions answered together in one generate call (1 = no batching).")
+        parser.add_argument("--max-batch-wait-ms", type=float, default=10, help="how long to wait for more questions to fill a batch.")
+        parser.add_argument("--encode-batch-size", type=int, default=8, help="maximum number of uploaded images encoded together (1 = no batching).")
+        parser.add_argument("--encode-batch-wait-ms", type=float, default=10, help="how long to wait for more images to fill an encode batch.")
+        parser.add_argument("--preprocess-threads", type=int, default=4, help="threads decoding & preprocessing uploaded images, ahead of the encoder.")
+        parser.add_argument("--decode-processes", type=int, default=0, help="decode images in this many worker processes instead of the preprocessing threads (0 = decode in the threads).")
+        parser.add_argument("--decode-size", type=int, default=-1, help="decode JPEGs at a reduced scale, no smaller than this many pixels per side (-1 = twice the vision encoder's input size, 0 = always decode in full).")
+        parser.add_argument("--max-upload-batch", type=int, default=32, help="maximum number of images in one /api/v1/upload_batch request.")
+        parser.add_argument("--max-history-turns", type=int, default=-1, help="earlier questions & answers kept in a conversation (-1 = all, 0 = stateless: each question sees only the image).")
+        parser.add_argument("--max-prompt-tokens", type=int, default=0, help="drop the oldest questions & answers from prompts longer than this many tokens (0 = no limit).")
+        parser.add_argument("--max-new-tokens", type=int, default=300, help="default (and largest allowed) answer length, in tokens.")
+        parser.add_argument("--deterministic", action='store_true', help="answer with greedy decoding (temperature 0) unless a request asks otherwise, so repeated questions can be served from the response cache.")
+        parser.add_argument("--response-cache-size", type=int, default=1024, help="number of deterministic answers kept in memory (0 = disabled).")
+        parser.add_argument("--response-cache-dir", default="", help="optional directory for a persistent on-disk response cache.")
         parser.add_argument(
             "--options",
             nargs="+",
@@ -58,52 +1211,448 @@ class MiniGPT4:
             "in xxx=yyy format will be merged into config file (deprecate), "
             "change to --cfg-options instead.",
         )
-        args = parser.parse_args()
+        args = parser.parse_args(argv)
         return args
 
+    # load the model on a background thread so the server can start answering status
+    # requests right away; state goes from 'loading' to 'ready' or 'failed'
+    def start_loading(self):
+        self.load_started = time.time()
+        threading.Thread(target=self.init, name='minigpt4-loader', daemon=True).start()
+
     # load model
     def init(self):
         print('Initializing...')
-        args = self.parse_args()
-        cfg = Config(args)
+        try:
+            self.backend.load(self.set_stage)
+            if self.args.warmup:
+                self.set_stage('warming up')
+                self.warmup()
+        except Exception as e:
+            print('Error: unable to load MiniGPT-4: ' + str(e))
+            self.error = str(e)
+            self.state = 'failed'
+        else:
+            self.stage = ''
+            self.state = 'ready'
+            print('Initialization Finished (' + str(round(time.time() - self.load_started, 1)) + ' seconds)')
+        self.load_finished = time.time()
 
-        model_config = cfg.model_cfg
-        model_config.device_8bit = args.gpu_id
-        model_cls = registry.get_model_class(model_config.arch)
-        model = model_cls.from_config(model_config).to('cuda:{}'.format(args.gpu_id))
+    def set_stage(self, stage):
+        self.stage = stage
+        print('Initializing: ' + stage + '...')
 
-        vis_processor_cfg = cfg.datasets_cfg.cc_sbu_align.vis_processor.train
-        vis_processor = registry.get_processor_class(vis_processor_cfg.name).from_config(vis_processor_cfg)
-        chat = Chat(model, vis_processor, device='cuda:{}'.format(args.gpu_id))
-        print('Initialization Finished')
-        return chat
+    def ready(self):
+        return self.state == 'ready'
 
-    def reset(self):
-        if self.chat_state is not None:
-            self.chat_state.messages = []
-        self.img_list = []
-        print('MiniGPT-4 session has been reset...')
-
-    # send image to MiniGPT-4
-    def upload_img(self, img):
-        msg = ''
-        if exists(img):
-            self.chat_state = CONV_VISION.copy()
-            self.img_list = []
-            msg = self.chat.upload_img(img, self.chat_state, self.img_list)
+    def load_status(self):
+        r = { "state": self.state, "stage": self.stage }
+        if self.load_started is not None:
+            r["seconds"] = round((self.load_finished or time.time()) - self.load_started, 1)
+        if self.error != '':
+            r["error"] = self.error
+        return r
+
+    # answer a short question about a blank image so one-time costs (CUDA kernel selection,
+    # allocator growth) are paid before the first real request; leaves nothing in the caches
+    # or the metrics
+    def warmup(self):
+        session = Session('warmup', self.new_conversation)
+        session.img_list.extend(self.backend.encode_batch([self.backend.preprocess(Image.new('RGB', (224, 224), (128, 128, 128)))]))
+        session.img_keys.append('warmup')
+        session.chat_state.append_message(session.chat_state.roles[0], IMAGE_MESSAGE)
+        self.ask(session, 'Describe this image.')
+        self.record_metrics = False
+        try:
+            result = self.answer_batch([session], params=[GenerationParams(max_new_tokens=16, temperature=0, use_cache=False)])[0]
+        finally:
+            self.record_metrics = True
+        if isinstance(result, Exception):
+            raise result
+        with self.kv_lock:
+            self.kv_sessions.pop(session.id, None)
+        self.prefill_tokens = 0
+        self.reused_tokens = 0
+
+    def new_conversation(self):
+        return self.backend.new_conversation()
+
+    def reset(self, session):
+        session.reset()
+        print('MiniGPT-4 session ' + session.id + ' has been reset...')
+
+    # decode uploaded image bytes (see decode_image_data), in a decode process if configured
+    def decode_image(self, data):
+        started = time.time()
+        draft_size = self.args.decode_size
+        if draft_size < 0:
+            # some headroom above the encoder's input, so the final resize still has detail to work with
+            draft_size = self.backend.input_size * 2
+        decode_args = (data, self.args.max_image_pixels, self.args.max_image_side, draft_size)
+        if self.decode_pool is not None:
+            image = self.decode_pool.submit(decode_image_data, *decode_args).result()
         else:
-            print('Error: upload image (' + img + ') does not exist!')
-        return msg
+            image = decode_image_data(*decode_args)
+        DECODE_SECONDS.observe(time.time() - started)
+        return image
 
-    def ask(self, message):
+    # decode & preprocess uploaded image bytes for the encoder; returns (inputs, seconds taken)
+    # CPU-only, so it runs on request threads (or the preprocessing pool) instead of the model worker
+    def prepare_image(self, data):
+        started = time.time()
+        inputs = self.backend.preprocess(self.decode_image(data))
+        return inputs, time.time() - started
+
+    # batch handler for 'upload' jobs: sends images to MiniGPT-4, starting a fresh conversation
+    # in each session; payloads are (session, key, data, inputs, prepare_seconds) tuples where
+    # key is EmbeddingCache.key(data) and inputs the prepared image, or None if the image was in
+    # the embedding cache when submitted; images not in the cache are encoded in one batch
+    # runs on the model worker thread
+    def upload_batch(self, payloads):
+        results = [None] * len(payloads)
+        timings = []
+        embs = {}
+        pending = OrderedDict()
+        for i, (session, key, data, inputs, seconds) in enumerate(payloads):
+            timing = {}
+            timings.append(timing)
+            if seconds is not None:
+                timing["decode_seconds"] = round(seconds, 4)
+            if key not in embs and key not in pending:
+                emb = self.embeddings.get(key)
+                if emb is not None:
+                    embs[key] = emb
+                elif inputs is None:
+                    # evicted from the cache since the request checked
+                    try:
+                        inputs, seconds = self.prepare_image(data)
+                    except Exception as e:
+                        results[i] = e
+                        continue
+                    timing["decode_seconds"] = round(seconds, 4)
+                if emb is None:
+                    pending[key] = inputs
+            timing["embedding_cache"] = 'hit' if key in embs else 'miss'
+
+        encoded = 0.0
+        if len(pending) > 0:
+            started = time.time()
+            try:
+                batch = self.backend.encode_batch(list(pending.values()))
+            except Exception as e:
+                return [results[i] or e for i in range(len(payloads))]
+            encoded = time.time() - started
+            ENCODE_SECONDS.observe(encoded)
+            ENCODE_BATCH_SIZE.observe(len(pending))
+            for key, emb in zip(pending.keys(), batch):
+                self.embeddings.put(key, emb)
+                embs[key] = emb
+
+        for i, (session, key, data, inputs, seconds) in enumerate(payloads):
+            if results[i] is not None:
+                continue
+            if timings[i]["embedding_cache"] == 'miss':
+                timings[i]["encode_seconds"] = round(encoded, 4)
+                timings[i]["encode_batch_size"] = len(pending)
+            with session.lock:
+                session.chat_state = self.new_conversation()
+                session.img_list = [embs[key]]
+                session.img_keys = [key]
+                session.timing = timings[i]
+                session.chat_state.append_message(session.chat_state.roles[0], IMAGE_MESSAGE)
+            results[i] = 'Received.'
+        return results
+
+    # same as Chat.ask: the first question is merged into the image message
+    def ask(self, session, message):
         if len(message) > 0:
-            self.chat.ask(message, self.chat_state)
+            conv = session.chat_state
+            if len(conv.messages) > 0 and conv.messages[-1][0] == conv.roles[0] and conv.messages[-1][1][-6:] == '</Img>':
+                conv.messages[-1][1] = ' '.join([conv.messages[-1][1], message])
+            else:
+                conv.append_message(conv.roles[0], message)
         else:
             print('Error: call to ask with empty message!')
 
-    def answer(self):
-        msg = self.chat.answer(self.chat_state, self.img_list)[0]
-        return msg
+    # a conversation's questions & answers as [question, answer] pairs, the first question
+    # without the image placeholder it shares a message with (see ask); None if the
+    # conversation doesn't start with an image
+    def history_turns(self, conv):
+        if len(conv.messages) == 0 or not conv.messages[0][1].startswith(IMAGE_MESSAGE):
+            return None
+        turns = [[conv.messages[0][1][len(IMAGE_MESSAGE):].strip(), None]]
+        for role, message in conv.messages[1:]:
+            if role == conv.roles[0]:
+                turns.append([message, None])
+            else:
+                turns[-1][1] = message
+        return turns
+
+    # rebuild a conversation from history_turns() pairs; the last turn is the pending question
+    def set_history(self, conv, turns):
+        conv.messages = []
+        for i, (question, answer) in enumerate(turns):
+            if i == 0:
+                question = ' '.join([IMAGE_MESSAGE, question]) if question != '' else IMAGE_MESSAGE
+            conv.append_message(conv.roles[0], question)
+            if answer is not None or i == len(turns) - 1:
+                conv.append_message(conv.roles[1], answer)
+
+    # enforce --max-history-turns on a conversation with a pending question: older
+    # question/answer pairs are dropped, the image always stays
+    def limit_history(self, conv):
+        limit = self.args.max_history_turns
+        if limit < 0:
+            return
+        turns = self.history_turns(conv)
+        if turns is not None and len(turns) - 1 > limit:
+            self.set_history(conv, turns[len(turns) - 1 - limit:])
+
+    # drop the oldest question/answer pair (for --max-prompt-tokens); False once only the
+    # pending question is left
+    def drop_oldest_turn(self, conv):
+        turns = self.history_turns(conv)
+        if turns is None or len(turns) < 2:
+            return False
+        self.set_history(conv, turns[1:])
+        return True
+
+    def answer(self, session):
+        result = self.answer_batch([session])[0]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    # sampling settings for requests that don't specify their own
+    def default_params(self):
+        return GenerationParams(max_new_tokens=self.args.max_new_tokens, temperature=0 if self.args.deterministic else 1.0)
+
+    # ResponseCache key for the answer a session is about to get, or None if it can't be cached
+    def response_key(self, session, params):
+        if not params.deterministic() or not self.responses.enabled():
+            return None
+        # the history limits are part of the key: they decide what the model actually sees
+        return ResponseCache.key([self.backend.name, self.args.cfg_path, session.img_keys, session.chat_state.get_prompt(), params.key(),
+                                  self.args.max_history_turns, self.args.max_prompt_tokens])
+
+    # answer the pending question in each session with one batched decode
+    # returns one entry per session: the answer text, or the exception for that session
+    # params optionally holds GenerationParams per session (default: default_params())
+    # conversations are first cut down to --max-history-turns / --max-prompt-tokens
+    # deterministic answers already in the response cache are returned without generating
+    # positions already held in a prefix cache (shared system prompt, or the session's
+    # previous prompt) are not run through the model again
+    # streams optionally holds a TokenStream (or None) per session to receive partial answers
+    def answer_batch(self, sessions, streams=None, params=None, max_length=2000):
+        results = [None] * len(sessions)
+        rows = []
+        cache_keys = {}
+        for i, session in enumerate(sessions):
+            conv = session.chat_state
+            p = params[i] if params is not None else self.default_params()
+            stream = streams[i] if streams is not None else None
+            try:
+                conv.append_message(conv.roles[1], None)
+                self.limit_history(conv)
+                key = self.response_key(session, p) if p.use_cache else None
+                entry = self.responses.get(key) if key is not None else None
+                if entry is not None:
+                    conv.messages[-1][1] = entry['response']
+                    session.prompt_tokens = entry['prompt_tokens']
+                    session.cached_tokens = 0
+                    session.timing = { "response_cache": 'hit' }
+                    if stream is not None:
+                        stream.push(entry['response'])
+                    results[i] = entry['response']
+                    continue
+                keys, embs = self.backend.prompt_inputs(conv, session.img_list, session.img_keys)
+                while 0 < self.args.max_prompt_tokens < len(keys) and self.drop_oldest_turn(conv):
+                    keys, embs = self.backend.prompt_inputs(conv, session.img_list, session.img_keys)
+                begin_idx = max(0, len(keys) + p.max_new_tokens - max_length)
+                row = GenerationRow(session, keys, embs, stream, p)
+                if key is not None:
+                    cache_keys[i] = key
+                if begin_idx > 0:
+                    print('Warning: The number of tokens in current conversation exceeds the max length. '
+                          'The model will not see the contexts outside the range.')
+                    # positions shift, so nothing cached applies and nothing is worth caching
+                    row.keys = None
+                    row.start = begin_idx
+                    row.length -= begin_idx
+                else:
+                    self.find_prefix(row)
+                rows.append((i, row))
+            except Exception as e:
+                self.discard_answer(conv)
+                results[i] = e
+        if len(rows) == 0:
+            return results
+
+        for _, row in rows:
+            self.prefill_tokens += row.length - row.cached
+            self.reused_tokens += row.cached
+            row.session.prompt_tokens = row.length
+            row.session.cached_tokens = row.cached
+        self.first_token = None
+        started = time.time()
+        try:
+            self.backend.generate([row for _, row in rows], self.add_token, self.kv_budget > 0)
+        except Exception as e:
+            for i, row in rows:
+                self.discard_answer(row.session.chat_state)
+                results[i] = e
+            return results
+        self.save_prefixes([row for _, row in rows])
+        self.record_timing([row for _, row in rows], started)
+
+        for i, row in rows:
+            results[i] = self.decode_answer(row.session.chat_state, row.tokens)
+            if i in cache_keys:
+                self.responses.put(cache_keys[i], { "response": results[i], "prompt_tokens": row.length })
+                row.session.timing["response_cache"] = 'miss'
+            elif not row.params.use_cache and row.params.deterministic() and self.responses.enabled():
+                row.session.timing["response_cache"] = 'bypass'
+        return results
+
+    # pick the longest usable cached prefix for a row; at least one prompt position is
+    # always recomputed so there are logits to sample the first answer token from
+    def find_prefix(self, row):
+        for cache in (row.session.prefix_cache, self.system_prefix):
+            if cache is not None:
+                length = min(cache.common_length(row.keys), len(row.keys) - 1)
+                if length > row.cached:
+                    row.cache = cache
+                    row.cached = length
+
+    # called by the backend for every generated token
+    def add_token(self, row, token):
+        if self.first_token is None:
+            self.first_token = time.time()
+        row.tokens.append(token)
+        row.done = self.is_finished(row.tokens) or len(row.tokens) >= row.params.max_new_tokens
+        if row.stream is not None:
+            row.stream.push(self.partial_answer(row.tokens))
+
+    # split a batch's run time into prefill (up to the first token) and generation, for
+    # /metrics and each session's timing breakdown
+    def record_timing(self, rows, started):
+        finished = time.time()
+        first = self.first_token if self.first_token is not None else finished
+        if self.record_metrics:
+            PREFILL_SECONDS.observe(first - started)
+            GENERATE_SECONDS.observe(finished - first)
+            BATCH_SIZE.observe(len(rows))
+        for row in rows:
+            if self.record_metrics:
+                GENERATED_TOKENS.inc(len(row.tokens))
+            row.session.timing = {
+                "prefill_seconds": round(first - started, 4),
+                "generate_seconds": round(finished - first, 4),
+                "batch_size": len(rows),
+                "tokens": len(row.tokens)
+            }
+
+    # keep each row's prompt state for the session's next turn; the first prompt segment
+    # (system prompt up to the first image) is shared by every session
+    def save_prefixes(self, rows):
+        for row in rows:
+            if row.prefix is None:
+                continue
+            if self.system_prefix is None:
+                length = next((p for p, key in enumerate(row.keys) if isinstance(key, tuple)), 0)
+                if length > 0:
+                    self.system_prefix = self.backend.truncate_prefix(row.prefix, length)
+            self.store_prefix(row.session, row.prefix)
+
+    # keep a session's prompt cache, dropping the least recently used ones beyond the memory budget
+    def store_prefix(self, session, cache):
+        with self.kv_lock:
+            session.prefix_cache = cache
+            self.kv_sessions[session.id] = session
+            self.kv_sessions.move_to_end(session.id)
+            total = 0
+            for s in list(self.kv_sessions.values()):
+                if s.prefix_cache is None:
+                    del self.kv_sessions[s.id]
+                else:
+                    total += s.prefix_cache.nbytes()
+            while total > self.kv_budget and len(self.kv_sessions) > 0:
+                _, oldest = self.kv_sessions.popitem(last=False)
+                if oldest.prefix_cache is not None:
+                    total -= oldest.prefix_cache.nbytes()
+                    oldest.prefix_cache = None
+
+    def is_finished(self, tokens):
+        if tokens[-1] == EOS_TOKEN_ID:
+            return True
+        for stop in STOP_WORDS_IDS:
+            if tokens[-len(stop):] == stop:
+                return True
+        return False
+
+    def kv_stats(self):
+        with self.kv_lock:
+            sessions = [s for s in self.kv_sessions.values() if s.prefix_cache is not None]
+            used = sum(s.prefix_cache.nbytes() for s in sessions)
+        total = self.prefill_tokens + self.reused_tokens
+        return {
+            "sessions": len(sessions),
+            "memory_mb": round(used / (1024 * 1024), 2),
+            "budget_mb": round(self.kv_budget / (1024 * 1024), 2),
+            "prefill_tokens": self.prefill_tokens,
+            "reused_tokens": self.reused_tokens,
+            "reuse_ratio": round(self.reused_tokens / total, 3) if total > 0 else 0.0
+        }
+
+    # same post-processing as Chat.answer
+    def decode_answer(self, conv, tokens):
+        if EOS_TOKEN_ID in tokens:
+            tokens = tokens[:tokens.index(EOS_TOKEN_ID)]
+        if len(tokens) > 0 and tokens[0] == 0:  # the model might output a unknow token <unk> at the beginning. remove it
+            tokens = tokens[1:]
+        if len(tokens) > 0 and tokens[0] == 1:  # some users find that there is a start token <s> at the beginning. remove it
+            tokens = tokens[1:]
+        output_text = self.backend.decode_tokens(tokens)
+        output_text = output_text.split('###')[0]  # remove the stop sign '###'
+        output_text = output_text.split('Assistant:')[-1].strip()
+        conv.messages[-1][1] = output_text
+        return output_text
+
+    # the part of an unfinished answer that is safe to show: cut at the '###' stop word,
+    # holding back trailing '#'s that may become one and incomplete multi-byte characters
+    def partial_answer(self, tokens):
+        if EOS_TOKEN_ID in tokens:
+            tokens = tokens[:tokens.index(EOS_TOKEN_ID)]
+        while len(tokens) > 0 and tokens[0] in (0, 1):
+            tokens = tokens[1:]
+        text = self.backend.decode_tokens(tokens)
+        text = text.split('###')[0].split('Assistant:')[-1].lstrip()
+        return text.rstrip('#').rstrip('\ufffd')
+
+    # remove the empty assistant turn left behind by a failed generation
+    def discard_answer(self, conv):
+        if len(conv.messages) > 0 and conv.messages[-1][1] is None:
+            conv.messages.pop()
+
+    # batch handler for 'ask' jobs; payloads are (session, message, stream, params) tuples where
+    # stream is a TokenStream or None and params GenerationParams, and all sessions are distinct
+    # (guaranteed by JobQueue)
+    # runs on the model worker thread
+    def ask_batch(self, payloads):
+        sessions = [session for session, _, _, _ in payloads]
+        streams = [stream for _, _, stream, _ in payloads]
+        for session in sessions:
+            session.lock.acquire()
+        try:
+            for session, message, _, _ in payloads:
+                self.ask(session, message)
+            return self.answer_batch(sessions, streams, [params for _, _, _, params in payloads])
+        finally:
+            for session in sessions:
+                session.lock.release()
+            for stream in streams:
+                if stream is not None:
+                    stream.close()
 
 
 # used by shutdown handler to kill the server
@@ -112,81 +1661,642 @@ def kill():
 
 # Flask setup
 app = Flask('MiniGPT-4')
-app.config['UPLOAD_FOLDER'] = 'temp'
-# remove old temp images from previous session
-if os.path.exists(app.config['UPLOAD_FOLDER']):
-    shutil.rmtree(app.config['UPLOAD_FOLDER'])
-# create upload dir if it doesn't exist
-if not os.path.exists(app.config['UPLOAD_FOLDER']):
-    try:
-        Path(app.config['UPLOAD_FOLDER']).mkdir(parents=True, exist_ok=True)
-    except:
-        print('Error creating temp directory for images!')
 chat = None
+sessions = None
+jobs = None
+# decodes & preprocesses uploaded images
+preprocess_pool = None
+# set while shutting down: new requests are refused, queued and running ones finish
+draining = False
+# requests currently being handled
+active_requests = 0
+active_lock = threading.Lock()
+# stops the HTTP server started by serve(); None when running under an external WSGI server
+stop_server = None
+
+# builds the server: loads the model once and sets up sessions, the job queue and metrics
+# argv is a list or string of api-server.py command-line arguments (default: sys.argv)
+def create_app(argv=None):
+    global chat, sessions, jobs, preprocess_pool
+    if chat is not None:
+        return app
+    if isinstance(argv, str):
+        argv = shlex.split(argv)
+    chat = MiniGPT4(argv)
+    app.config['MAX_CONTENT_LENGTH'] = int(chat.args.max_upload_mb * 1024 * 1024)
+    sessions = SessionManager(chat.new_conversation, chat.args.max_sessions, chat.args.session_ttl, chat.args.session_memory_mb)
+    jobs = JobQueue(chat.args.queue_depth)
+    jobs.register_batcher('ask', Batcher(chat.ask_batch, chat.args.max_batch_size, chat.args.max_batch_wait_ms / 1000))
+    jobs.register_batcher('upload', Batcher(chat.upload_batch, chat.args.encode_batch_size, chat.args.encode_batch_wait_ms / 1000))
+    jobs.start()
+    preprocess_pool = ThreadPoolExecutor(max_workers=max(1, chat.args.preprocess_threads), thread_name_prefix='minigpt4-preprocess')
+    if chat.decode_pool is not None:
+        # start the decode processes now rather than on the first upload
+        for _ in range(chat.args.decode_processes):
+            chat.decode_pool.submit(int)
+    register_metrics()
+    chat.start_loading()
+    return app
+
+# an HTTP server for a WSGI app: waitress when it's installed, otherwise werkzeug's threaded
+# server (what app.run uses, without the development-server reloader & debugger); also used by
+# api-router.py
+# http_server is 'auto', 'waitress' or 'werkzeug'; threads, connection_limit & max_body only
+# apply to waitress
+# returns (name of the server used, run, stop): run() serves until stop() is called from
+# another thread (or a signal handler)
+def make_http_server(app, host, port, http_server='auto', threads=16, connection_limit=100, max_body=None, ident='MiniGPT-4'):
+    if http_server == 'auto':
+        try:
+            import waitress
+            http_server = 'waitress'
+        except ImportError:
+            http_server = 'werkzeug'
+    stopping = threading.Event()
+    if http_server == 'waitress':
+        from waitress import create_server
+        options = { 'threads': threads, 'connection_limit': connection_limit, 'ident': ident }
+        if max_body is not None:
+            options['max_request_body_size'] = max_body
+        server = create_server(app, host=host, port=port, **options)
+        serve_forever = server.run
+
+        # waitress' loop runs until every connection is closed, including idle keep-alive ones
+        # (e.g. a router's health checks), so close them all; done on the loop's own thread
+        def close_all():
+            for channel in list(server._map.values()):
+                channel.close()
+        shutdown = lambda: server.trigger.pull_trigger(close_all)
+    else:
+        from werkzeug.serving import make_server
+        server = make_server(host, port, app, threaded=True)
+        serve_forever = server.serve_forever
+        shutdown = server.shutdown
+
+    def run():
+        try:
+            serve_forever()
+        except OSError:
+            # waitress' loop may notice its socket closing mid-poll
+            if not stopping.is_set():
+                raise
+
+    def stop():
+        stopping.set()
+        shutdown()
+    return http_server, run, stop
+
+# serve requests (see make_http_server)
+# SIGINT/SIGTERM drain the server like /api/v1/shutdown; a second signal exits immediately
+def serve():
+    global stop_server
+    args = chat.args
+    http_server, run, stop_server = make_http_server(app, args.host, args.port, args.http_server, args.threads, args.connection_limit,
+                                                     app.config['MAX_CONTENT_LENGTH'], 'MiniGPT-4')
+    signal.signal(signal.SIGINT, handle_signal)
+    signal.signal(signal.SIGTERM, handle_signal)
+    print('Serving MiniGPT-4 on http://' + args.host + ':' + str(args.port) + ' (' + http_server + ')...')
+    run()
+    print('MiniGPT-4 server stopped.')
+
+def handle_signal(signum, frame):
+    if draining:
+        print('Forcing shutdown...')
+        os._exit(1)
+    threading.Thread(target=shutdown_server, daemon=True).start()
+
+# stop taking new requests, give queued and running ones up to --drain-timeout seconds to
+# finish, then stop the HTTP server
+def shutdown_server():
+    global draining
+    if draining:
+        return
+    draining = True
+    print('Draining MiniGPT-4 server (' + str(jobs.stats()['depth']) + ' queued, ' + str(active_requests) + ' in progress)...')
+    deadline = time.time() + chat.args.drain_timeout
+    while time.time() < deadline and (jobs.busy() or active_requests > 0):
+        time.sleep(0.1)
+    if jobs.busy() or active_requests > 0:
+        print('Warning: drain timed out; abandoning ' + str(active_requests) + ' requests...')
+    # let the last responses finish sending
+    time.sleep(0.5)
+    if stop_server is not None:
+        stop_server()
+    else:
+        kill()
+
+# metrics read from the server's components whenever /metrics is scraped
+def register_metrics():
+    metrics.add(Collected('minigpt4_queue_depth', 'Requests waiting in the queue.', 'gauge', lambda: jobs.stats()['depth']))
+    metrics.add(Collected('minigpt4_queue_running', 'Requests being worked on.', 'gauge', lambda: jobs.stats()['running']))
+    metrics.add(Collected('minigpt4_queue_rejected_total', 'Requests rejected because the queue was full.', 'counter', lambda: jobs.stats()['rejected']))
+    metrics.add(Collected('minigpt4_sessions', 'Open sessions.', 'gauge', lambda: sessions.stats()['sessions']))
+    metrics.add(Collected('minigpt4_sessions_evicted_total', 'Sessions discarded for idleness or memory.', 'counter', lambda: sessions.stats()['evicted']))
+    metrics.add(Collected('minigpt4_embedding_cache_hits_total', 'Uploads served from the in-memory embedding cache.', 'counter', lambda: chat.embeddings.stats()['hits']))
+    metrics.add(Collected('minigpt4_embedding_cache_disk_hits_total', 'Uploads served from the on-disk embedding cache.', 'counter', lambda: chat.embeddings.stats()['disk_hits']))
+    metrics.add(Collected('minigpt4_embedding_cache_misses_total', 'Uploads that had to be encoded.', 'counter', lambda: chat.embeddings.stats()['misses']))
+    metrics.add(Collected('minigpt4_embedding_cache_hit_ratio', 'Fraction of uploads served from the embedding cache.', 'gauge', lambda: chat.embeddings.stats()['hit_ratio']))
+    metrics.add(Collected('minigpt4_response_cache_hits_total', 'Answers served from the response cache (memory or disk).', 'counter', lambda: chat.responses.stats()['hits'] + chat.responses.stats()['disk_hits']))
+    metrics.add(Collected('minigpt4_response_cache_misses_total', 'Deterministic answers that had to be generated.', 'counter', lambda: chat.responses.stats()['misses']))
+    metrics.add(Collected('minigpt4_prefill_tokens_total', 'Prompt positions run through the model.', 'counter', lambda: chat.prefill_tokens))
+    metrics.add(Collected('minigpt4_reused_tokens_total', 'Prompt positions served from the prefix cache.', 'counter', lambda: chat.reused_tokens))
+    metrics.add(Collected('minigpt4_prefix_cache_reuse_ratio', 'Fraction of prompt positions served from the prefix cache.', 'gauge', lambda: chat.kv_stats()['reuse_ratio']))
+    metrics.add(Collected('minigpt4_prefix_cache_bytes', 'Memory held by per-session prefix caches.', 'gauge', lambda: int(chat.kv_stats()['memory_mb'] * 1024 * 1024)))
+    metrics.add(Collected('minigpt4_gpu_memory_allocated_bytes', 'GPU memory allocated by tensors.', 'gauge', lambda: chat.backend.memory_stats().get('allocated')))
+    metrics.add(Collected('minigpt4_gpu_memory_reserved_bytes', 'GPU memory reserved by the allocator.', 'gauge', lambda: chat.backend.memory_stats().get('reserved')))
+    metrics.add(Collected('minigpt4_gpu_memory_peak_bytes', 'Peak GPU memory allocated by tensors.', 'gauge', lambda: chat.backend.memory_stats().get('peak')))
 
 # Flask routes & handlers
+# sessions are identified by the id returned from /api/v1/upload; requests that
+# omit it fall back to the most recently uploaded session (legacy single-user behavior)
+def request_session_id():
+    session_id = request.values.get('session', '')
+    if session_id == '' and request.is_json:
+        session_id = (request.get_json(silent=True) or {}).get('session', '')
+    return session_id
+
+# a request option (form, query string or JSON body), or default if it isn't given
+def request_value(name, default=''):
+    value = request.values.get(name, '')
+    if value == '' and request.is_json:
+        value = (request.get_json(silent=True) or {}).get(name, '')
+    return default if value == '' else value
+
+# whether a boolean request option is set
+def request_flag(name):
+    return str(request_value(name)) in ('1', 'true', 'True')
+
+# sampling settings for a request: optional temperature, top_p and max_new_tokens (up to
+# --max-new-tokens), plus no_cache=1 to leave the response cache out
+# raises ValueError for settings out of range
+def request_generation_params():
+    params = chat.default_params()
+    try:
+        params.temperature = float(request_value('temperature', params.temperature))
+        params.top_p = float(request_value('top_p', params.top_p))
+        params.max_new_tokens = int(request_value('max_new_tokens', params.max_new_tokens))
+        params.num_beams = int(request_value('num_beams', params.num_beams))
+    except (TypeError, ValueError):
+        raise ValueError('temperature and top_p must be numbers, max_new_tokens and num_beams integers')
+    if params.temperature < 0:
+        raise ValueError('temperature must be 0 (greedy) or more')
+    if not 0 < params.top_p <= 1:
+        raise ValueError('top_p must be greater than 0 and at most 1')
+    if not 1 <= params.max_new_tokens <= chat.args.max_new_tokens:
+        raise ValueError('max_new_tokens must be between 1 and ' + str(chat.args.max_new_tokens))
+    if params.num_beams != 1:
+        raise ValueError('beam search is not supported; num_beams must be 1 (use temperature=0 for deterministic answers)')
+    params.use_cache = not request_flag('no_cache')
+    return params
+
+# per-request timing breakdown of a finished job, for timing=1 responses
+def job_timing(job, session, started):
+    timing = { "queue_seconds": round(job.started - job.submitted, 4) }
+    timing.update(session.timing)
+    timing["total_seconds"] = round(time.time() - started, 4)
+    return timing
+
+# request priority; higher values are scheduled first
+def request_priority():
+    try:
+        return int(request.values.get('priority', 0))
+    except ValueError:
+        return 0
+
+# response for a request rejected because the queue is full
+def queue_full_response(e):
+    r = jsonify({ "success": False, "message": "MiniGPT-4 is busy; request queue is full!", "retry_after": e.retry_after })
+    r.status_code = 429
+    r.headers['Retry-After'] = str(e.retry_after)
+    return r
+
+# submit a job for a request that has already started work (e.g. the later questions of an
+# /api/v1/analyze call): waits for room in the queue instead of failing the whole request
+def submit_when_possible(**kwargs):
+    while True:
+        try:
+            return jobs.submit(**kwargs)
+        except QueueFull as e:
+            time.sleep(e.retry_after)
+
+# checks an answer against an /api/v1/analyze follow-up rule
+def followup_matches(rule, answer):
+    condition = rule.get('if', '')
+    value = rule.get('value', '')
+    if condition == 'missing':
+        return str(value) not in answer
+    if condition == 'contains':
+        return str(value) in answer
+    if condition == 'words_over':
+        return len(answer.split()) > int(value)
+    if condition == 'words_under':
+        return len(answer.split()) < int(value)
+    raise ValueError('Unknown follow-up condition: ' + str(condition))
+
+# parses the prompts field of an /api/v1/analyze request into (prompt, followups) pairs
+# each entry is a plain string, or {"prompt": "...", "followups": [{"if": ..., "value": ..., "prompt": ...}]}
+def parse_analyze_prompts(raw):
+    if isinstance(raw, str):
+        raw = json.loads(raw)
+    if not isinstance(raw, list) or len(raw) == 0:
+        raise ValueError('prompts must be a non-empty list')
+    prompts = []
+    for entry in raw:
+        if isinstance(entry, str):
+            entry = { "prompt": entry }
+        if not isinstance(entry, dict) or entry.get('prompt', '') == '':
+            raise ValueError('each prompt needs a non-empty "prompt"')
+        followups = entry.get('followups', [])
+        for rule in followups:
+            followup_matches(rule, '')
+            if rule.get('prompt', '') == '':
+                raise ValueError('each follow-up needs a non-empty "prompt"')
+        prompts.append((entry['prompt'], followups))
+    return prompts
+
+# count every response by endpoint (the route pattern, so unknown paths share one label) and status
+@app.after_request
+def count_request(response):
+    endpoint = request.url_rule.rule if request.url_rule is not None else 'other'
+    REQUESTS.inc(labels=(endpoint, str(response.status_code)))
+    return response
+
+# refuse new work while draining, and model work until the model has loaded (status and
+# metrics stay available so load balancers & the router can see why); count requests in
+# progress for the drain
+@app.before_request
+def start_request():
+    global active_requests
+    if draining and request.endpoint not in ('status', 'metrics_endpoint', 'shutdown'):
+        r = jsonify({ "success": False, "message": "MiniGPT-4 server is shutting down!" })
+        r.status_code = 503
+        r.headers['Retry-After'] = '5'
+        return r
+    if not chat.ready() and request.endpoint in ('upload_file', 'upload_batch', 'analyze', 'ask'):
+        if chat.state == 'failed':
+            r = jsonify({ "success": False, "message": "MiniGPT-4 failed to load: " + chat.error })
+        else:
+            r = jsonify({ "success": False, "message": "MiniGPT-4 is still loading; try again shortly!", "model": chat.load_status() })
+            r.headers['Retry-After'] = '10'
+        r.status_code = 503
+        return r
+    with active_lock:
+        active_requests += 1
+    g.counted = True
+
+@app.teardown_request
+def end_request(exc):
+    global active_requests
+    if g.get('counted', False):
+        with active_lock:
+            active_requests -= 1
+
+# Prometheus metrics: stage latency histograms, token & cache counters, queue and memory gauges
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 # get MiniGPT-4's current status
+# pass session=<id> to get the position of that session's next request in the queue (0 = running)
 @app.route('/api/v1/status', methods=['GET'])
 def status():
-    if not chat.busy:
-        return jsonify({ "success": True, "message": "MiniGPT-4 is ready for a new request!" })
+    r = { "success": chat.ready() and not draining, "backend": chat.backend.name, "model": chat.load_status(), "sessions": sessions.stats(), "queue": jobs.stats(), "embedding_cache": chat.embeddings.stats(), "kv_cache": chat.kv_stats(), "response_cache": chat.responses.stats() }
+    if draining:
+        r["message"] = "MiniGPT-4 server is shutting down!"
+    elif chat.state == 'loading':
+        r["message"] = "MiniGPT-4 is loading" + (" (" + chat.stage + ")" if chat.stage != '' else '') + "..."
+    elif chat.state == 'failed':
+        r["message"] = "MiniGPT-4 failed to load: " + chat.error
+    elif not jobs.busy():
+        r["message"] = "MiniGPT-4 is ready for a new request!"
     else:
-        return jsonify({ "success": True, "message": "MiniGPT-4 is currently working on a request!" })
+        r["message"] = "MiniGPT-4 is currently working on a request!"
+    session_id = request.args.get('session', '')
+    if session_id != '':
+        r["position"] = jobs.position(session_id)
+    return jsonify(r)
 
 # shutdown MiniGPT-4 server
 @app.route('/api/v1/shutdown', methods=['GET'])
 def shutdown():
     print('Attempting to shut down...')
-    # call kill fuction in 0.5 secs
-    threading.Timer(0.5, kill).start()
+    # finish queued & running requests first (see shutdown_server)
+    threading.Thread(target=shutdown_server, daemon=True).start()
     return jsonify({ "success": True, "message": "Attempting to shut down MiniGPT-4 server..." })
 
 # reset MiniGPT-4 session
-@app.route('/api/v1/reset', methods=['GET'])
+@app.route('/api/v1/reset', methods=['GET', 'POST'])
 def reset():
-    chat.reset()
+    session_id = request_session_id()
+    session = sessions.get(session_id)
+    if session is not None:
+        with session.lock:
+            chat.reset(session)
+    elif session_id != '':
+        return jsonify({ "success": False, "message": "Unknown or expired session: " + session_id })
     return jsonify({ "success": True, "message": "MiniGPT-4 session has been reset..." })
 
+# discard a MiniGPT-4 session and free its image embedding
+@app.route('/api/v1/close', methods=['GET', 'POST'])
+def close():
+    session_id = request_session_id()
+    if session_id != '' and sessions.remove(session_id):
+        return jsonify({ "success": True, "message": "MiniGPT-4 session has been closed...", "session": session_id })
+    return jsonify({ "success": False, "message": "Unknown or expired session: " + session_id })
+
+# raw bytes of an uploaded image: a multipart 'file', a JSON body with a base64 'image',
+# or the request body itself (Content-Type image/* or application/octet-stream)
+# raises ValueError if the request carries no usable image
+def read_upload():
+    if 'file' in request.files:
+        file = request.files['file']
+        if file.filename == '':
+            raise ValueError('Empty file found in POST request...')
+        data = file.read()
+    elif request.is_json:
+        body = request.get_json(silent=True) or {}
+        try:
+            data = base64.b64decode(body.get('image', ''), validate=True)
+        except ValueError:
+            raise ValueError('Invalid base64 image in JSON body...')
+    elif request.mimetype.startswith('image/') or request.mimetype == 'application/octet-stream':
+        data = request.get_data()
+    else:
+        raise ValueError('No file found in POST request...')
+    if len(data) == 0:
+        raise ValueError('Empty file found in POST request...')
+    return data
+
+# raw bytes of every image in an /api/v1/upload_batch request, as (name, data) pairs:
+# repeated multipart 'file' fields, or a JSON body with a list of base64 'images'
+# raises ValueError if the request carries no usable images
+def read_uploads():
+    uploads = []
+    if 'file' in request.files:
+        for file in request.files.getlist('file'):
+            uploads.append((file.filename, file.read()))
+    elif request.is_json:
+        body = request.get_json(silent=True) or {}
+        images = body.get('images', [])
+        if not isinstance(images, list):
+            raise ValueError('images must be a list of base64-encoded images...')
+        for i, image in enumerate(images):
+            try:
+                uploads.append((str(i), base64.b64decode(image, validate=True)))
+            except ValueError:
+                raise ValueError('Invalid base64 image in JSON body (images[' + str(i) + '])...')
+    if len(uploads) == 0:
+        raise ValueError('No files found in POST request...')
+    return uploads
+
+# decode & preprocess an upload for submit_upload, unless the embedding cache already has it;
+# returns (inputs, seconds taken), both None for cached images
+def prepare_upload(data, key):
+    if chat.embeddings.contains(key):
+        return None, None
+    return chat.prepare_image(data)
+
+# queue an uploaded image for encoding into the session; images that aren't already in the
+# embedding cache are decoded & preprocessed by the preprocessing pool first, rather than on the
+# model worker (prepared is the result of prepare_upload if the caller already ran it)
+# the pool bounds how many images are decoded at once, however many requests arrive together
+# uploads waiting at the same time are encoded together (see MiniGPT4.upload_batch)
+def submit_upload(data, session, priority, prepared=None, wait=False):
+    key = EmbeddingCache.key(data)
+    if prepared is None:
+        prepared = preprocess_pool.submit(prepare_upload, data, key).result()
+    inputs, seconds = prepared
+    submit = submit_when_possible if wait else jobs.submit
+    return submit(session_id=session.id, priority=priority, kind='upload', payload=(session, key, data, inputs, seconds))
+
 # upload an image to MiniGPT-4
+# starts a new session, or replaces the image in an existing one if a session id is supplied
 @app.route('/api/v1/upload', methods=['POST'])
 def upload_file():
-    if 'file' not in request.files:
-        print('Error: upload attempt with no file found in POST request!')
-        return jsonify({ "success": False, "message": "No file found in POST request..." })
+    started = time.time()
+    try:
+        data = read_upload()
+    except ValueError as e:
+        print('Error: upload attempt failed: ' + str(e))
+        return jsonify({ "success": False, "message": str(e) })
+    session_id = request_session_id()
+    session = sessions.get(session_id) if session_id != '' else None
+    created = session is None
+    if created:
+        session = sessions.new()
+
+    try:
+        job = submit_upload(data, session, request_priority())
+    except QueueFull as e:
+        return queue_full_response(e)
+    except Exception as e:
+        return jsonify({ "success": False, "message": "Error decoding image: " + str(e) })
+    if created:
+        sessions.add(session)
+    try:
+        msg = job.wait()
+    except Exception as e:
+        if created:
+            sessions.remove(session.id)
+        return jsonify({ "success": False, "message": "Error encoding image: " + str(e) })
+    # embedding size is only known after encoding, so re-check the memory cap
+    with sessions.lock:
+        sessions.evict()
+    if 'received' in msg.lower():
+        r = { "success": True, "message": "Image received!", "session": session.id }
+        if request_flag('timing'):
+            r["timing"] = job_timing(job, session, started)
+        return jsonify(r)
     else:
-        file = request.files['file']
-        if file.filename == '':
-            print('Error: upload attempt with empty file found in POST request!')
-            return jsonify({ "success": False, "message": "Empty file found in POST request..." })
-        else:
+        if created:
+            sessions.remove(session.id)
+        return jsonify({ "success": False, "message": msg })
 
-            filename = secure_filename(os.path.basename(file.filename))
-            full_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            file.save(full_path)
-            msg = chat.upload_img(full_path)
-            if 'received' in msg.lower():
-                return jsonify({ "success": True, "message": "Image received!" })
-            else:
-                return jsonify({ "success": False, "message": msg })
+# upload many images in one request; each image gets its own new session
+# takes repeated multipart 'file' fields, or a JSON body with a list of base64 'images'
+# images are decoded & preprocessed by --preprocess-threads threads, then encoded together in
+# batches of up to --encode-batch-size; the response lists a session id per image, in request order
+@app.route('/api/v1/upload_batch', methods=['POST'])
+def upload_batch():
+    started = time.time()
+    try:
+        uploads = read_uploads()
+    except ValueError as e:
+        print('Error: batch upload attempt failed: ' + str(e))
+        return jsonify({ "success": False, "message": str(e) })
+    if len(uploads) > chat.args.max_upload_batch:
+        return jsonify({ "success": False, "message": "Too many images (limit is " + str(chat.args.max_upload_batch) + " per request)!" })
+    priority = request_priority()
+    timing = request_flag('timing')
+
+    futures = [preprocess_pool.submit(prepare_upload, data, EmbeddingCache.key(data)) for _, data in uploads]
+    results = [None] * len(uploads)
+    submitted = []
+    for i, ((name, data), future) in enumerate(zip(uploads, futures)):
+        try:
+            prepared = future.result()
+        except Exception as e:
+            results[i] = { "file": name, "success": False, "message": "Error decoding image: " + str(e) }
+            continue
+        session = sessions.new()
+        try:
+            # only the first image can be turned away by a full queue; the rest wait for room
+            job = submit_upload(data, session, priority, prepared, wait=len(submitted) > 0)
+        except QueueFull as e:
+            for f in futures:
+                f.cancel()
+            return queue_full_response(e)
+        sessions.add(session)
+        submitted.append((i, name, session, job))
+
+    for i, name, session, job in submitted:
+        try:
+            job.wait()
+        except Exception as e:
+            sessions.remove(session.id)
+            results[i] = { "file": name, "success": False, "message": "Error encoding image: " + str(e) }
+            continue
+        results[i] = { "file": name, "success": True, "session": session.id }
+        if timing:
+            results[i]["timing"] = job_timing(job, session, started)
+    # embedding sizes are only known after encoding, so re-check the memory cap
+    with sessions.lock:
+        sessions.evict()
+    received = sum(1 for r in results if r["success"])
+    return jsonify({ "success": received > 0, "message": "Received " + str(received) + " of " + str(len(uploads)) + " images!", "images": results })
+
+# upload an image and ask a list of questions about it in one request
+# takes the image the same ways as /api/v1/upload; prompts is a JSON list (form field, or
+# a key of the JSON body) of strings or {"prompt", "followups"} objects; a follow-up's
+# prompt is asked when its condition matches the latest answer ("missing"/"contains" a value,
+# "words_over"/"words_under" a count), replacing that answer
+# the session is closed afterwards unless keep=1 is passed
+@app.route('/api/v1/analyze', methods=['POST'])
+def analyze():
+    started = time.time()
+    try:
+        data = read_upload()
+    except ValueError as e:
+        return jsonify({ "success": False, "message": str(e) })
+    fields = request.get_json(silent=True) if request.is_json else request.values
+    fields = fields or {}
+    try:
+        prompts = parse_analyze_prompts(fields.get('prompts', ''))
+    except ValueError as e:
+        return jsonify({ "success": False, "message": "Invalid prompts: " + str(e) })
+    try:
+        params = request_generation_params()
+    except ValueError as e:
+        return jsonify({ "success": False, "message": "Invalid generation settings: " + str(e) })
+    priority = request_priority()
+    keep = str(fields.get('keep', '0')) in ('1', 'true', 'True')
+    timing = request_flag('timing')
+
+    session = sessions.new()
+    try:
+        try:
+            job = submit_upload(data, session, priority)
+        except QueueFull as e:
+            return queue_full_response(e)
+        except Exception as e:
+            return jsonify({ "success": False, "message": "Error decoding image: " + str(e) })
+        sessions.add(session)
+        try:
+            msg = job.wait()
+        except Exception as e:
+            return jsonify({ "success": False, "message": "Error encoding image: " + str(e) })
+        if 'received' not in msg.lower():
+            return jsonify({ "success": False, "message": msg })
+        upload_timing = job_timing(job, session, started) if timing else None
+
+        answers = []
+        for prompt, followups in prompts:
+            history = []
+            question = prompt
+            remaining = list(followups)
+            while question is not None:
+                job = submit_when_possible(session_id=session.id, priority=priority, kind='ask', payload=(session, question, None, params))
+                try:
+                    r = job.wait()
+                except Exception as e:
+                    return jsonify({ "success": False, "message": "Error generating response: " + str(e), "answers": answers })
+                history.append({ "prompt": question, "response": r })
+                history[-1]["prompt_tokens"] = session.prompt_tokens
+                if timing:
+                    history[-1]["timing"] = job_timing(job, session, job.submitted)
+                question = None
+                while len(remaining) > 0:
+                    rule = remaining.pop(0)
+                    if followup_matches(rule, r):
+                        question = rule['prompt']
+                        break
+            answers.append({ "prompt": prompt, "response": history[-1]["response"], "history": history })
+        r = { "success": True, "message": "Image analyzed!", "session": session.id if keep else '', "answers": answers }
+        if timing:
+            r["timing"] = { "upload": upload_timing, "total_seconds": round(time.time() - started, 4) }
+        return jsonify(r)
+    finally:
+        if not keep:
+            sessions.remove(session.id)
 
 # ask MiniGPT-4 about the current image
+# requests wait in the job queue until the model worker is free
+# with stream=1 the answer is sent as JSON lines while it is generated: {"token": "..."} pieces,
+# then a final line with the full response, time to first token and tokens/sec
 @app.route('/api/v1/ask', methods=['POST'])
 def ask():
-    if not chat.busy:
-        msg = request.form['message']
-        if msg != None and msg != '':
-            chat.busy = True
-            chat.ask(msg)
-            r = chat.answer()
-            chat.busy = False
-            return jsonify({ "success": True, "message": msg, "response": r })
-        else:
-            return jsonify({ "success": False, "message": "No message in POST request!" })
+    started = time.time()
+    msg = str(request_value('message'))
+    if chat.args.max_message_chars > 0 and len(msg) > chat.args.max_message_chars:
+        return jsonify({ "success": False, "message": "Message is too long (limit is " + str(chat.args.max_message_chars) + " characters)!" })
+    if msg != None and msg != '':
+        session = sessions.get(request_session_id())
+        if session is None:
+            return jsonify({ "success": False, "message": "Unknown or expired session; upload an image first!" })
+        try:
+            params = request_generation_params()
+        except ValueError as e:
+            return jsonify({ "success": False, "message": "Invalid generation settings: " + str(e) })
+        stream = TokenStream() if request_flag('stream') else None
+        try:
+            job = jobs.submit(session_id=session.id, priority=request_priority(), kind='ask', payload=(session, msg, stream, params))
+        except QueueFull as e:
+            return queue_full_response(e)
+        if stream is not None:
+            return Response(stream_answer(job, stream, session, msg, started if request_flag('timing') else None), mimetype='application/x-ndjson')
+        try:
+            r = job.wait()
+        except Exception as e:
+            return jsonify({ "success": False, "message": "Error generating response: " + str(e) })
+        r = { "success": True, "message": msg, "response": r, "session": session.id, "queue_seconds": round(job.started - job.submitted, 3), "batch_size": job.batch_size,
+              "prompt_tokens": session.prompt_tokens, "cached_tokens": session.cached_tokens }
+        if request_flag('timing'):
+            r["timing"] = job_timing(job, session, started)
+        return jsonify(r)
     else:
-        return jsonify({ "success": False, "message": "MiniGPT-4 is currently working on another request!" })
+        return jsonify({ "success": False, "message": "No message in POST request!" })
+
+# body of a streaming /api/v1/ask response; started is set when a timing breakdown was requested
+def stream_answer(job, stream, session, msg, started=None):
+    for piece in stream:
+        yield json.dumps({ "token": piece }) + '\n'
+    try:
+        r = job.wait()
+    except Exception as e:
+        yield json.dumps({ "done": True, "success": False, "message": "Error generating response: " + str(e) }) + '\n'
+        return
+    final = { "done": True, "success": True, "message": msg, "response": r, "session": session.id, "queue_seconds": round(job.started - job.submitted, 3),
+              "batch_size": job.batch_size, "prompt_tokens": session.prompt_tokens, "cached_tokens": session.cached_tokens, "tokens": stream.tokens }
+    if stream.first_token is not None:
+        final["ttft_seconds"] = round(stream.first_token - job.submitted, 3)
+        generating = job.finished - stream.first_token
+        final["tokens_per_sec"] = round((stream.tokens - 1) / generating, 2) if generating > 0 else 0.0
+    if started is not None:
+        final["timing"] = job_timing(job, session, started)
+    yield json.dumps(final) + '\n'
 
 
 # entry point
 if __name__ == '__main__':
-    chat = MiniGPT4()
-    app.run()
+    create_app()
+    serve()
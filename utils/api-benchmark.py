@@ -0,0 +1,317 @@
+# Copyright 2021 - 2023, Bill Kennedy (https://github.com/rbbrdckybk/MiniGPT-4)
+# SPDX-License-Identifier: MIT
+
+# API Server Benchmark
+# Replays a workload of image + question sets against a running MiniGPT-4 server (or router)
+# and reports requests/sec, latency percentiles & histograms, time to first token and error
+# rates for /api/v1/upload and /api/v1/ask, plus a JSON report for comparing server versions.
+# Start the server with --backend fake to benchmark the serving layers without a GPU.
+
+# the workload is a JSONL file with one image per line (paths are relative to the file):
+# {"image": "img/simpsons.jpg", "prompts": ["Generate a short title for this image.", "..."]}
+# without --workload, every .jpg in --imgdir is asked the metadata tagger's three questions
+
+# usage:
+# python api-benchmark.py --concurrency 8 --sessions 200 --report before.json
+# python api-benchmark.py --rate 2 --duration 60 --stream --report after.json --compare before.json
+
+import argparse
+import json
+import math
+import os
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from minigpt4_client import shared_http_session, read_image
+
+# the metadata tagger's questions (see metadata-tagger.py)
+INITIAL_DIRECTION = 'You are a metadata generation machine designed to help describe images. Your responses will be used verbatim in image metadata and should not be conversational. Respond with only the answer and no context around why the answer is appropriate. '
+TAGGER_PROMPTS = [
+    INITIAL_DIRECTION + 'Generate an appropriate short title (just a few words) for this image. The title should accurately describe the most obvious visual elements of the image in as few words as possible. Avoid esoteric or abstract language.',
+    INITIAL_DIRECTION + 'Write a short description (1-2 sentences) for this image. Stick to describing visual elements of the image without making comments about its origin or purpose.',
+    INITIAL_DIRECTION + 'List at least 10 appropriate keywords for this image, separated by commas.',
+]
+
+# upper bounds (seconds) of the latency histogram buckets: 1ms to ~17min, 4 per doubling
+BUCKETS = [0.001 * 2 ** (i / 4) for i in range(81)]
+
+# latency samples and outcomes for one kind of operation
+class Stat:
+    def __init__(self):
+        self.samples = []
+        self.errors = 0
+        self.status_codes = {}
+
+    def percentile(self, p):
+        if len(self.samples) == 0:
+            return 0.0
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(math.ceil(p / 100 * len(ordered))) - 1)]
+
+    def histogram(self):
+        counts = [0] * len(BUCKETS)
+        for s in self.samples:
+            i = 0
+            while i < len(BUCKETS) - 1 and s > BUCKETS[i]:
+                i += 1
+            counts[i] += 1
+        return [[round(BUCKETS[i], 4), c] for i, c in enumerate(counts) if c > 0]
+
+    def summary(self):
+        count = len(self.samples) + self.errors
+        return {
+            "count": count,
+            "errors": self.errors,
+            "error_rate": round(self.errors / count, 4) if count > 0 else 0.0,
+            "status_codes": self.status_codes,
+            "mean": round(sum(self.samples) / len(self.samples), 4) if len(self.samples) > 0 else 0.0,
+            "p50": round(self.percentile(50), 4),
+            "p90": round(self.percentile(90), 4),
+            "p95": round(self.percentile(95), 4),
+            "p99": round(self.percentile(99), 4),
+            "max": round(max(self.samples), 4) if len(self.samples) > 0 else 0.0,
+            "histogram": self.histogram()
+        }
+
+# thread-safe collection of Stats by operation name
+class Recorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stats = {}
+        self.tokens = 0
+        self.enabled = True
+
+    def record(self, op, seconds, ok=True, status=None):
+        if not self.enabled:
+            return
+        with self.lock:
+            stat = self.stats.setdefault(op, Stat())
+            if ok:
+                stat.samples.append(seconds)
+            else:
+                stat.errors += 1
+            if status is not None:
+                stat.status_codes[str(status)] = stat.status_codes.get(str(status), 0) + 1
+
+    def add_tokens(self, n):
+        if self.enabled:
+            with self.lock:
+                self.tokens += n
+
+
+# list of (name, image bytes, mime type, prompts)
+def load_workload(opt):
+    items = []
+    if opt.workload != '':
+        base = os.path.dirname(os.path.abspath(opt.workload))
+        with open(opt.workload, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if line == '' or line.startswith('#'):
+                    continue
+                entry = json.loads(line)
+                img = os.path.join(base, entry['image'])
+                data, mime = read_image(img)
+                items.append((entry['image'], data, mime, entry.get('prompts', TAGGER_PROMPTS)))
+    else:
+        for f in sorted(os.listdir(opt.imgdir)):
+            if f.lower().endswith('.jpg'):
+                data, mime = read_image(os.path.join(opt.imgdir, f))
+                items.append((f, data, mime, TAGGER_PROMPTS))
+    return items
+
+# JSON body of a response, or {} if it isn't JSON
+def parse(r):
+    try:
+        return r.json()
+    except ValueError:
+        return {}
+
+# one streamed /api/v1/ask; returns (ok, status)
+def ask_stream(opt, http, recorder, session_id, prompt):
+    start = time.time()
+    r = http.post(opt.url + '/api/v1/ask', data={"message": prompt, "session": session_id, "stream": 1}, stream=True, timeout=(5, opt.timeout))
+    if r.status_code != 200 or not r.headers.get('Content-Type', '').startswith('application/x-ndjson'):
+        r.close()
+        return False, r.status_code
+    final = {}
+    first = None
+    with r:
+        for line in r.iter_lines():
+            if not line:
+                continue
+            parsed = json.loads(line)
+            if 'token' in parsed and first is None:
+                first = time.time()
+                recorder.record('ask_ttft', first - start)
+            if parsed.get('done'):
+                final = parsed
+    recorder.add_tokens(final.get('tokens', 0))
+    return final.get('success', False), r.status_code
+
+# upload one image and ask its questions; session latency is measured from the arrival time
+def run_session(opt, http, recorder, item, arrival):
+    name, data, mime, prompts = item
+    try:
+        start = time.time()
+        r = http.post(opt.url + '/api/v1/upload', files=[('file', (name, data, mime))], timeout=(5, opt.timeout))
+        parsed = parse(r)
+        ok = r.status_code == 200 and parsed.get('success', False)
+        recorder.record('upload', time.time() - start, ok, r.status_code)
+        if not ok:
+            recorder.record('session', 0, False)
+            return
+        session_id = parsed['session']
+        for prompt in prompts:
+            start = time.time()
+            if opt.stream:
+                ok, status = ask_stream(opt, http, recorder, session_id, prompt)
+            else:
+                r = http.post(opt.url + '/api/v1/ask', data={"message": prompt, "session": session_id}, timeout=(5, opt.timeout))
+                parsed = parse(r)
+                ok, status = r.status_code == 200 and parsed.get('success', False), r.status_code
+            recorder.record('ask', time.time() - start, ok, status)
+            if not ok:
+                break
+        http.get(opt.url + '/api/v1/close', params={"session": session_id}, timeout=(5, opt.timeout))
+        recorder.record('session', time.time() - arrival, ok)
+    except requests.exceptions.RequestException as e:
+        recorder.record('session', 0, False, type(e).__name__)
+
+# fixed number of clients, each starting its next session as soon as the last one finishes
+def run_closed(opt, http, recorder, items, deadline):
+    counter = iter(range(sys.maxsize))
+    lock = threading.Lock()
+    def client():
+        while time.time() < deadline:
+            with lock:
+                n = next(counter)
+            if opt.sessions > 0 and n >= opt.sessions:
+                return
+            run_session(opt, http, recorder, items[n % len(items)], time.time())
+    threads = [threading.Thread(target=client) for _ in range(opt.concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+# sessions arrive at random (Poisson) times at --rate per second, at most --concurrency at once;
+# latency counts from the scheduled arrival, so time spent waiting for a free client is included
+def run_open(opt, http, recorder, items, deadline):
+    rng = random.Random(opt.seed)
+    with ThreadPoolExecutor(max_workers=opt.concurrency) as pool:
+        n = 0
+        arrival = time.time()
+        while arrival < deadline and (opt.sessions <= 0 or n < opt.sessions):
+            time.sleep(max(0, arrival - time.time()))
+            pool.submit(run_session, opt, http, recorder, items[n % len(items)], arrival)
+            n += 1
+            arrival += rng.expovariate(opt.rate)
+
+def print_summary(report):
+    print('\n' + str(report['sessions']['completed']) + ' sessions in ' + str(report['duration_seconds']) + 's: '
+          + str(report['throughput']['sessions_per_sec']) + ' sessions/s, ' + str(report['throughput']['requests_per_sec']) + ' requests/s'
+          + (', ' + str(report['throughput']['tokens_per_sec']) + ' tokens/s' if report['throughput']['tokens_per_sec'] > 0 else ''))
+    print('{:<10} {:>7} {:>8} {:>8} {:>8} {:>8} {:>8} {:>8}'.format('operation', 'count', 'errors', 'mean', 'p50', 'p95', 'p99', 'max'))
+    for op, s in report['operations'].items():
+        print('{:<10} {:>7} {:>8} {:>8.3f} {:>8.3f} {:>8.3f} {:>8.3f} {:>8.3f}'.format(op, s['count'], s['errors'], s['mean'], s['p50'], s['p95'], s['p99'], s['max']))
+
+# percentage change of the headline numbers against an earlier report
+def print_comparison(report, baseline):
+    print('\nCompared to ' + (baseline.get('label') or 'baseline') + ' (' + baseline.get('started', '') + '):')
+    def change(new, old):
+        return '{:+.1f}%'.format(100 * (new - old) / old) if old else 'n/a'
+    for key in ('sessions_per_sec', 'requests_per_sec', 'tokens_per_sec'):
+        print('  {:<18} {:>10} -> {:<10} {}'.format(key, baseline['throughput'].get(key, 0), report['throughput'][key], change(report['throughput'][key], baseline['throughput'].get(key, 0))))
+    for op, s in report['operations'].items():
+        old = baseline['operations'].get(op)
+        if old is None:
+            continue
+        for key in ('p50', 'p95', 'p99', 'error_rate'):
+            print('  {:<18} {:>10} -> {:<10} {}'.format(op + ' ' + key, old[key], s[key], change(s[key], old[key])))
+
+
+# entry point
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", type=str, default='http://localhost:5000', help="MiniGPT-4 server (or router) to benchmark")
+    parser.add_argument("--workload", type=str, default='', help="JSONL file of {\"image\": ..., \"prompts\": [...]} lines")
+    parser.add_argument("--imgdir", type=str, default='img', help="images to use with the tagger's questions when no --workload is given")
+    parser.add_argument("--concurrency", type=int, default=4, help="number of sessions in flight at once")
+    parser.add_argument("--rate", type=float, default=0, help="session arrivals per second (0 = closed loop: start a new session whenever one finishes)")
+    parser.add_argument("--sessions", type=int, default=100, help="number of sessions to run (0 = until --duration)")
+    parser.add_argument("--duration", type=float, default=0, help="stop starting new sessions after this many seconds (0 = no limit)")
+    parser.add_argument("--warmup", type=int, default=2, help="sessions to run one at a time before measuring")
+    parser.add_argument("--stream", action='store_true', help="ask with stream=1 to measure time to first token and tokens/sec")
+    parser.add_argument("--timeout", type=float, default=600, help="read timeout per request, in seconds")
+    parser.add_argument("--label", type=str, default='', help="name for this run in the report (e.g. the server version)")
+    parser.add_argument("--report", type=str, default='', help="write the JSON report to this file")
+    parser.add_argument("--compare", type=str, default='', help="earlier JSON report to compare against")
+    parser.add_argument("--seed", type=int, default=0)
+    opt = parser.parse_args()
+
+    if opt.sessions <= 0 and opt.duration <= 0:
+        print('Error: specify --sessions and/or --duration!')
+        sys.exit(1)
+    items = load_workload(opt)
+    if len(items) == 0:
+        print('Error: the workload is empty!')
+        sys.exit(1)
+    http = shared_http_session(max(32, opt.concurrency))
+    recorder = Recorder()
+
+    try:
+        server = http.get(opt.url + '/api/v1/status', timeout=(5, 30)).json()
+    except Exception as e:
+        print('Error: unable to reach MiniGPT-4 server at ' + opt.url + ': ' + str(e))
+        sys.exit(1)
+    print('Benchmarking ' + opt.url + ' with ' + str(len(items)) + ' workload images, concurrency ' + str(opt.concurrency)
+          + (', ' + str(opt.rate) + ' sessions/s' if opt.rate > 0 else ', closed loop') + '...')
+
+    recorder.enabled = False
+    for n in range(opt.warmup):
+        run_session(opt, http, recorder, items[n % len(items)], time.time())
+    recorder.enabled = True
+
+    started = time.time()
+    deadline = started + opt.duration if opt.duration > 0 else float('inf')
+    if opt.rate > 0:
+        run_open(opt, http, recorder, items, deadline)
+    else:
+        run_closed(opt, http, recorder, items, deadline)
+    elapsed = time.time() - started
+
+    try:
+        server = http.get(opt.url + '/api/v1/status', timeout=(5, 30)).json()
+    except Exception:
+        pass
+    operations = dict((op, s.summary()) for op, s in sorted(recorder.stats.items()))
+    sessions = operations.get('session', {"count": 0, "errors": 0})
+    requests_done = sum(operations[op]['count'] - operations[op]['errors'] for op in ('upload', 'ask') if op in operations)
+    report = {
+        "label": opt.label,
+        "url": opt.url,
+        "started": time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(started)),
+        "duration_seconds": round(elapsed, 2),
+        "config": vars(opt),
+        "server": dict((k, server[k]) for k in ('backend', 'queue', 'embedding_cache', 'kv_cache') if k in server),
+        "sessions": { "completed": sessions['count'] - sessions['errors'], "failed": sessions['errors'] },
+        "throughput": {
+            "sessions_per_sec": round((sessions['count'] - sessions['errors']) / elapsed, 3),
+            "requests_per_sec": round(requests_done / elapsed, 3),
+            "tokens_per_sec": round(recorder.tokens / elapsed, 2)
+        },
+        "operations": operations
+    }
+    print_summary(report)
+    if opt.report != '':
+        with open(opt.report, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        print('\nReport written to ' + opt.report)
+    if opt.compare != '':
+        with open(opt.compare, 'r', encoding='utf-8') as f:
+            print_comparison(report, json.load(f))
@@ -0,0 +1,140 @@
+# Copyright 2021 - 2023, Bill Kennedy (https://github.com/rbbrdckybk/MiniGPT-4)
+# SPDX-License-Identifier: MIT
+
+# Decode Benchmark
+# Times the server's image decoding (decode_image_data in api-server.py) on large JPEGs with a
+# full decode and with draft (reduced-scale) decodes, each followed by the resize to the vision
+# encoder's 224x224 input that the MiniGPT-4 vis processor does. Reports time per image, the size
+# the decoder actually produced, how close the final 224x224 image is to the full decode's (PSNR),
+# and throughput when decoding with a pool of threads or processes.
+# The images come from --imgdir or are generated (smooth shapes plus grain, like a photo).
+# Runs on CPU; no model or GPU required (the server's Python packages must be installed).
+
+# usage:
+# python decode-benchmark.py --images 8 --width 8000 --height 6000
+# python decode-benchmark.py --imgdir <path containing images> --workers 8 --processes
+
+import argparse
+import importlib
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from PIL import Image, ImageChops, ImageDraw, ImageFilter, ImageStat
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+server = importlib.import_module('api-server')
+
+# the vision encoder's input size (MiniGPT-4's blip2_image_eval processor)
+INPUT_SIZE = 224
+
+
+def generate_images(dir, n, width, height, seed):
+    rng = random.Random(seed)
+    paths = []
+    for i in range(n):
+        # draw at 1/4 scale and upscale, so the shapes have soft photo-like edges
+        image = Image.new('RGB', (width // 4, height // 4), tuple(rng.randrange(256) for _ in range(3)))
+        draw = ImageDraw.Draw(image)
+        for _ in range(60):
+            x, y = rng.randrange(width // 4), rng.randrange(height // 4)
+            r = rng.randrange(10, max(11, width // 16))
+            draw.ellipse((x - r, y - r, x + r, y + r), fill=tuple(rng.randrange(256) for _ in range(3)))
+        image = image.filter(ImageFilter.GaussianBlur(3)).resize((width, height), Image.BICUBIC)
+        grain = Image.effect_noise((width, height), 12).convert('RGB')
+        image = Image.blend(image, grain, 0.15)
+        path = os.path.join(dir, 'image-' + str(i) + '.jpg')
+        image.save(path, quality=92)
+        paths.append(path)
+    return paths
+
+# what the server does with an upload before preprocessing, then the processor's resize
+def decode_and_resize(data, draft_size):
+    image = server.decode_image_data(data, draft_size=draft_size)
+    decoded = image.size
+    return image.resize((INPUT_SIZE, INPUT_SIZE), Image.BICUBIC), decoded
+
+def psnr(a, b):
+    mse = sum(ImageStat.Stat(ImageChops.difference(a, b)).sum2) / (3 * INPUT_SIZE * INPUT_SIZE)
+    return float('inf') if mse == 0 else 10 * math.log10(255 * 255 / mse)
+
+# best time per image over repeat passes, the decoded sizes and the final images
+def time_decode(datas, draft_size, repeat):
+    best = None
+    for _ in range(repeat):
+        results = []
+        start = time.perf_counter()
+        for data in datas:
+            results.append(decode_and_resize(data, draft_size))
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best / len(datas), results
+
+def throughput(datas, draft_size, workers, processes):
+    if processes:
+        pool = ProcessPoolExecutor(max_workers=workers, initializer=server.disable_pil_pixel_limit)
+    else:
+        pool = ThreadPoolExecutor(max_workers=workers)
+    with pool:
+        # warm the pool up (processes need to start)
+        list(pool.map(decode_and_resize, datas[:workers], [draft_size] * min(workers, len(datas))))
+        start = time.perf_counter()
+        list(pool.map(decode_and_resize, datas, [draft_size] * len(datas)))
+        return len(datas) / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--imgdir", type=str, default='', help="directory of JPEGs to use instead of generated images")
+    parser.add_argument("--images", type=int, default=6, help="number of generated images")
+    parser.add_argument("--width", type=int, default=6000, help="width of generated images")
+    parser.add_argument("--height", type=int, default=4000, help="height of generated images")
+    parser.add_argument("--repeat", type=int, default=3, help="timed passes per decode mode (best is reported)")
+    parser.add_argument("--workers", type=int, default=4, help="pool size for the throughput test (0 = skip it)")
+    parser.add_argument("--processes", action='store_true', help="use a process pool for the throughput test instead of threads")
+    parser.add_argument("--seed", type=int, default=0)
+    opt = parser.parse_args()
+    # as the server does at startup
+    server.disable_pil_pixel_limit()
+
+    with tempfile.TemporaryDirectory(prefix='decode-benchmark-') as temp_dir:
+        if opt.imgdir != '':
+            paths = sorted(os.path.join(opt.imgdir, f) for f in os.listdir(opt.imgdir) if f.lower().endswith(('.jpg', '.jpeg')))
+        else:
+            print('Generating ' + str(opt.images) + ' ' + str(opt.width) + 'x' + str(opt.height) + ' JPEGs...')
+            paths = generate_images(temp_dir, opt.images, opt.width, opt.height, opt.seed)
+        if len(paths) == 0:
+            print('Error: no JPEG images to decode!')
+            sys.exit(1)
+        datas = []
+        for path in paths:
+            with open(path, 'rb') as f:
+                datas.append(f.read())
+        megapixels = sum(Image.open(path).size[0] * Image.open(path).size[1] for path in paths) / len(paths) / 1e6
+
+        modes = [
+            ('full decode', 0),
+            ('draft >= ' + str(INPUT_SIZE * 2) + ' (default)', INPUT_SIZE * 2),
+            ('draft >= ' + str(INPUT_SIZE), INPUT_SIZE),
+        ]
+        print('Decoding ' + str(len(datas)) + ' images (' + str(round(megapixels, 1)) + ' MP average) to ' + str(INPUT_SIZE) + 'x' + str(INPUT_SIZE) + ', best of ' + str(opt.repeat) + ' passes')
+        baseline = None
+        reference = None
+        for name, draft_size in modes:
+            seconds, results = time_decode(datas, draft_size, opt.repeat)
+            line = name.ljust(22) + str(round(seconds * 1000, 1)).rjust(8) + ' ms per image'
+            if baseline is None:
+                baseline = seconds
+                reference = [image for image, _ in results]
+            else:
+                line += ' (' + str(round(baseline / seconds, 1)) + 'x)'
+                line += ', PSNR vs full ' + str(round(min(psnr(a, b) for a, (b, _) in zip(reference, results)), 1)) + ' dB (worst)'
+            w, h = results[0][1]
+            line += ', decoded at ' + str(w) + 'x' + str(h)
+            if opt.workers > 0:
+                line += ', ' + str(round(throughput(datas, draft_size, opt.workers, opt.processes), 1)) + ' images/s with ' + str(opt.workers) + (' processes' if opt.processes else ' threads')
+            print(line)
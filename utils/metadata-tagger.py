@@ -3,9 +3,10 @@
 
 # Image Metadata Tagger
 # Point this utility at a directory of .jpg images to have MiniGPT-4 write the IPTC metadata for each image!
-# Tagged images will be written to a "tagged" sub-folder off of the image directory.
+# Tagged images will be written to a "tagged" sub-folder off of the image directory (or, with
+# --in-place, back into the originals).
 
-# requires iptcinfo3:
+# the original iptcinfo3 writer (--writer iptcinfo3) requires iptcinfo3:
 # pip install iptcinfo3
 
 # usage:
@@ -14,13 +15,20 @@
 import argparse
 import json
 import logging
+import metadata_export
+import metadata_sanitizer
+import metadata_writer
 import minigpt4_client as minigpt4
+import tagger_discovery
+import tagger_manifest
+import queue
+import random
 import shutil
+import threading
 import time
 import os
 from os.path import exists
 from pathlib import Path
-from iptcinfo3 import IPTCInfo
 
 logging.getLogger('iptcinfo').setLevel(logging.ERROR)
 
@@ -29,6 +37,7 @@ logging.getLogger('iptcinfo').setLevel(logging.ERROR)
 # pre-existing metadata will be overwritten!
 # files will be written to a 'tagged' subdir
 def write_iptc_info(filename, title, description, keywords, copyright):
+    from iptcinfo3 import IPTCInfo
     info = None
     try:
         info = IPTCInfo(filename)
@@ -54,14 +63,59 @@ def write_iptc_info(filename, title, description, keywords, copyright):
                 pass
         print('\nWrote metadata to output image (' + output_file + ')...')
 
-# gets .jpg images found within specified dir, ignores subdirs
-def get_images_from_dir(dir):
-    images = []
-    for f in os.scandir(dir):
-        if f.path.lower().endswith(".jpg"):
-            images.append(f.path)
-    images.sort()
-    return images
+# write the supplied metadata with the configured writer (see --writer, --in-place & --xmp)
+# metadata all str except keywords which is []
+def write_metadata(filename, title, description, keywords, copyright=''):
+    if not write_images:
+        return False
+    if not is_jpeg(filename):
+        print('\nNote: IPTC metadata can only be written to JPEG files; skipping ' + filename + '...')
+        return False
+    if writer is None:
+        write_iptc_info(filename, title, description, keywords, copyright)
+    else:
+        output_file = writer.write(filename, title, description, keywords, copyright)
+        print('\nWrote metadata to output image (' + output_file + ')...')
+    return True
+
+# hands an image's final metadata to the --export files & --sidecars writer
+def export_metadata(filename, title, description, keywords):
+    for export in exports:
+        export.add(filename, title, description, keywords)
+    if sidecars is not None:
+        try:
+            output_file = sidecars.write(filename, title, description, keywords)
+            print('\nWrote XMP sidecar (' + output_file + ')...')
+        except (OSError, ValueError) as e:
+            print('\nError writing XMP sidecar for ' + filename + ': ' + str(e))
+
+# writes out whatever the --export files still have buffered
+def close_exports():
+    for export in exports:
+        try:
+            export.close()
+        except Exception as e:
+            print('Error: unable to finish export ' + export.path + ': ' + str(e))
+            continue
+        print('Exported ' + str(export.count) + ' images to ' + export.path + '.')
+
+# reports a write finished by the background writer (called on its thread)
+def written_in_background(manifest, filename, output_file, error, title, description, keywords):
+    if error is not None:
+        print('\nError writing metadata to ' + filename + ': ' + str(error))
+        if manifest is not None:
+            manifest.record_error(filename, 'Error writing metadata: ' + str(error))
+        return
+    print('\nWrote metadata to output image (' + output_file + ')...')
+    if manifest is not None:
+        manifest.record_done(filename, title, description, keywords, refresh=in_place())
+
+def is_jpeg(filename):
+    return filename.lower().endswith(('.jpg', '.jpeg'))
+
+# whether metadata is written back into the original images
+def in_place():
+    return writer is not None and writer.in_place
 
 # checks a server response for the success/failure
 def response_success(r):
@@ -88,201 +142,448 @@ def answer_extract(r):
         resp = response['response']
     return resp
 
+# the start of a server's answer to a request naming a session it no longer has (expired, or
+# evicted once more than its --max-sessions were open)
+SESSION_EXPIRED = 'Unknown or expired session'
+# times an image is uploaded again when its session disappears part-way through its questions,
+# after a random pause of up to this many seconds (doubling each time) so that images whose
+# sessions were evicted together don't evict each other again
+SESSION_RETRIES = 3
+SESSION_RETRY_PAUSE = 2.0
+
+class SessionExpired(Exception):
+    pass
+
+# raises SessionExpired if a server response says the session is gone
+def check_session(r):
+    if not response_success(r) and question_extract(r).startswith(SESSION_EXPIRED):
+        raise SessionExpired()
+
 # for logging to console & file
+log_lock = threading.Lock()
 def log(msg):
-    print(msg)
-    with open('metadata-tagger-log.txt', 'a', encoding = 'utf-8') as f:
-        f.write(msg + '\n')
-
-# common replacements to both title/description
-def sanitize_common(str):
-    # common things to remove at the start of text responses
-    if str.startswith('The image is of '):
-        str = str.replace('The image is of ', '')
-    if str.startswith('The image shows '):
-        str = str.replace('The image shows ', '')
-    if str.startswith('The image depicts '):
-        str = str.replace('The image depicts ', '')
-    if str.startswith('This image shows '):
-        str = str.replace('This image shows ', '')
-    if str.startswith('This image depicts '):
-        str = str.replace('This image depicts ', '')
-    if str.startswith('The painting is of '):
-        str = str.replace('The painting is of ', '')
-    if str.startswith('The painting shows '):
-        str = str.replace('The painting shows ', '')
-    if str.startswith('The painting depicts '):
-        str = str.replace('The painting depicts ', '')
-    if str.startswith('This painting shows '):
-        str = str.replace('This painting shows ', '')
-    if str.startswith('This painting depicts '):
-        str = str.replace('This painting depicts ', '')
-    if str.startswith('This is an image of '):
-        str = str.replace('This is an image of ', '')
-    if str.startswith('This is a painting of '):
-        str = str.replace('This is a painting of ', '')
-    if str.startswith('This image features '):
-        str = str.replace('This image features ', '')
-    if str.startswith('The image is '):
-        str = str.replace('The image is ', '')
-    if str.startswith('This image is '):
-        str = str.replace('This image is ', '')
-    if str.startswith('The painting is '):
-        str = str.replace('The painting is ', '')
-    if str.startswith('This painting is '):
-        str = str.replace('This painting is ', '')
-    if str.startswith('Image of a '):
-        str = str.replace('Image of a ', '')
-    if str.startswith('Image content: '):
-        str = str.replace('Image content: ', '')
-    if str.startswith('Image: '):
-        str = str.replace('Image: ', '')
-
-    # common things to replace/remove
-    str = str.replace('<Img>', '')
-    str = str.replace('</Img>', '')
-    str = str.replace('<img>', '')
-    str = str.replace('</img>', '')
-
-    return str
-
-# for sanitizing MiniGPT-4 output
-def sanitize_title(title):
-    if '"' in title:
-        temp = title.split('"', 1)[1]
-        if '"' in temp:
-            title = temp.split('"', 1)[0]
-    if '>' in title:
-        temp = title.split('>', 1)[1]
-        if '<' in temp:
-            title = temp.split('<', 1)[0]
-
-    title = sanitize_common(title)
-    if title.startswith('Image Title: '):
-        title = title.replace('Image Title: ', '')
-    if title.startswith('Title: '):
-        title = title.replace('Title: ', '')
-
-    title = title.strip()
-    if title.endswith('.'):
-        title = title[:-1]
-
-    # capitalize just the first letter; leave rest of title intact
-    if ' ' in title:
-        temp = title.split(' ', 1)
-        title = temp[0].capitalize() + ' ' + temp[1]
-
-    return title
-
-def sanitize_description(description):
-    description = description.strip()
-    if description.startswith('"') and description.endswith('"'):
-        description = description.replace('"', '')
-    description = description.capitalize()
-
-    # remove some common MiniGPT-4 extra wordiness
-    description = sanitize_common(description)
-    if description.startswith('Image Description: '):
-        description = description.replace('Image Description: ', '')
-    if description.startswith('Description: '):
-        description = description.replace('Description: ', '')
-
-    # capitalize every sentence
-    sentences = description.split('. ')
-    final = ''
-    for sentence in sentences:
-        final += sentence.capitalize()
-        final += '. '
-    final = final.strip()
-    description = final
-
+    with log_lock:
+        print(msg)
+        with open('metadata-tagger-log.txt', 'a', encoding = 'utf-8') as f:
+            f.write(msg + '\n')
+
+# prepended to all server requests to help guide output
+initial_direction = 'You are a metadata generation machine designed to help describe images. Your responses will be used verbatim in image metadata and should not be conversational. Respond with only the answer and no context around why the answer is appropriate. '
+title_request = initial_direction + 'Generate an appropriate short title (just a few words) for this image. The title should accurately describe the most obvious visual elements of the image in as few words as possible. Avoid esoteric or abstract language.'
+title_shorten_request = 'Shorten the title so that it is less than 10 words. Use plain descriptive language.'
+description_request = initial_direction + 'Write a short description (1-2 sentences) for this image. Stick to describing visual elements of the image without making comments about its origin or purpose.'
+keyword_request = initial_direction + 'List at least 10 appropriate keywords for this image, separated by commas.'
+keyword_commas_request = 'List the keywords on a single line, separated by commas.'
+
+# the same questions & retries as a single /api/v1/analyze request
+analyze_prompts = [
+    { "prompt": title_request, "followups": [ { "if": "words_over", "value": 12, "prompt": title_shorten_request } ] },
+    { "prompt": description_request },
+    { "prompt": keyword_request, "followups": [ { "if": "missing", "value": ",", "prompt": keyword_commas_request } ] }
+]
+
+# cleans up MiniGPT-4 answers; replaced by --sanitizer-config
+sanitizer = metadata_sanitizer.Sanitizer.load()
+# writes metadata into images (None = the original iptcinfo3 writer); replaced by --in-place,
+# --xmp & --writer
+writer = metadata_writer.MetadataWriter()
+# False with --export-only: metadata goes to exports & sidecars, images are left alone
+write_images = True
+# --export files and the --sidecars writer
+exports = []
+sidecars = None
+
+# turns raw MiniGPT-4 answers into final metadata; returns (title, description, keywords)
+def finalize_metadata(title, description, keywords, log=log):
+    title = sanitizer.title(title)
+    log('Sanitized Title >>> ' + title)
+
+    description = sanitizer.description(description)
+    log('Sanitized Description >>> ' + description)
+    description = description.split('. ',)[0]
     if not description.endswith('.'):
         description += '.'
-    else:
-        while description.endswith('..'):
-            description = description[:-1]
-
-    description = description.capitalize()
-    return description
+    log('Sanitized Description (1st sentence) >>> ' + description)
 
-def sanitize_keywords(keywords):
-    keywords = answer.split(',')
     final_keywords = []
-
-    # remove/sanitize unwanted keywords
-    for kw in keywords:
-        if kw.endswith('.'):
-            kw = kw[:-1]
-
-        kw = kw.lower()
-        if kw.endswith('.'):
-            kw = kw[:-1]
-        if kw.endswith("'s"):
-            kw = kw[:-2]
-        kw = kw.replace('keywords: ', '')
-        kw = kw.replace('keyword: ', '')
-        kw = kw.replace('keywords', '')
-        kw = kw.replace('keyword', '')
-        kw = kw.replace('image metadata', '')
-        kw = kw.replace('visual elements', '')
-        kw = kw.replace('visual pattern', '')
-        kw = kw.replace('intricate designs', '')
-        kw = kw.replace('no other elements visible', '')
-        kw = kw.replace('description', '')
-        kw = kw.replace('descriptive words', '')
-        kw = kw.replace('descriptive language', '')
-        kw = kw.replace('visual interest', '')
-        kw = kw.replace('additional information', '')
-        kw = kw.replace('visually appealing', '')
-        kw = kw.replace('details', '')
-        kw = kw.replace('detail', '')
-        kw = kw.replace('</img>', '')
-        kw = kw.replace('<img>', '')
-        kw = kw.replace('eye-catching', '')
-
-        kw = kw.replace(' appearance', '')
-        kw = kw.replace(' element', '')
-        kw = kw.replace(' position', '')
-
-        kw = kw.strip()
-
-        if kw == 'image' or kw == 'metadata' or kw == 'appropriate':
-            kw = ''
-
-        if kw == 'descriptive' or kw == 'detail':
-            kw = ''
-
-        if kw != '':
-            final_keywords.append(kw)
-    final_keywords = [*set(final_keywords)]
-
-    # break multi-word keywords into single words
-    temp = []
-    for kw in final_keywords:
-        if ' ' in kw:
-            p = kw.split(' ')
-            for k in p:
-                k = k.strip()
-                if k == 'a' or k == 'in' or k == 'with' or k == 'the' or k == 'and':
-                    k = ''
-                if k == 'for' or k == 'not' or k == 'of' or k == '1.' or k == 'context':
-                    k = ''
-                if k == 'no' or k == 'setting' or k == 'colors' or k == 'color' or k == 'quality':
-                    k = ''
-                if k == 'focal' or k == 'appropriate' or k == 'image' or k == 'this':
-                    k = ''
-                if k == 'an' or k == 'or' or k == '-' or k == 'on' or k == 'image:':
-                    k = ''
-                if k == 'are':
-                    k = ''
-
-                if k != '':
-                    temp.append(k)
+    if ',' not in keywords:
+        log('Error: keyword response does not appear to be comma-separated list after two attempts!')
+    else:
+        # sanitize & de-dupe keywords
+        final_keywords = sanitizer.keywords(keywords)
+    log('Sanitized Keywords >>> ' + str(final_keywords))
+    return title, description, final_keywords
+
+# asks the metadata questions one at a time about the uploaded image
+# returns raw (title, description, keywords) answers
+def ask_metadata_questions(client, log=log):
+    r = client.ask(title_request)
+    check_session(r)
+    question = question_extract(r)
+    answer = answer_extract(r)
+    log('\nTitle Request >>> ' + question.replace(initial_direction, ''))
+    log('MiniGPT-4 >>> ' + answer)
+    title = answer
+    if (len(answer.split())) > 12:
+        # this is a very long title
+        r = client.ask(title_shorten_request)
+        check_session(r)
+        question = question_extract(r)
+        answer = answer_extract(r)
+        log('\nTitle Request (shorten length) >>> ' + question)
+        log('MiniGPT-4 >>> ' + answer)
+        title = answer
+
+    r = client.ask(description_request)
+    check_session(r)
+    question = question_extract(r)
+    answer = answer_extract(r)
+    log('\nDescription Request >>> ' + question.replace(initial_direction, ''))
+    log('MiniGPT-4 >>> ' + answer)
+    description = answer
+
+    r = client.ask(keyword_request)
+    check_session(r)
+    question = question_extract(r)
+    answer = answer_extract(r)
+    log('\nKeyword Request >>> ' + question.replace(initial_direction, ''))
+    log('MiniGPT-4 >>> ' + answer)
+    if ',' not in answer:
+        r = client.ask(keyword_commas_request)
+        check_session(r)
+        question = question_extract(r)
+        answer = answer_extract(r)
+        log('\nKeyword Request (commas) >>> ' + question)
+        log('MiniGPT-4 >>> ' + answer)
+    keywords = answer
+    return title, description, keywords
+
+# uploads an image and asks the metadata questions one request at a time
+# returns raw (title, description, keywords) answers, or None on failure
+def tag_image(client, img, log=log):
+    r = client.upload(img)
+    if not response_success(r):
+        log('Error attempting to upload image (' + img + '):')
+        client.debug_response(r)
+        return None
+    log('Uploaded image (' + img + ') to MiniGPT-4 successfully!')
+    return ask_metadata_questions_reuploading(client, img, log)
+
+# asks the metadata questions, uploading the image again (up to SESSION_RETRIES times) if its
+# server session disappears part-way through; returns raw answers, or None on failure
+# on_expired is called each time a session disappears
+def ask_metadata_questions_reuploading(client, img, log=log, on_expired=None):
+    for attempt in range(SESSION_RETRIES + 1):
+        try:
+            return ask_metadata_questions(client, log)
+        except SessionExpired:
+            if on_expired is not None:
+                on_expired()
+            if attempt == SESSION_RETRIES:
+                break
+            log('Server session for ' + img + ' expired; uploading the image again...')
+            time.sleep(random.uniform(0, SESSION_RETRY_PAUSE * 2 ** attempt))
+            client.session = ''
+            r = client.upload(img)
+            if not response_success(r):
+                log('Error attempting to upload image (' + img + '): ' + r)
+                return None
+    log('Error: server session for ' + img + ' kept expiring (are more sessions open than the server\'s --max-sessions?)')
+    return None
+
+# sends an image and all metadata questions in one /api/v1/analyze request
+# returns raw (title, description, keywords) answers, or None on failure
+def tag_image_single_call(client, img, log=log):
+    r = client.analyze(img, analyze_prompts)
+    if not response_success(r):
+        log('Error attempting to analyze image (' + img + '):')
+        client.debug_response(r)
+        return None
+    log('Analyzed image (' + img + ') with MiniGPT-4 successfully!')
+    labels = [ ('Title Request', 'Title Request (shorten length)'),
+               ('Description Request', 'Description Request'),
+               ('Keyword Request', 'Keyword Request (commas)') ]
+    answers = json.loads(r)['answers']
+    for (label, followup_label), answer in zip(labels, answers):
+        for i, turn in enumerate(answer['history']):
+            log('\n' + (label if i == 0 else followup_label) + ' >>> ' + turn['prompt'].replace(initial_direction, ''))
+            log('MiniGPT-4 >>> ' + turn['response'])
+    return tuple(answer['response'] for answer in answers)
+
+
+# one image moving through the pipelined tagger
+# log lines are buffered so each image's log stays together when several run at once
+class TagJob:
+    def __init__(self, number, img, client):
+        self.number = number
+        self.img = img
+        self.client = client
+        self.answers = None
+        self.error = ''
+        self.lines = []
+        self.start_time = time.time()
+        # whether the job holds one of the run's SessionLimit slots
+        self.session_held = False
+
+    def log(self, msg):
+        self.lines.append(msg)
+
+    def flush(self):
+        log('\n'.join(self.lines))
+        self.lines = []
+
+
+# caps the server sessions a pipelined run keeps open at once (each lives from its upload until
+# its last question), so the run stays under the servers' --max-sessions instead of having its
+# own sessions evicted; a batch of uploads takes its slots all at once, so upload threads
+# holding part of a batch each can't deadlock
+# each session that expires anyway (the server is shared, or its --max-sessions is lower) takes
+# one slot away, so new uploads settle below what the server can hold (an image being asked
+# about keeps its slot while it is uploaded again: the slots it would wait for may belong to
+# images queued behind it)
+class SessionLimit:
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.cond = threading.Condition()
+
+    def acquire(self, n=1):
+        with self.cond:
+            # a batch larger than a shrunken limit waits for every slot instead
+            while self.used + n > self.limit and self.used > 0:
+                self.cond.wait()
+            self.used += n
+
+    def release(self, n=1):
+        with self.cond:
+            self.used -= n
+            self.cond.notify_all()
+
+    # returns the new limit; slots already taken are kept
+    def shrink(self):
+        with self.cond:
+            self.limit = max(1, self.limit - 1)
+            return self.limit
+
+
+# a pool of threads running fn over jobs from inbox, passing successful ones to outbox
+# fn returns True if the job should continue down the pipeline; on_fail is called otherwise
+# with batch > 1, fn is called with a list of up to batch jobs that were waiting together
+# and returns a list of per-job results
+class Stage:
+    def __init__(self, name, fn, threads, inbox, outbox=None, on_fail=None, batch=1):
+        self.name = name
+        self.fn = fn
+        self.on_fail = on_fail
+        self.threads = threads
+        self.batch = batch
+        self.inbox = inbox
+        self.outbox = outbox
+        # number of threads in the next stage; each needs its own end-of-work marker
+        self.downstream = 0
+        self.lock = threading.Lock()
+        self.count = 0
+        self.failed = 0
+        self.busy = 0.0
+        self.finished = 0
+        self.workers = [threading.Thread(target=self.run, daemon=True) for _ in range(threads)]
+
+    def start(self, downstream=0):
+        self.downstream = downstream
+        for worker in self.workers:
+            worker.start()
+
+    def join(self):
+        for worker in self.workers:
+            worker.join()
+
+    def run(self):
+        done = False
+        while not done:
+            job = self.inbox.get()
+            if job is None:
+                break
+            jobs = [job]
+            # take whatever else is already waiting, up to a full batch
+            while len(jobs) < self.batch:
+                try:
+                    job = self.inbox.get_nowait()
+                except queue.Empty:
+                    break
+                if job is None:
+                    done = True
+                    break
+                jobs.append(job)
+            self.process(jobs)
+        with self.lock:
+            self.finished += 1
+            last = self.finished == self.threads
+        if last and self.outbox is not None:
+            for _ in range(self.downstream):
+                self.outbox.put(None)
+
+    def process(self, jobs):
+        start = time.time()
+        try:
+            if self.batch > 1:
+                results = self.fn(jobs)
+            else:
+                results = [self.fn(jobs[0])]
+        except Exception as e:
+            for job in jobs:
+                job.error = 'Error in ' + self.name + ' stage: ' + str(e)
+                job.log(job.error + ' (' + job.img + ')')
+            results = [False] * len(jobs)
+        with self.lock:
+            self.busy += time.time() - start
+            self.count += len(jobs)
+            self.failed += sum(1 for ok in results if not ok)
+        for job, ok in zip(jobs, results):
+            if ok and self.outbox is not None:
+                self.outbox.put(job)
+            elif not ok:
+                if self.on_fail is not None:
+                    self.on_fail(job)
+                job.flush()
+
+    def report(self, elapsed):
+        rate = self.count / elapsed if elapsed > 0 else 0.0
+        avg = self.busy / self.count if self.count > 0 else 0.0
+        utilization = self.busy / (elapsed * self.threads) if elapsed > 0 else 0.0
+        return (self.name + ': ' + str(self.count) + ' images (' + str(self.failed) + ' failed), '
+                + str(round(rate, 2)) + ' images/sec, ' + str(round(avg, 2)) + ' sec/image, '
+                + str(round(100 * utilization)) + '% busy across ' + str(self.threads) + ' thread(s)')
+
+
+# tags images with overlapping stages: uploading, asking questions (against one or more
+# servers) and writing IPTC data each run in their own threads, connected by bounded queues
+# images may be any iterable; progress is recorded in manifest if one is given
+# at most max_sessions images have a session open on the servers at once (see SessionLimit)
+def run_pipeline(images, servers, workers, writers, single_call, manifest=None, upload_batch=1, max_sessions=32):
+    max_sessions = max(1, max_sessions)
+    upload_batch = min(upload_batch, max_sessions)
+    sessions = SessionLimit(max_sessions)
+
+    def session_expired():
+        log('Note: a server session expired; now keeping at most ' + str(sessions.shrink()) + ' open...')
+    depth = max(workers, upload_batch) * 2
+    asks = queue.Queue(maxsize=depth)
+    writes = queue.Queue(maxsize=depth)
+
+    def upload_stage(job):
+        job.log('\n[' + str(job.number) + '] Now working on ' + job.img + '...')
+        sessions.acquire()
+        job.session_held = True
+        r = job.client.upload(job.img)
+        if not response_success(r):
+            job.error = 'Error attempting to upload image: ' + r
+            job.log(job.error + ' (' + job.img + ')')
+            return False
+        job.log('Uploaded image (' + job.img + ') to MiniGPT-4 successfully!')
+        return True
+
+    # uploads a batch of images with one /api/v1/upload_batch request per server, so each
+    # server can encode them together; every image still gets its own session
+    def upload_batch_stage(batch):
+        results = [False] * len(batch)
+        sessions.acquire(len(batch))
+        for job in batch:
+            job.session_held = True
+        by_server = {}
+        for i, job in enumerate(batch):
+            job.log('\n[' + str(job.number) + '] Now working on ' + job.img + '...')
+            by_server.setdefault(job.client.url, []).append(i)
+        for url, indexes in by_server.items():
+            r = batch[indexes[0]].client.upload_batch([batch[i].img for i in indexes])
+            try:
+                images = json.loads(r).get('images', [])
+            except ValueError:
+                images = []
+            if len(images) != len(indexes):
+                for i in indexes:
+                    batch[i].error = 'Error attempting to upload image: ' + r
+                    batch[i].log(batch[i].error + ' (' + batch[i].img + ')')
+                continue
+            for i, image in zip(indexes, images):
+                job = batch[i]
+                if image.get('success'):
+                    job.client.session = image['session']
+                    job.log('Uploaded image (' + job.img + ') to MiniGPT-4 successfully!')
+                    results[i] = True
+                else:
+                    job.error = 'Error attempting to upload image: ' + image.get('message', '')
+                    job.log(job.error + ' (' + job.img + ')')
+        return results
+
+    def ask_stage(job):
+        try:
+            if single_call:
+                job.log('\n[' + str(job.number) + '] Now working on ' + job.img + '...')
+                job.answers = tag_image_single_call(job.client, job.img, job.log)
+            else:
+                job.answers = ask_metadata_questions_reuploading(job.client, job.img, job.log, session_expired)
+        finally:
+            if not single_call:
+                job.client.server_close()
+                release_session(job)
+        if job.answers is None:
+            job.error = 'Error attempting to analyze image'
+            return False
+        if manifest is not None:
+            manifest.record_answers(job.img, *job.answers)
+        return True
+
+    def write_stage(job):
+        title, description, keywords = finalize_metadata(*job.answers, log=job.log)
+        export_metadata(job.img, title, description, keywords)
+        written = write_metadata(job.img, title, description, keywords)
+        if manifest is not None:
+            manifest.record_done(job.img, title, description, keywords, refresh=written and in_place())
+        exec_time = time.time() - job.start_time
+        job.log("finished job #" + str(job.number) + " in " + str(round(exec_time, 2)) + " seconds.")
+        job.flush()
+        return True
+
+    def release_session(job):
+        if job.session_held:
+            job.session_held = False
+            sessions.release()
+
+    def record_failure(job):
+        release_session(job)
+        if manifest is not None:
+            manifest.record_error(job.img, job.error)
+
+    stages = []
+    if single_call:
+        inbox = asks
+    else:
+        inbox = queue.Queue(maxsize=depth)
+        if upload_batch > 1:
+            # a few threads each sending whole batches keep the server's encoder busy
+            stages.append(Stage('upload', upload_batch_stage, max(1, workers // upload_batch), inbox, asks, record_failure, upload_batch))
         else:
-            temp.append(kw)
-    final_keywords = [*set(temp)]
-
-    return final_keywords
+            stages.append(Stage('upload', upload_stage, workers, inbox, asks, record_failure))
+    stages.append(Stage('ask', ask_stage, workers, asks, writes, record_failure))
+    stages.append(Stage('write', write_stage, writers, writes, None, record_failure))
+    for i, stage in enumerate(stages):
+        stage.start(stages[i + 1].threads if i + 1 < len(stages) else 0)
+
+    start_time = time.time()
+    count = 0
+    for img in images:
+        inbox.put(TagJob(count + 1, img, minigpt4.MiniGPT4_Client(url=servers[count % len(servers)])))
+        count += 1
+    for _ in range(stages[0].threads):
+        inbox.put(None)
+    for stage in stages:
+        stage.join()
+    elapsed = time.time() - start_time
+
+    log('\nTagged ' + str(stages[-1].count - stages[-1].failed) + ' of ' + str(count) + ' images in ' + str(round(elapsed, 2)) + ' seconds.')
+    log('Per-stage throughput:')
+    for stage in stages:
+        log('  ' + stage.report(elapsed))
 
 
 # entry point
@@ -294,96 +595,292 @@ if __name__ == '__main__':
         required=True,
         help="the base directory containing images"
     )
+    parser.add_argument(
+        "--recursive",
+        action='store_true',
+        help="also tag images in subdirectories (output 'tagged' directories are skipped)"
+    )
+    parser.add_argument(
+        "--extensions",
+        type=str,
+        default='.jpg,.jpeg',
+        help="comma-separated image file extensions to tag; .png and .tif/.tiff images are analyzed but only JPEGs get IPTC data"
+    )
+    parser.add_argument(
+        "--include",
+        type=str,
+        action='append',
+        default=[],
+        help="only tag images whose path (relative to --imgdir) or name matches this glob (repeatable)"
+    )
+    parser.add_argument(
+        "--exclude",
+        type=str,
+        action='append',
+        default=[],
+        help="skip images and directories whose relative path or name matches this glob (repeatable)"
+    )
+    parser.add_argument(
+        "--min-size",
+        type=tagger_discovery.parse_size,
+        default=None,
+        help="skip files smaller than this (bytes, or with a K/M/G suffix)"
+    )
+    parser.add_argument(
+        "--max-size",
+        type=tagger_discovery.parse_size,
+        default=None,
+        help="skip files larger than this (bytes, or with a K/M/G suffix)"
+    )
+    parser.add_argument(
+        "--newer-than",
+        type=tagger_discovery.parse_time,
+        default=None,
+        help="only tag files modified on or after this date/time (e.g. 2023-05-01 or 2023-05-01T12:00)"
+    )
+    parser.add_argument(
+        "--older-than",
+        type=tagger_discovery.parse_time,
+        default=None,
+        help="only tag files modified on or before this date/time"
+    )
+    parser.add_argument(
+        "--shard",
+        type=tagger_discovery.parse_shard,
+        default=None,
+        help="INDEX/COUNT: only tag this process's share of the images, split by a stable hash of their paths (e.g. 0/4 ... 3/4)"
+    )
+    parser.add_argument(
+        "--single-call",
+        action='store_true',
+        help="send each image and all of its questions in one request (requires a server with /api/v1/analyze)"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=0,
+        help="pipeline uploads, questions and IPTC writing with this many concurrent images (0 = one image at a time)"
+    )
+    parser.add_argument(
+        "--upload-batch",
+        type=int,
+        default=1,
+        help="upload this many images per request in pipelined mode, so the server encodes them together (requires a server with /api/v1/upload_batch; implies --workers)"
+    )
+    parser.add_argument(
+        "--max-live-sessions",
+        type=int,
+        default=32,
+        help="most images with a session open on the servers at once in pipelined mode; keep it below the servers' --max-sessions (default 64), less what other clients need"
+    )
+    parser.add_argument(
+        "--writers",
+        type=int,
+        default=1,
+        help="threads writing IPTC data in pipelined mode"
+    )
+    parser.add_argument(
+        "--writer",
+        choices=['fast', 'iptcinfo3'],
+        default='fast',
+        help="'fast' rewrites only the metadata segments and streams the rest of each image; 'iptcinfo3' is the original writer"
+    )
+    parser.add_argument(
+        "--in-place",
+        action='store_true',
+        help="write metadata into the original images (atomically, via a temporary file) instead of copies in a 'tagged' subdir"
+    )
+    parser.add_argument(
+        "--xmp",
+        action='store_true',
+        help="also write the metadata as XMP (dc:title, dc:description & dc:subject) alongside IPTC"
+    )
+    parser.add_argument(
+        "--durable",
+        action='store_true',
+        help="fsync each image (and, in one-image-at-a-time mode, each batch's directory) before moving on"
+    )
+    parser.add_argument(
+        "--export",
+        type=str,
+        action='append',
+        help="also write every image's metadata to this .jsonl, .csv or .parquet file (Parquet requires pyarrow); repeatable"
+    )
+    parser.add_argument(
+        "--sidecars",
+        action='store_true',
+        help="also write an XMP sidecar (photo.jpg -> photo.jpg.xmp) for every image"
+    )
+    parser.add_argument(
+        "--sidecar-dir",
+        type=str,
+        default='',
+        help="directory to write XMP sidecars to, in the same subdirectories as the images under --imgdir (default: next to each image)"
+    )
+    parser.add_argument(
+        "--export-only",
+        action='store_true',
+        help="leave the images untouched; metadata only goes to --export files and --sidecars"
+    )
+    parser.add_argument(
+        "--manifest",
+        type=str,
+        default='metadata-tagger-manifest.db',
+        help="SQLite file recording per-image progress & answers, so reruns skip finished images ('' to disable)"
+    )
+    parser.add_argument(
+        "--force",
+        action='store_true',
+        help="re-tag every image, even ones the manifest lists as done and unchanged"
+    )
+    parser.add_argument(
+        "--resanitize",
+        action='store_true',
+        help="re-run sanitization on the answers stored in the manifest and rewrite metadata, without contacting a server"
+    )
+    parser.add_argument(
+        "--sanitizer-config",
+        type=str,
+        default='',
+        help="JSON file of the prefixes, phrases & stopwords stripped from answers (default metadata-sanitizer.json next to this script)"
+    )
+    parser.add_argument(
+        "--server",
+        type=str,
+        action='append',
+        help="MiniGPT-4 server URL; repeat to spread images across several servers (default http://localhost:5000)"
+    )
     opt = parser.parse_args()
-
-    if opt.imgdir != '' and exists(opt.imgdir):
-        print('\nStarting...')
-        count = 0
-        images = get_images_from_dir(opt.imgdir)
-        print('Found ' + str(len(images)) + ' images in ' + opt.imgdir + '...')
-        if len(images) > 0:
-            # create log file
-            f = open('metadata-tagger-log.txt', 'w', encoding = 'utf-8')
-            f.close()
-            client = minigpt4.MiniGPT4_Client()
+    servers = opt.server if opt.server else ['http://localhost:5000']
+    if opt.sanitizer_config != '':
+        sanitizer = metadata_sanitizer.Sanitizer.load(opt.sanitizer_config)
+    if opt.writer == 'iptcinfo3':
+        if opt.in_place or opt.xmp or opt.durable:
+            print('Note: --in-place, --xmp & --durable require --writer fast...')
+        writer = None
+    else:
+        writer = metadata_writer.MetadataWriter(in_place=opt.in_place, xmp=opt.xmp, durable=opt.durable)
+    write_images = not opt.export_only
+    if opt.sidecars or opt.sidecar_dir != '':
+        sidecars = metadata_export.SidecarWriter(opt.sidecar_dir if opt.sidecar_dir != '' else None, root=opt.imgdir or '.')
+    for path in opt.export or []:
+        try:
+            exports.append(metadata_export.open_export(path))
+        except (OSError, ValueError, RuntimeError) as e:
+            parser.error('--export ' + path + ': ' + str(e))
+    if opt.export_only and len(exports) == 0 and sidecars is None:
+        print('Note: --export-only without --export or --sidecars writes no metadata anywhere...')
+
+    # exports are closed even if the run fails, so what was written so far stays readable
+    try:
+        if opt.imgdir != '' and exists(opt.imgdir) and opt.resanitize:
+            if opt.manifest == '' or not exists(opt.manifest):
+                print('Error: --resanitize requires an existing manifest (--manifest <file>)!')
+            else:
+                manifest = tagger_manifest.Manifest(opt.manifest)
+                rows = manifest.answered(opt.imgdir)
+                print('\nRe-sanitizing stored answers for ' + str(len(rows)) + ' images in ' + opt.imgdir + '...')
+                for img, raw_title, raw_description, raw_keywords in rows:
+                    if not exists(img):
+                        continue
+                    log('\nRe-sanitizing ' + img + '...')
+                    title, description, keywords = finalize_metadata(raw_title, raw_description, raw_keywords)
+                    export_metadata(img, title, description, keywords)
+                    try:
+                        written = write_metadata(img, title, description, keywords)
+                    except (OSError, ValueError) as e:
+                        print('\nError writing metadata to ' + img + ': ' + str(e))
+                        manifest.record_error(img, 'Error writing metadata: ' + str(e))
+                        continue
+                    manifest.record_done(img, title, description, keywords, refresh=written and in_place())
+                manifest.close()
+                print('\nDone!')
+
+        elif opt.imgdir != '' and exists(opt.imgdir):
+            print('\nStarting...')
+            count = 0
+            manifest = None
+            if opt.manifest != '':
+                manifest = tagger_manifest.Manifest(opt.manifest)
+            # images are found (and checked against the manifest) as the work proceeds
+            finder = tagger_discovery.ImageFinder(
+                opt.imgdir,
+                recursive=opt.recursive,
+                include=opt.include,
+                exclude=opt.exclude,
+                extensions=[ext.strip() for ext in opt.extensions.split(',') if ext.strip() != ''],
+                min_size=opt.min_size,
+                max_size=opt.max_size,
+                newer_than=opt.newer_than,
+                older_than=opt.older_than,
+                shard=opt.shard,
+                keep=manifest.needs_tagging if manifest is not None and not opt.force else None)
+            images = iter(finder)
+            # append to the log file so resumed runs keep their history
+            log('\n===== metadata-tagger run started ' + time.strftime('%Y-%m-%d %H:%M:%S') + ' =====')
+            client = minigpt4.MiniGPT4_Client(url=servers[0])
             r = client.server_reset()
             if response_success(r):
-                initial_direction = 'You are a metadata generation machine designed to help describe images. Your responses will be used verbatim in image metadata and should not be conversational. Respond with only the answer and no context around why the answer is appropriate. '
                 log('\nNote: The following initial direction is prepended to all server requests to help guide output: ')
                 log(initial_direction)
-                # iterate through .jpg images in specified directory
-                for img in images:
-                    log('\n[' + str(count+1) + '] Now working on ' + img + '...')
-                    # send image to MiniGPT-4 server
-                    r = client.upload(img)
-                    if response_success(r):
-                        start_time = time.time()
-                        log('Uploaded image (' + img + ') to MiniGPT-4 successfully!')
-                        title = ''
-                        desc = ''
-                        keywords = []
-
-                        # ask questions to generate image metadata
-                        r = client.ask(initial_direction + 'Generate an appropriate short title (just a few words) for this image. The title should accurately describe the most obvious visual elements of the image in as few words as possible. Avoid esoteric or abstract language.')
-                        question = question_extract(r)
-                        answer = answer_extract(r)
-                        log('\nTitle Request >>> ' + question.replace(initial_direction, ''))
-                        log('MiniGPT-4 >>> ' + answer)
-                        title = answer
-                        if (len(answer.split())) > 12:
-                            # this is a very long title
-                            r = client.ask('Shorten the title so that it is less than 10 words. Use plain descriptive language.')
-                            question = question_extract(r)
-                            answer = answer_extract(r)
-                            log('\nTitle Request (shorten length) >>> ' + question)
-                            log('MiniGPT-4 >>> ' + answer)
-                            title = answer
-                        title = sanitize_title(title)
-                        log('Sanitized Title >>> ' + title)
-
-                        r = client.ask(initial_direction + 'Write a short description (1-2 sentences) for this image. Stick to describing visual elements of the image without making comments about its origin or purpose.')
-                        question = question_extract(r)
-                        answer = answer_extract(r)
-                        log('\nDescription Request >>> ' + question.replace(initial_direction, ''))
-                        log('MiniGPT-4 >>> ' + answer)
-                        description = sanitize_description(answer)
-                        log('Sanitized Description >>> ' + description)
-                        description = description.split('. ',)[0]
-                        if not description.endswith('.'):
-                            description += '.'
-                        log('Sanitized Description (1st sentence) >>> ' + description)
-
-                        r = client.ask(initial_direction + 'List at least 10 appropriate keywords for this image, separated by commas.')
-                        question = question_extract(r)
-                        answer = answer_extract(r)
-                        log('\nKeyword Request >>> ' + question.replace(initial_direction, ''))
-                        log('MiniGPT-4 >>> ' + answer)
-                        if ',' not in answer:
-                            r = client.ask('List the keywords on a single line, separated by commas.')
-                            question = question_extract(r)
-                            answer = answer_extract(r)
-                            log('\nKeyword Request (commas) >>> ' + question)
-                            log('MiniGPT-4 >>> ' + answer)
-                        if ',' not in answer:
-                            log('Error: keyword response does not appear to be comma-separated list after two attempts!')
-                        else:
-                            # sanitize & de-dupe keywords
-                            final_keywords = sanitize_keywords(keywords)
-                        log('Sanitized Keywords >>> ' + str(final_keywords))
-
-                        # write metadata to image
-                        write_iptc_info(img, title, description, final_keywords, '')
-
-                        exec_time = time.time() - start_time
-                        print("finished job #" + str(count+1) + " in " + str(round(exec_time, 2)) + " seconds.")
-                    else:
-                        log('Error attempting to upload image (' + img + '):')
-                        client.debug_response(r)
-                    count += 1
+                if opt.upload_batch > 1 and opt.single_call:
+                    print('Note: --upload-batch has no effect with --single-call...')
+                elif opt.upload_batch > 1 and opt.workers == 0:
+                    opt.workers = opt.upload_batch
+                if opt.workers > 0:
+                    run_pipeline(images, servers, opt.workers, max(1, opt.writers), opt.single_call, manifest, max(1, opt.upload_batch), opt.max_live_sessions)
+                else:
+                    # metadata is written on a background thread while the next image is analyzed
+                    background = None
+                    if writer is not None and write_images:
+                        background = metadata_writer.BackgroundWriter(writer)
+                    # queued writes are finished even if the run stops early (an error, or Ctrl-C),
+                    # since the manifest already has their answers
+                    try:
+                        # iterate through images as they are found
+                        for img in images:
+                            log('\n[' + str(count+1) + '] Now working on ' + img + '...')
+                            start_time = time.time()
+                            # send image & questions to MiniGPT-4 server
+                            if opt.single_call:
+                                answers = tag_image_single_call(client, img)
+                            else:
+                                answers = tag_image(client, img)
+                            if answers is not None:
+                                if manifest is not None:
+                                    manifest.record_answers(img, *answers)
+                                title, description, keywords = finalize_metadata(*answers)
+                                export_metadata(img, title, description, keywords)
+
+                                # write metadata to image
+                                if background is not None and is_jpeg(img):
+                                    background.submit(img, title, description, keywords,
+                                        done=lambda path, output, error, metadata=(title, description, keywords): written_in_background(manifest, path, output, error, *metadata))
+                                else:
+                                    written = write_metadata(img, title, description, keywords)
+                                    if manifest is not None:
+                                        manifest.record_done(img, title, description, keywords, refresh=written and in_place())
+
+                                exec_time = time.time() - start_time
+                                print("finished job #" + str(count+1) + " in " + str(round(exec_time, 2)) + " seconds.")
+                            elif manifest is not None:
+                                manifest.record_error(img, 'Error attempting to tag image')
+                            count += 1
+                    finally:
+                        if background is not None:
+                            background.close()
             else:
                 print('Error attempting to reset MiniGPT-4:')
                 client.debug_response(r)
-
-        print('\nDone!')
-    else:
-        print('Error: specify a valid directory containing images (--imgdir <path>)!')
+            summary = 'Scanned ' + str(finder.scanned) + ' files in ' + opt.imgdir + ': ' + str(finder.matched) + ' images to tag'
+            if manifest is not None and not opt.force:
+                summary += ', ' + str(finder.skipped) + ' already tagged (see ' + opt.manifest + ')'
+            print('\n' + summary + '.')
+            if manifest is not None:
+                manifest.close()
+
+            print('\nDone!')
+        else:
+            print('Error: specify a valid directory containing images (--imgdir <path>)!')
+    finally:
+        close_exports()
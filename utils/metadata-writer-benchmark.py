@@ -0,0 +1,143 @@
+# Copyright 2021 - 2023, Bill Kennedy (https://github.com/rbbrdckybk/MiniGPT-4)
+# SPDX-License-Identifier: MIT
+
+# Metadata Writer Benchmark
+# Times the metadata tagger's fast JPEG metadata writer (metadata_writer.py) against the
+# original iptcinfo3 path (parse, save_as into 'tagged', delete the '~' backup), writing the same
+# title, description & keywords into copies of a set of JPEGs. The images come from --imgdir or
+# are generated (large, noisy JPEGs, so the compressed data dominates). Every output is read back
+# with iptcinfo3 and decoded with PIL to check it.
+# Runs on CPU; no model or server required.
+
+# usage:
+# python metadata-writer-benchmark.py --images 20 --width 6000 --height 4000
+# python metadata-writer-benchmark.py --imgdir <path containing images> --xmp
+
+import argparse
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+from iptcinfo3 import IPTCInfo
+from PIL import Image
+
+import metadata_writer
+
+logging.getLogger('iptcinfo').setLevel(logging.ERROR)
+
+TITLE = 'Sunset over the mountains'
+DESCRIPTION = 'The sun sets behind snowy mountains, casting an orange glow over a lake.'
+KEYWORDS = ['sunset', 'mountains', 'lake', 'snow', 'orange', 'glow', 'landscape', 'evening']
+
+
+def generate_images(dir, n, width, height, quality):
+    paths = []
+    noise = Image.effect_noise((width, height), 64).convert('RGB')
+    for i in range(n):
+        path = os.path.join(dir, 'image-' + str(i) + '.jpg')
+        # vary each image a little so none are byte-identical
+        noise.rotate(i * 2).save(path, quality=quality)
+        paths.append(path)
+    return paths
+
+# copies of the source images in a fresh directory, so every run starts from the same files
+def stage_copies(sources, dir):
+    if os.path.exists(dir):
+        shutil.rmtree(dir)
+    os.makedirs(dir)
+    copies = []
+    for src in sources:
+        copies.append(shutil.copy(src, os.path.join(dir, os.path.basename(src))))
+    return copies
+
+# the original write path from metadata-tagger.py
+def legacy_write(filename):
+    info = IPTCInfo(filename, force=True)
+    info['object name'] = TITLE
+    info['caption/abstract'] = DESCRIPTION
+    info['copyright notice'] = ''
+    info['keywords'] = KEYWORDS
+    dir = os.path.join(os.path.dirname(filename), 'tagged')
+    os.makedirs(dir, exist_ok=True)
+    output_file = os.path.join(dir, os.path.basename(filename))
+    info.save_as(output_file)
+    if os.path.exists(output_file + '~'):
+        os.remove(output_file + '~')
+    return output_file
+
+def time_run(sources, work_dir, repeat, write):
+    best = None
+    outputs = []
+    for _ in range(repeat):
+        copies = stage_copies(sources, work_dir)
+        start = time.perf_counter()
+        outputs = [write(path) for path in copies]
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, outputs
+
+# returns the number of outputs that don't read back correctly
+def verify(outputs):
+    bad = 0
+    for path in outputs:
+        try:
+            info = IPTCInfo(path)
+            ok = info['object name'] == TITLE.encode('utf-8') and [k.decode('utf-8') for k in info['keywords']] == KEYWORDS
+            with Image.open(path) as img:
+                img.load()
+        except Exception as e:
+            print('Error verifying ' + path + ': ' + str(e))
+            ok = False
+        if not ok:
+            bad += 1
+    return bad
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--imgdir", type=str, default='', help="directory of JPEGs to use instead of generated images")
+    parser.add_argument("--images", type=int, default=10, help="number of generated images")
+    parser.add_argument("--width", type=int, default=4000, help="width of generated images")
+    parser.add_argument("--height", type=int, default=3000, help="height of generated images")
+    parser.add_argument("--quality", type=int, default=95, help="JPEG quality of generated images")
+    parser.add_argument("--xmp", action='store_true', help="have the fast writer write XMP as well")
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per writer (best is reported)")
+    opt = parser.parse_args()
+
+    temp_dir = tempfile.mkdtemp(prefix='metadata-writer-benchmark-')
+    try:
+        if opt.imgdir != '':
+            sources = sorted(os.path.join(opt.imgdir, f) for f in os.listdir(opt.imgdir) if f.lower().endswith(('.jpg', '.jpeg')))
+        else:
+            print('Generating ' + str(opt.images) + ' ' + str(opt.width) + 'x' + str(opt.height) + ' JPEGs...')
+            os.makedirs(os.path.join(temp_dir, 'source'))
+            sources = generate_images(os.path.join(temp_dir, 'source'), opt.images, opt.width, opt.height, opt.quality)
+        if len(sources) == 0:
+            print('Error: no JPEG images to write to!')
+        else:
+            total_mb = sum(os.path.getsize(path) for path in sources) / (1024 * 1024)
+            work_dir = os.path.join(temp_dir, 'work')
+            tagged = metadata_writer.MetadataWriter(xmp=opt.xmp)
+            in_place = metadata_writer.MetadataWriter(in_place=True, xmp=opt.xmp)
+            runs = [
+                ('iptcinfo3 (tagged copy)', legacy_write),
+                ('fast (tagged copy)', lambda path: tagged.write(path, TITLE, DESCRIPTION, KEYWORDS)),
+                ('fast (in place)', lambda path: in_place.write(path, TITLE, DESCRIPTION, KEYWORDS)),
+            ]
+            print('Writing metadata to ' + str(len(sources)) + ' images (' + str(round(total_mb, 1)) + ' MB, best of ' + str(opt.repeat) + ' runs)')
+            baseline = None
+            for name, write in runs:
+                seconds, outputs = time_run(sources, work_dir, opt.repeat, write)
+                bad = verify(outputs)
+                line = name.ljust(24) + str(round(seconds * 1000 / len(sources), 2)) + ' ms per image, ' + str(round(total_mb / seconds, 1)) + ' MB/s'
+                if baseline is None:
+                    baseline = seconds
+                else:
+                    line += ' (' + str(round(baseline / seconds, 2)) + 'x)'
+                if bad > 0:
+                    line += ', ' + str(bad) + ' outputs failed verification!'
+                print(line)
+    finally:
+        shutil.rmtree(temp_dir)
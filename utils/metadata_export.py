@@ -0,0 +1,196 @@
+# Copyright 2021 - 2023, Bill Kennedy (https://github.com/rbbrdckybk/MiniGPT-4)
+# SPDX-License-Identifier: MIT
+
+# bulk exports & XMP sidecars of the metadata produced by metadata-tagger.py
+# results are buffered and written a batch at a time (or after a few seconds, whichever comes
+# first), so a long run streams its results to one JSONL, CSV or Parquet file that downstream
+# tools can ingest with a single sequential read; sidecars carry the same metadata next to
+# each image without touching the image itself
+
+import csv
+import io
+import json
+import os
+import threading
+import time
+import uuid
+
+import metadata_writer
+
+# columns of every export
+FIELDS = ('path', 'title', 'description', 'keywords', 'tagged')
+# keywords are joined with this in CSV exports (they never contain one)
+CSV_KEYWORD_SEPARATOR = ';'
+
+
+# base class: subclasses turn a batch of records into file writes
+# JSONL & CSV exports are appended to, so resumed runs add to the same file; a re-tagged image
+# gets a new line, and the last line for a path wins
+class Export:
+    def __init__(self, path, batch=256, interval=5.0):
+        self.path = path
+        self.batch = batch
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.pending = []
+        self.last_flush = time.time()
+        self.count = 0
+
+    # queue one image's metadata; thread-safe
+    def add(self, img, title, description, keywords):
+        record = {
+            'path': os.path.abspath(img),
+            'title': title,
+            'description': description,
+            'keywords': list(keywords),
+            'tagged': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        }
+        with self.lock:
+            self.pending.append(record)
+            if len(self.pending) >= self.batch or time.time() - self.last_flush >= self.interval:
+                self.flush_locked()
+
+    def flush(self):
+        with self.lock:
+            self.flush_locked()
+
+    def flush_locked(self):
+        if len(self.pending) > 0:
+            self.write(self.pending)
+            self.count += len(self.pending)
+            self.pending = []
+        self.last_flush = time.time()
+
+    def close(self):
+        self.flush()
+
+    def write(self, records):
+        raise NotImplementedError
+
+
+class JsonlExport(Export):
+    def __init__(self, path, **kwargs):
+        super().__init__(path, **kwargs)
+        self.f = open(path, 'a', encoding='utf-8')
+
+    def write(self, records):
+        self.f.write(''.join(json.dumps(r, ensure_ascii=False) + '\n' for r in records))
+        self.f.flush()
+
+    def close(self):
+        super().close()
+        self.f.close()
+
+
+class CsvExport(Export):
+    def __init__(self, path, **kwargs):
+        super().__init__(path, **kwargs)
+        new = not os.path.exists(path) or os.path.getsize(path) == 0
+        self.f = open(path, 'a', encoding='utf-8', newline='')
+        if new:
+            csv.writer(self.f).writerow(FIELDS)
+            self.f.flush()
+
+    def write(self, records):
+        # format the whole batch in memory, then hand it to the file in one write
+        buf = io.StringIO()
+        out = csv.writer(buf)
+        for r in records:
+            out.writerow([r['path'], r['title'], r['description'], CSV_KEYWORD_SEPARATOR.join(r['keywords']), r['tagged']])
+        self.f.write(buf.getvalue())
+        self.f.flush()
+
+    def close(self):
+        super().close()
+        self.f.close()
+
+
+# one row group per batch; requires pyarrow (pip install pyarrow)
+# Parquet files can't be appended to, so a run writes a temporary file, starting with the rows
+# of an existing export, that replaces the export when the run closes it; a run killed before
+# that leaves the previous export untouched (and a stray .tmp file)
+class ParquetExport(Export):
+    def __init__(self, path, **kwargs):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise RuntimeError('Parquet exports require pyarrow (pip install pyarrow)')
+        super().__init__(path, **kwargs)
+        self.pa = pyarrow
+        self.schema = pyarrow.schema([
+            ('path', pyarrow.string()),
+            ('title', pyarrow.string()),
+            ('description', pyarrow.string()),
+            ('keywords', pyarrow.list_(pyarrow.string())),
+            ('tagged', pyarrow.string()),
+        ])
+        self.temp = path + '.' + uuid.uuid4().hex + '.tmp'
+        self.writer = pyarrow.parquet.ParquetWriter(self.temp, self.schema)
+        try:
+            if os.path.exists(path):
+                # carry the earlier rows over a batch at a time
+                for batch in pyarrow.parquet.ParquetFile(path).iter_batches(columns=list(FIELDS)):
+                    self.writer.write_table(pyarrow.Table.from_batches([batch]).cast(self.schema))
+        except BaseException:
+            self.writer.close()
+            os.remove(self.temp)
+            raise
+
+    def write(self, records):
+        columns = { field: [r[field] for r in records] for field in FIELDS }
+        self.writer.write_table(self.pa.Table.from_pydict(columns, schema=self.schema))
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            self.writer.close()
+        os.replace(self.temp, self.path)
+
+
+EXPORTS = { '.jsonl': JsonlExport, '.csv': CsvExport, '.parquet': ParquetExport }
+
+# export for a file, by extension (.jsonl, .csv or .parquet)
+def open_export(path, **kwargs):
+    ext = os.path.splitext(path)[1].lower()
+    if ext not in EXPORTS:
+        raise ValueError('unsupported export format ' + repr(ext) + ' (use ' + ', '.join(EXPORTS) + ')')
+    return EXPORTS[ext](path, **kwargs)
+
+
+# writes an XMP sidecar for each image: photo.jpg -> photo.jpg.xmp (the image's full name is
+# kept, so photo.jpg & photo.png get separate sidecars), next to the image, or in dir if given,
+# under the image's path relative to root (so a/photo.jpg & b/photo.jpg don't share one); an
+# existing sidecar is updated, keeping its other properties
+class SidecarWriter:
+    def __init__(self, dir=None, root='.'):
+        self.dir = dir
+        self.root = root
+
+    def sidecar_path(self, img):
+        if self.dir is None:
+            return img + '.xmp'
+        rel = os.path.relpath(os.path.abspath(img), os.path.abspath(self.root))
+        if rel == os.pardir or rel.startswith(os.pardir + os.sep) or os.path.isabs(rel):
+            raise ValueError(img + ' is outside ' + self.root + ', so it has no place in the sidecar directory')
+        return os.path.join(self.dir, rel + '.xmp')
+
+    def write(self, img, title, description, keywords, copyright=''):
+        path = self.sidecar_path(img)
+        existing = None
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                existing = f.read()
+        packet = metadata_writer.build_xmp(existing, title, description, keywords, copyright, padding=0)
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        temp = path + '.' + uuid.uuid4().hex + '.tmp'
+        try:
+            with open(temp, 'wb') as f:
+                f.write(packet)
+            os.replace(temp, path)
+        except BaseException:
+            if os.path.exists(temp):
+                os.remove(temp)
+            raise
+        return path
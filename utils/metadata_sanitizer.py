@@ -0,0 +1,105 @@
+# Copyright 2021 - 2023, Bill Kennedy (https://github.com/rbbrdckybk/MiniGPT-4)
+# SPDX-License-Identifier: MIT
+
+# turns raw MiniGPT-4 answers into clean metadata for metadata-tagger.py
+# the prefixes, phrases and stopwords to strip live in a JSON config (metadata-sanitizer.json by
+# default) and are compiled once into regexes & sets, so each answer is cleaned in a single pass
+
+import json
+import os
+import re
+
+DEFAULT_CONFIG = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'metadata-sanitizer.json')
+
+# first "quoted" or >tagged< span of a title answer
+QUOTED = re.compile(r'"([^"]*)"')
+TAGGED = re.compile(r'>([^<]*)<')
+
+# one regex matching any of the given strings (longest first, so 'keywords: ' wins over
+# 'keywords'), optionally anchored to the start of the text; None if there are no strings
+def compile_phrases(phrases, prefix=False, ignore_case=True):
+    if len(phrases) == 0:
+        return None
+    pattern = '|'.join(re.escape(p) for p in sorted(phrases, key=len, reverse=True))
+    if prefix:
+        # strip any run of prefixes, e.g. 'Title: The image shows '
+        pattern = '^(?:' + pattern + ')+'
+    return re.compile(pattern, re.IGNORECASE if ignore_case else 0)
+
+def strip_phrases(regex, text):
+    return text if regex is None else regex.sub('', text)
+
+
+class Sanitizer:
+    def __init__(self, config):
+        common = config.get('common_prefixes', [])
+        self.title_prefixes = compile_phrases(common + config.get('title_prefixes', []), prefix=True)
+        self.description_prefixes = compile_phrases(common + config.get('description_prefixes', []), prefix=True)
+        self.common_removals = compile_phrases(config.get('common_removals', []))
+        # keyword answers are lowercased before matching
+        self.keyword_removals = compile_phrases([p.lower() for p in config.get('keyword_removals', [])], ignore_case=False)
+        self.keyword_stopwords = set(config.get('keyword_stopwords', []))
+        self.keyword_word_stopwords = set(config.get('keyword_word_stopwords', []))
+
+    # load a sanitizer from a JSON config file (see metadata-sanitizer.json)
+    @classmethod
+    def load(cls, path=None):
+        with open(path or DEFAULT_CONFIG, 'r', encoding='utf-8') as f:
+            return cls(json.load(f))
+
+    # remove stray tags, then any leading filler ('The image shows ', 'Title: ', ...)
+    def clean(self, text, prefixes):
+        return strip_phrases(prefixes, strip_phrases(self.common_removals, text))
+
+    def title(self, title):
+        m = QUOTED.search(title)
+        if m is not None:
+            title = m.group(1)
+        m = TAGGED.search(title)
+        if m is not None:
+            title = m.group(1)
+
+        title = self.clean(title, self.title_prefixes).strip()
+        if title.endswith('.'):
+            title = title[:-1]
+
+        # capitalize just the first letter; leave rest of title intact
+        if ' ' in title:
+            temp = title.split(' ', 1)
+            title = temp[0].capitalize() + ' ' + temp[1]
+        return title
+
+    def description(self, description):
+        description = description.strip()
+        if description.startswith('"') and description.endswith('"'):
+            description = description.replace('"', '')
+        description = self.clean(description.capitalize(), self.description_prefixes)
+
+        # capitalize every sentence
+        description = '. '.join(sentence.capitalize() for sentence in description.split('. ')).strip()
+        if not description.endswith('.'):
+            description += '.'
+        else:
+            description = description.rstrip('.') + '.'
+        return description.capitalize()
+
+    # comma-separated keyword answer -> list of unique keywords, in order of first appearance
+    # multi-word keywords are broken into single words
+    # (no removal phrase contains a comma, so they are stripped from the whole answer at once)
+    def keywords(self, keywords):
+        final = {}
+        for kw in strip_phrases(self.keyword_removals, keywords.lower()).split(','):
+            for suffix in ('.', '.', "'s"):
+                if kw.endswith(suffix):
+                    kw = kw[:-len(suffix)]
+            kw = kw.strip()
+            if kw == '' or kw in self.keyword_stopwords:
+                continue
+            if ' ' in kw:
+                for word in kw.split(' '):
+                    word = word.strip()
+                    if word != '' and word not in self.keyword_word_stopwords:
+                        final[word] = None
+            else:
+                final[kw] = None
+        return list(final)
@@ -0,0 +1,387 @@
+# Copyright 2021 - 2023, Bill Kennedy (https://github.com/rbbrdckybk/MiniGPT-4)
+# SPDX-License-Identifier: MIT
+
+# writes IPTC (and optionally XMP) metadata into JPEG files for metadata-tagger.py
+# only the header segments are parsed and rewritten: the APP13 Photoshop block holding the IPTC
+# data (which may span several segments) and the APP1 XMP packet are replaced (other Photoshop resources, IPTC fields and XMP
+# properties are kept) and the rest of the file (the compressed image) is copied across in
+# large chunks, so each image is read once and written once
+# output goes to a temporary file that atomically replaces the target: a 'tagged' copy next
+# to the original, or the original itself with in_place=True
+
+import io
+import os
+import queue
+import shutil
+import struct
+import threading
+import uuid
+import xml.etree.ElementTree as ET
+
+# JPEG markers
+SOI = 0xD8
+EOI = 0xD9
+SOS = 0xDA
+APP0 = 0xE0
+APP1 = 0xE1
+APP13 = 0xED
+
+EXIF_HEADER = b'Exif\x00\x00'
+XMP_HEADER = b'http://ns.adobe.com/xap/1.0/\x00'
+PHOTOSHOP_HEADER = b'Photoshop 3.0\x00'
+# Photoshop image resource holding the IPTC-IIM datasets
+IPTC_RESOURCE = 0x0404
+# largest segment payload (the 2-byte length counts itself)
+MAX_SEGMENT = 65533
+COPY_CHUNK = 1024 * 1024
+
+# IPTC-IIM datasets written here, as (record, dataset), and their maximum lengths in bytes
+CHARSET = (1, 90)
+RECORD_VERSION = (2, 0)
+OBJECT_NAME = (2, 5)
+KEYWORDS = (2, 25)
+COPYRIGHT = (2, 116)
+CAPTION = (2, 120)
+IIM_LIMITS = { OBJECT_NAME: 64, KEYWORDS: 64, COPYRIGHT: 128, CAPTION: 2000 }
+# ISO 2022 escape sequence declaring UTF-8 text
+UTF8 = b'\x1b%G'
+
+# XMP namespaces
+NS_X = 'adobe:ns:meta/'
+NS_RDF = 'http://www.w3.org/1999/02/22-rdf-syntax-ns#'
+NS_DC = 'http://purl.org/dc/elements/1.1/'
+NS_XML = 'http://www.w3.org/XML/1998/namespace'
+DC_FIELDS = ('title', 'description', 'subject', 'rights')
+# prefixes every packet is written with
+XMP_PREFIXES = (('x', NS_X), ('rdf', NS_RDF), ('dc', NS_DC))
+XPACKET_BEGIN = '<?xpacket begin="﻿" id="W5M0MpCehiHzreSzNTczkc9d"?>\n'
+XPACKET_END = '\n<?xpacket end="w"?>'
+# whitespace left in the XMP packet so other tools can edit it in place
+XMP_PADDING = 2048
+
+# ElementTree's prefix map is global, so a packet's own prefixes are registered and the packet
+# serialized under this lock, or writer threads could rename each other's prefixes
+namespace_lock = threading.Lock()
+for prefix, uri in XMP_PREFIXES:
+    ET.register_namespace(prefix, uri)
+
+
+# header segments of a JPEG up to the start of the image data, as (marker, payload) pairs
+# (payload None for markers without one); returns (segments, marker that ended the header),
+# leaving f just after that marker
+def read_segments(f):
+    if f.read(2) != b'\xff\xd8':
+        raise ValueError('not a JPEG file')
+    segments = []
+    while True:
+        if f.read(1) != b'\xff':
+            raise ValueError('corrupt JPEG (expected a marker)')
+        marker = f.read(1)
+        # any number of 0xff fill bytes may come before a marker
+        while marker == b'\xff':
+            marker = f.read(1)
+        if marker == b'':
+            raise ValueError('truncated JPEG')
+        m = marker[0]
+        if m == SOS or m == EOI:
+            return segments, m
+        if 0xD0 <= m <= 0xD7 or m == 0x01:
+            segments.append((m, None))
+            continue
+        length = f.read(2)
+        if len(length) < 2:
+            raise ValueError('truncated JPEG')
+        payload = f.read(struct.unpack('>H', length)[0] - 2)
+        segments.append((m, payload))
+
+def segment(marker, payload):
+    if len(payload) > MAX_SEGMENT:
+        raise ValueError('metadata segment is too large (' + str(len(payload)) + ' bytes)')
+    return struct.pack('>BBH', 0xFF, marker, len(payload) + 2) + payload
+
+# text as UTF-8, cut to at most limit bytes without splitting a character
+def iim_text(text, limit):
+    data = text.encode('utf-8')
+    if len(data) > limit:
+        data = data[:limit].decode('utf-8', 'ignore').encode('utf-8')
+    return data
+
+
+# IPTC-IIM datasets as ((record, dataset), value bytes) pairs
+def parse_iim(data):
+    datasets = []
+    offset = 0
+    while offset + 5 <= len(data) and data[offset] == 0x1C:
+        record, dataset, length = struct.unpack('>BBH', data[offset + 1:offset + 5])
+        offset += 5
+        if length & 0x8000:
+            # extended dataset: the length field gives the size of the real length
+            size = length & 0x7FFF
+            length = int.from_bytes(data[offset:offset + size], 'big')
+            offset += size
+        datasets.append(((record, dataset), data[offset:offset + length]))
+        offset += length
+    return datasets
+
+def pack_iim(datasets):
+    out = []
+    for (record, dataset), value in datasets:
+        if len(value) < 0x8000:
+            out.append(struct.pack('>BBBH', 0x1C, record, dataset, len(value)))
+        else:
+            out.append(struct.pack('>BBBHI', 0x1C, record, dataset, 0x8004, len(value)))
+        out.append(value)
+    return b''.join(out)
+
+# existing IPTC datasets with title, caption, keywords & copyright replaced; everything else is
+# kept, and the text is declared as UTF-8
+def build_iim(existing, title, description, keywords, copyright):
+    replaced = (CHARSET, OBJECT_NAME, KEYWORDS, COPYRIGHT, CAPTION)
+    datasets = [(tag, value) for tag, value in parse_iim(existing) if tag not in replaced]
+    datasets.append((CHARSET, UTF8))
+    if not any(tag == RECORD_VERSION for tag, _ in datasets):
+        datasets.append((RECORD_VERSION, struct.pack('>H', 4)))
+    datasets.append((OBJECT_NAME, iim_text(title, IIM_LIMITS[OBJECT_NAME])))
+    datasets.append((CAPTION, iim_text(description, IIM_LIMITS[CAPTION])))
+    for keyword in keywords:
+        datasets.append((KEYWORDS, iim_text(keyword, IIM_LIMITS[KEYWORDS])))
+    if copyright != '':
+        datasets.append((COPYRIGHT, iim_text(copyright, IIM_LIMITS[COPYRIGHT])))
+    # records & datasets in ascending order (stable, so keywords keep theirs)
+    datasets.sort(key=lambda d: d[0])
+    return pack_iim(datasets)
+
+
+# Photoshop image resources as (id, name, data) triples
+def parse_resources(data):
+    resources = []
+    offset = 0
+    while offset + 12 <= len(data) and data[offset:offset + 4] == b'8BIM':
+        resource_id = struct.unpack('>H', data[offset + 4:offset + 6])[0]
+        offset += 6
+        # Pascal string name, padded to an even size
+        name_size = data[offset] + 1
+        name = data[offset:offset + name_size]
+        offset += name_size + (name_size % 2)
+        size = struct.unpack('>I', data[offset:offset + 4])[0]
+        offset += 4
+        resources.append((resource_id, name, data[offset:offset + size]))
+        offset += size + (size % 2)
+    return resources
+
+def pack_resources(resources):
+    out = []
+    for resource_id, name, data in resources:
+        out.append(b'8BIM' + struct.pack('>H', resource_id) + name + (b'\x00' if len(name) % 2 else b''))
+        out.append(struct.pack('>I', len(data)) + data + (b'\x00' if len(data) % 2 else b''))
+    return b''.join(out)
+
+
+def xmp_alt(parent, tag, text):
+    alt = ET.SubElement(ET.SubElement(parent, tag), '{%s}Alt' % NS_RDF)
+    li = ET.SubElement(alt, '{%s}li' % NS_RDF)
+    li.set('{%s}lang' % NS_XML, 'x-default')
+    li.text = text
+
+# XMP packet with dc:title, dc:description, dc:subject & dc:rights set; the other properties of
+# an existing packet are kept (a packet that can't be parsed is replaced)
+# padding is whitespace for in-place edits, which sidecar files don't need
+def build_xmp(existing, title, description, keywords, copyright, padding=XMP_PADDING):
+    root = None
+    # the packet's own prefixes (xmp:, photoshop:, ...), kept rather than becoming ns0:, ns1:, ...
+    prefixes = []
+    if existing is not None:
+        try:
+            prefixes = [ns for _, ns in ET.iterparse(io.BytesIO(existing), events=('start-ns',)) if ns[0] != '']
+            root = ET.fromstring(existing)
+        except ET.ParseError as e:
+            print('Warning: replacing unreadable XMP packet: ' + str(e))
+    if root is None:
+        root = ET.Element('{%s}xmpmeta' % NS_X)
+    rdf = root if root.tag == '{%s}RDF' % NS_RDF else root.find('{%s}RDF' % NS_RDF)
+    if rdf is None:
+        rdf = ET.SubElement(root, '{%s}RDF' % NS_RDF)
+    descriptions = rdf.findall('{%s}Description' % NS_RDF)
+    for d in descriptions:
+        for field in DC_FIELDS:
+            d.attrib.pop('{%s}%s' % (NS_DC, field), None)
+            for child in d.findall('{%s}%s' % (NS_DC, field)):
+                d.remove(child)
+    if len(descriptions) > 0:
+        target = descriptions[0]
+    else:
+        target = ET.SubElement(rdf, '{%s}Description' % NS_RDF)
+        target.set('{%s}about' % NS_RDF, '')
+
+    xmp_alt(target, '{%s}title' % NS_DC, title)
+    xmp_alt(target, '{%s}description' % NS_DC, description)
+    bag = ET.SubElement(ET.SubElement(target, '{%s}subject' % NS_DC), '{%s}Bag' % NS_RDF)
+    for keyword in keywords:
+        ET.SubElement(bag, '{%s}li' % NS_RDF).text = keyword
+    if copyright != '':
+        xmp_alt(target, '{%s}rights' % NS_DC, copyright)
+
+    with namespace_lock:
+        for prefix, uri in prefixes:
+            try:
+                ET.register_namespace(prefix, uri)
+            except ValueError:
+                pass
+        # ours win if the packet used one of their prefixes for something else
+        for prefix, uri in XMP_PREFIXES:
+            ET.register_namespace(prefix, uri)
+        body = ET.tostring(root, encoding='unicode')
+    packet = (XPACKET_BEGIN + body + '\n' + ' ' * padding + XPACKET_END).encode('utf-8')
+    if len(XMP_HEADER) + len(packet) > MAX_SEGMENT:
+        # drop the padding before giving up
+        packet = (XPACKET_BEGIN + body + XPACKET_END).encode('utf-8')
+    return packet
+
+
+class MetadataWriter:
+    # in_place rewrites the original; otherwise a copy is written to output_dir next to it
+    # durable fsyncs each file before it replaces the target (see BackgroundWriter for the
+    # directory sync)
+    def __init__(self, in_place=False, xmp=False, output_dir='tagged', durable=False):
+        self.in_place = in_place
+        self.xmp = xmp
+        self.output_dir = output_dir
+        self.durable = durable
+
+    def output_path(self, path):
+        if self.in_place:
+            return path
+        return os.path.join(os.path.dirname(path), self.output_dir, os.path.basename(path))
+
+    # new header segments: the existing ones with our APP13 (and APP1 XMP) in place of theirs,
+    # placed after the leading JFIF/Exif segments
+    def build_header(self, segments, title, description, keywords, copyright):
+        photoshop = []
+        xmp = None
+        kept = []
+        for marker, payload in segments:
+            if marker == APP13 and payload.startswith(PHOTOSHOP_HEADER):
+                # a block too large for one segment continues in the next, so join them first
+                photoshop.append(payload[len(PHOTOSHOP_HEADER):])
+            elif marker == APP1 and payload.startswith(XMP_HEADER) and self.xmp:
+                xmp = payload[len(XMP_HEADER):].rstrip(b'\x00')
+            else:
+                kept.append((marker, payload))
+
+        resources = parse_resources(b''.join(photoshop))
+        existing = b''.join(data for resource_id, _, data in resources if resource_id == IPTC_RESOURCE)
+        iptc = (IPTC_RESOURCE, b'\x00', build_iim(existing, title, description, keywords, copyright))
+        position = next((i for i, r in enumerate(resources) if r[0] == IPTC_RESOURCE), len(resources))
+        resources = [r for r in resources if r[0] != IPTC_RESOURCE]
+        resources.insert(min(position, len(resources)), iptc)
+        new = []
+        if self.xmp:
+            new.append(segment(APP1, XMP_HEADER + build_xmp(xmp, title, description, keywords, copyright)))
+        block = pack_resources(resources)
+        step = MAX_SEGMENT - len(PHOTOSHOP_HEADER)
+        for start in range(0, max(len(block), 1), step):
+            new.append(segment(APP13, PHOTOSHOP_HEADER + block[start:start + step]))
+
+        out = [b'\xff\xd8']
+        i = 0
+        while i < len(kept) and (kept[i][0] == APP0 or (kept[i][0] == APP1 and kept[i][1].startswith(EXIF_HEADER))):
+            out.append(segment(*kept[i]))
+            i += 1
+        out.extend(new)
+        for marker, payload in kept[i:]:
+            out.append(struct.pack('>BB', 0xFF, marker) if payload is None else segment(marker, payload))
+        return b''.join(out)
+
+    # write metadata for one image; returns the path written
+    def write(self, path, title, description, keywords, copyright=''):
+        out = self.output_path(path)
+        os.makedirs(os.path.dirname(out) or '.', exist_ok=True)
+        temp = out + '.' + uuid.uuid4().hex + '.tmp'
+        try:
+            with open(path, 'rb') as src, open(temp, 'wb') as dst:
+                segments, marker = read_segments(src)
+                dst.write(self.build_header(segments, title, description, keywords, copyright))
+                dst.write(struct.pack('>BB', 0xFF, marker))
+                shutil.copyfileobj(src, dst, COPY_CHUNK)
+                if self.durable:
+                    dst.flush()
+                    os.fsync(dst.fileno())
+            shutil.copymode(path, temp)
+            os.replace(temp, out)
+        except BaseException:
+            if os.path.exists(temp):
+                os.remove(temp)
+            raise
+        return out
+
+
+# runs a MetadataWriter on a background thread so callers don't wait on disk
+# queued writes are taken in batches; with a durable writer each batch ends with one fsync
+# per directory touched, making the renames themselves durable
+class BackgroundWriter:
+    def __init__(self, writer, max_pending=64, batch=32):
+        self.writer = writer
+        self.batch = batch
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.thread = threading.Thread(target=self.run, name='metadata-writer', daemon=True)
+        self.thread.start()
+
+    # queue a write (blocks while max_pending writes are waiting); done(path, output, error)
+    # is called on the writer thread afterwards, with output None and error set on failure
+    def submit(self, path, title, description, keywords, copyright='', done=None):
+        self.queue.put((path, title, description, keywords, copyright, done))
+
+    # finish the queued writes and stop the thread
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def run(self):
+        stopping = False
+        while not stopping:
+            item = self.queue.get()
+            if item is None:
+                break
+            items = [item]
+            while len(items) < self.batch:
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                items.append(item)
+            results = []
+            dirs = set()
+            for path, title, description, keywords, copyright, done in items:
+                try:
+                    output = self.writer.write(path, title, description, keywords, copyright)
+                    dirs.add(os.path.dirname(output) or '.')
+                    results.append((done, path, output, None))
+                except Exception as e:
+                    results.append((done, path, None, e))
+            if self.writer.durable:
+                for d in dirs:
+                    try:
+                        sync_dir(d)
+                    except OSError as e:
+                        print('Error: unable to sync ' + d + ': ' + str(e))
+            # an error in a callback (e.g. recording the write) mustn't stop the thread, or
+            # submit() would block forever once max_pending writes are waiting
+            for done, path, output, error in results:
+                if done is not None:
+                    try:
+                        done(path, output, error)
+                    except Exception as e:
+                        print('Error: unable to report the metadata write for ' + path + ': ' + str(e))
+
+# make renames within a directory durable (not supported on Windows)
+def sync_dir(path):
+    if not hasattr(os, 'O_DIRECTORY'):
+        return
+    fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
@@ -2,64 +2,207 @@
 # SPDX-License-Identifier: MIT
 # adapted from api-client-example.py
 
+import asyncio
 import requests
+import urllib3
 import json
+import threading
+import time
 from os.path import exists
 
+# connection pool shared by every MiniGPT4_Client in this process (keep-alive connections
+# are reused across requests and across client instances)
+http_lock = threading.Lock()
+http_sessions = {}
+def shared_http_session(pool_size=32):
+    with http_lock:
+        if pool_size not in http_sessions:
+            http = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            http.mount('http://', adapter)
+            http.mount('https://', adapter)
+            http_sessions[pool_size] = http
+        return http_sessions[pool_size]
+
+# whether a server response means "busy, try again later"
+def server_busy(status, text):
+    if status in (429, 503):
+        return True
+    return 'currently working on another request' in text
+
+# whether a request that failed with a connection error can be sent again: GETs always can,
+# anything else only if the connection was never made (refused, or timed out connecting), since
+# a request that failed later may already have been acted on (e.g. a question added to the
+# conversation before the connection dropped)
+def retry_safe(method, error):
+    if method.upper() == 'GET' or isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], 'reason', None) if len(error.args) > 0 else None
+    return isinstance(reason, urllib3.exceptions.NewConnectionError)
+
+# image file contents and mime type for an upload
+def read_image(img):
+    mime = 'image/jpeg'
+    if img.lower().endswith('.png'):
+        mime = 'image/png'
+    elif img.lower().endswith(('.tif', '.tiff')):
+        mime = 'image/tiff'
+    with open(img, 'rb') as f:
+        return f.read(), mime
+
 class MiniGPT4_Client:
-    def __init__(self, debug=False):
-        self.url = 'http://localhost:5000'
+    # timeout is (connect, read) seconds; busy responses and connection errors are retried (other
+    # than GETs, only errors connecting, see retry_safe)
+    # up to retries times, waiting backoff seconds and doubling each time (or the server's Retry-After)
+    def __init__(self, debug=False, url='http://localhost:5000', timeout=(5, 600), retries=5, backoff=0.5, http=None):
+        self.url = url.rstrip('/')
+        # server-side session id, assigned by the server on the first upload
+        self.session = ''
         self.debug = debug
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.http = http if http is not None else shared_http_session()
 
-    # reset the MiniGPT-4 session
+    # sends a request over the pooled session, retrying while the server is busy
+    def request(self, method, path, **kwargs):
+        delay = self.backoff
+        for attempt in range(self.retries + 1):
+            try:
+                r = self.http.request(method, self.url + path, timeout=self.timeout, **kwargs)
+            except requests.exceptions.ConnectionError as e:
+                if attempt == self.retries or not retry_safe(method, e):
+                    raise
+                wait = delay
+            else:
+                if attempt == self.retries or not server_busy(r.status_code, r.text if not kwargs.get('stream') else ''):
+                    return r
+                wait = max(delay, float(r.headers.get('Retry-After', 0)))
+                r.close()
+            if self.debug:
+                print('Server busy; retrying in ' + str(round(wait, 2)) + ' seconds...')
+            time.sleep(wait)
+            delay *= 2
+
+    # get the MiniGPT-4 server status
     def server_status(self):
         if self.debug:
             print('\nRequesting server status...')
-        url = self.url + '/api/v1/status'
-        r = requests.request("GET", url)
+        r = self.request("GET", '/api/v1/status')
         return r.text
 
     # reset the MiniGPT-4 session
     def server_reset(self):
         if self.debug:
             print('\nRequesting server reset...')
-        url = self.url + '/api/v1/reset'
-        r = requests.request("GET", url)
+        payload = {"session": self.session}
+        r = self.request("GET", '/api/v1/reset', params=payload)
+        return r.text
+
+    # discard this client's server-side session
+    def server_close(self):
+        if self.debug:
+            print('\nClosing server session...')
+        payload = {"session": self.session}
+        r = self.request("GET", '/api/v1/close', params=payload)
+        self.session = ''
         return r.text
 
     # send an image to MiniGPT-4
     # img is the image filename including path
+    # the first upload creates a server session; later uploads replace the image in it
     def upload(self, img):
         if self.debug:
             print('\nUploading image to server (' + img + ')...')
         if exists(img):
-            url = self.url + '/api/v1/upload'
-            payload = {}
-            mime = 'image/jpeg'
-            if img.lower().endswith('.png'):
-                mime = 'image/png'
-            files = [ ('file', (img, open(img,'rb'), mime)) ]
-            r = requests.request("POST", url, data=payload, files=files)
+            payload = {"session": self.session}
+            data, mime = read_image(img)
+            files = [ ('file', (img, data, mime)) ]
+            r = self.request("POST", '/api/v1/upload', data=payload, files=files)
+            self.update_session(r.text)
             return r.text
         else:
             print('Error: attempt to upload image that does not exist: ' + img)
             return ''
 
     # ask the MiniGPT-4 server a question
-    def ask(self, message):
+    # params are optional generation settings sent along with it: temperature (0 = greedy, and
+    # cacheable by the server), top_p, max_new_tokens, no_cache
+    def ask(self, message, **params):
         if self.debug:
             print('\nSending query to server ("' + message + '")...')
-        url = self.url + '/api/v1/ask'
-        payload = {"message": message}
-        r = requests.request("POST", url, data=payload)
+        payload = dict(params, message=message, session=self.session)
+        r = self.request("POST", '/api/v1/ask', data=payload)
+        return r.text
+
+    # ask the MiniGPT-4 server a question and receive the answer as it is generated
+    # yields parsed JSON lines: {"token": ...} pieces, then a final {"done": true, "response": ...}
+    # line that also reports time to first token and tokens/sec
+    def ask_stream(self, message, **params):
+        if self.debug:
+            print('\nSending streaming query to server ("' + message + '")...')
+        payload = dict(params, message=message, session=self.session, stream='1')
+        with self.request("POST", '/api/v1/ask', data=payload, stream=True) as r:
+            if 'application/x-ndjson' not in r.headers.get('Content-Type', ''):
+                # error responses (e.g. queue full) are plain JSON
+                parsed = json.loads(r.text)
+                parsed['done'] = True
+                yield parsed
+                return
+            for line in r.iter_lines(decode_unicode=True):
+                if line:
+                    yield json.loads(line)
+
+    # send an image plus a list of questions in a single request
+    # prompts is a list of strings or {"prompt": ..., "followups": [...]} dicts (see /api/v1/analyze)
+    # the server closes the session afterwards unless keep is True; params are as for ask()
+    def analyze(self, img, prompts, keep=False, **params):
+        if self.debug:
+            print('\nSending image and ' + str(len(prompts)) + ' questions to server (' + img + ')...')
+        if exists(img):
+            payload = dict(params, prompts=json.dumps(prompts), keep='1' if keep else '0')
+            data, mime = read_image(img)
+            files = [ ('file', (img, data, mime)) ]
+            r = self.request("POST", '/api/v1/analyze', data=payload, files=files)
+            if keep:
+                self.update_session(r.text)
+            return r.text
+        else:
+            print('Error: attempt to upload image that does not exist: ' + img)
+            return ''
+
+    # upload several images in one request; the server encodes them together and starts a new
+    # session for each one (returned in request order in the response's "images" list)
+    # images that don't exist are skipped; the client's own session is left unchanged
+    def upload_batch(self, imgs):
+        files = []
+        for img in imgs:
+            if exists(img):
+                data, mime = read_image(img)
+                files.append(('file', (img, data, mime)))
+            else:
+                print('Error: attempt to upload image that does not exist: ' + img)
+        if len(files) == 0:
+            return ''
+        if self.debug:
+            print('\nUploading ' + str(len(files)) + ' images to server...')
+        r = self.request("POST", '/api/v1/upload_batch', files=files)
         return r.text
 
     # tell the MiniGPT-4 server to shut down
     def server_shutdown(self):
-        url = self.url + '/api/v1/shutdown'
-        r = requests.request("GET", url)
+        r = self.request("GET", '/api/v1/shutdown')
         return r.text
 
+    # remember the session id returned by the server
+    def update_session(self, r):
+        try:
+            parsed = json.loads(r)
+        except ValueError:
+            return
+        if parsed.get('success') and parsed.get('session'):
+            self.session = parsed['session']
+
     # r is a reponse from the MiniGPT-4 server
     def debug_response(self, r):
         if r != None and r != '':
@@ -68,3 +211,138 @@ class MiniGPT4_Client:
             print(json.dumps(parsed, indent=4))
         else:
             print('Empty response!')
+
+
+# asyncio counterpart of MiniGPT4_Client (requires aiohttp), for keeping many requests in
+# flight against one or more servers from a single event loop
+# unlike MiniGPT4_Client it holds no conversation state of its own: upload/analyze return the
+# server's session id and later calls take it explicitly; new sessions go to the server with the
+# fewest requests in flight, and later calls for a session are routed back to the same server
+class AsyncMiniGPT4_Client:
+    def __init__(self, urls='http://localhost:5000', debug=False, timeout=(5, 600), retries=5, backoff=0.5, max_connections=100):
+        import aiohttp
+        self.aiohttp = aiohttp
+        if isinstance(urls, str):
+            urls = [urls]
+        self.urls = [url.rstrip('/') for url in urls]
+        self.debug = debug
+        self.timeout = aiohttp.ClientTimeout(sock_connect=timeout[0], sock_read=timeout[1])
+        self.retries = retries
+        self.backoff = backoff
+        self.max_connections = max_connections
+        self.http = None
+        # session id -> server url
+        self.routes = {}
+        self.in_flight = dict((url, 0) for url in self.urls)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def close(self):
+        if self.http is not None:
+            await self.http.close()
+            self.http = None
+
+    def server_for(self, session):
+        if session in self.routes:
+            return self.routes[session]
+        return min(self.urls, key=lambda url: self.in_flight[url])
+
+    # sends a request, retrying while the server is busy; returns (status, text)
+    # data is a callable building the request body, since a multipart body can only be sent once
+    async def request(self, url, method, path, data=None, params=None):
+        if self.http is None:
+            self.http = self.aiohttp.ClientSession(timeout=self.timeout, connector=self.aiohttp.TCPConnector(limit=self.max_connections))
+        delay = self.backoff
+        self.in_flight[url] += 1
+        try:
+            for attempt in range(self.retries + 1):
+                try:
+                    async with self.http.request(method, url + path, data=data() if data is not None else None, params=params) as r:
+                        text = await r.text()
+                        if attempt == self.retries or not server_busy(r.status, text):
+                            return r.status, text
+                        wait = max(delay, float(r.headers.get('Retry-After', 0)))
+                except self.aiohttp.ClientConnectionError as e:
+                    # as in retry_safe: only GETs, or requests that never connected, are resent
+                    if attempt == self.retries or not (method.upper() == 'GET' or isinstance(e, self.aiohttp.ClientConnectorError)):
+                        raise
+                    wait = delay
+                if self.debug:
+                    print('Server busy; retrying in ' + str(round(wait, 2)) + ' seconds...')
+                await asyncio.sleep(wait)
+                delay *= 2
+        finally:
+            self.in_flight[url] -= 1
+
+    def image_form(self, img, data, mime, fields):
+        def build():
+            form = self.aiohttp.FormData()
+            for name, value in fields.items():
+                form.add_field(name, str(value))
+            form.add_field('file', data, filename=img, content_type=mime)
+            return form
+        return build
+
+    def remember(self, url, text):
+        try:
+            parsed = json.loads(text)
+        except ValueError:
+            return
+        if parsed.get('success') and parsed.get('session'):
+            self.routes[parsed['session']] = url
+
+    # get the status of every server; returns {url: response text}
+    async def server_status(self):
+        results = await asyncio.gather(*[self.request(url, 'GET', '/api/v1/status') for url in self.urls])
+        return dict((url, text) for url, (_, text) in zip(self.urls, results))
+
+    # send an image to MiniGPT-4; pass session to replace the image in an existing session
+    # the response's 'session' field identifies the session for later calls
+    async def upload(self, img, session=''):
+        if self.debug:
+            print('\nUploading image to server (' + img + ')...')
+        if not exists(img):
+            print('Error: attempt to upload image that does not exist: ' + img)
+            return ''
+        data, mime = read_image(img)
+        url = self.server_for(session)
+        _, text = await self.request(url, 'POST', '/api/v1/upload', data=self.image_form(img, data, mime, {"session": session}))
+        self.remember(url, text)
+        return text
+
+    # ask a question about the image in a session
+    async def ask(self, message, session, **params):
+        if self.debug:
+            print('\nSending query to server ("' + message + '")...')
+        _, text = await self.request(self.server_for(session), 'POST', '/api/v1/ask', data=lambda: dict(params, message=message, session=session))
+        return text
+
+    # send an image plus a list of questions in a single request (see MiniGPT4_Client.analyze)
+    async def analyze(self, img, prompts, keep=False, **params):
+        if self.debug:
+            print('\nSending image and ' + str(len(prompts)) + ' questions to server (' + img + ')...')
+        if not exists(img):
+            print('Error: attempt to upload image that does not exist: ' + img)
+            return ''
+        data, mime = read_image(img)
+        url = self.server_for('')
+        fields = dict(params, prompts=json.dumps(prompts), keep='1' if keep else '0')
+        _, text = await self.request(url, 'POST', '/api/v1/analyze', data=self.image_form(img, data, mime, fields))
+        if keep:
+            self.remember(url, text)
+        return text
+
+    async def server_reset(self, session):
+        _, text = await self.request(self.server_for(session), 'GET', '/api/v1/reset', params={"session": session})
+        return text
+
+    # discard a server-side session
+    async def server_close(self, session):
+        url = self.server_for(session)
+        self.routes.pop(session, None)
+        _, text = await self.request(url, 'GET', '/api/v1/close', params={"session": session})
+        return text
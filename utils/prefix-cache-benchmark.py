@@ -0,0 +1,104 @@
+# Copyright 2021 - 2023, Bill Kennedy (https://github.com/rbbrdckybk/MiniGPT-4)
+# SPDX-License-Identifier: MIT
+
+# Prefix Cache Benchmark
+# Replays the metadata tagger's conversation (title, description & keyword questions, plus
+# the occasional retry) against an in-process api-server.py running the fake backend, and
+# reports how many prompt positions the server had to prefill per image, as returned by
+# /api/v1/ask (prompt_tokens, of which cached_tokens were reused) and /api/v1/status (kv_cache).
+# Everything goes through the server's real prompt building and prefix cache; only the model
+# is simulated (token counts are the fake backend's word/punctuation tokens).
+# Runs on CPU in a few seconds; no model or GPU required (the server's Python packages must be
+# installed).
+
+# usage:
+# python prefix-cache-benchmark.py --images 100
+# python prefix-cache-benchmark.py --images 100 --server-args "--kv-cache-mb 0"
+
+import argparse
+import importlib
+import io
+import os
+import random
+import sys
+import time
+
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+server = importlib.import_module('api-server')
+
+# the tagger's prompts (see metadata-tagger.py)
+INITIAL_DIRECTION = 'You are a metadata generation machine designed to help describe images. Your responses will be used verbatim in image metadata and should not be conversational. Respond with only the answer and no context around why the answer is appropriate. '
+TITLE = INITIAL_DIRECTION + 'Generate an appropriate short title (just a few words) for this image. The title should accurately describe the most obvious visual elements of the image in as few words as possible. Avoid esoteric or abstract language.'
+SHORTEN = 'Shorten the title so that it is less than 10 words. Use plain descriptive language.'
+DESCRIPTION = INITIAL_DIRECTION + 'Write a short description (1-2 sentences) for this image. Stick to describing visual elements of the image without making comments about its origin or purpose.'
+KEYWORDS = INITIAL_DIRECTION + 'List at least 10 appropriate keywords for this image, separated by commas.'
+COMMAS = 'List the keywords on a single line, separated by commas.'
+
+
+# the tagger's question sequence for one image
+def questions(rng, retry_rate):
+    q = [TITLE]
+    if rng.random() < retry_rate:
+        q.append(SHORTEN)
+    q.append(DESCRIPTION)
+    q.append(KEYWORDS)
+    if rng.random() < retry_rate:
+        q.append(COMMAS)
+    return q
+
+# a small PNG that differs for every n, so each image gets its own embedding
+def image_bytes(n):
+    buf = io.BytesIO()
+    Image.new('RGB', (64, 64), (n % 256, (n // 256) % 256, 128)).save(buf, 'PNG')
+    return buf.getvalue()
+
+def check(r):
+    body = r.get_json()
+    if r.status_code != 200 or not body.get('success'):
+        print('Error: ' + str(body.get('message', r.status_code)))
+        sys.exit(1)
+    return body
+
+
+# entry point
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--images", type=int, default=100, help="number of images to simulate")
+    parser.add_argument("--retry-rate", type=float, default=0.2, help="fraction of images needing a shorten/commas retry")
+    parser.add_argument("--answer-tokens", type=int, default=20, help="length of every (fake) answer, in tokens")
+    parser.add_argument("--server-args", type=str, default='', help="extra api-server.py arguments, e.g. \"--kv-cache-mb 0\"")
+    parser.add_argument("--seed", type=int, default=0)
+    opt = parser.parse_args()
+
+    # no simulated latency: only the token counts matter here
+    app = server.create_app('--backend fake --fake-encode-ms 0 --fake-prefill-tokens-per-sec 1e12 --fake-tokens-per-sec 1e12 '
+                            + '--fake-answer-tokens ' + str(opt.answer_tokens) + ' ' + opt.server_args)
+    while not server.chat.ready():
+        if server.chat.state == 'failed':
+            print('Error: ' + server.chat.error)
+            sys.exit(1)
+        time.sleep(0.05)
+    client = app.test_client()
+
+    rng = random.Random(opt.seed)
+    total_prompt = 0
+    total_cached = 0
+    asks = 0
+    for n in range(opt.images):
+        r = check(client.post('/api/v1/upload', data={ 'file': (io.BytesIO(image_bytes(n)), 'image-' + str(n) + '.png') }, content_type='multipart/form-data'))
+        session = r['session']
+        for question in questions(rng, opt.retry_rate):
+            r = check(client.post('/api/v1/ask', json={ 'message': question, 'session': session }))
+            total_prompt += r['prompt_tokens']
+            total_cached += r['cached_tokens']
+            asks += 1
+        check(client.post('/api/v1/close', data={ 'session': session }))
+
+    kv = check(client.get('/api/v1/status'))['kv_cache']
+    print('Replayed ' + str(opt.images) + ' images, ' + str(asks) + ' asks (fake backend token counts)')
+    print('Prefill positions per image without cache: ' + str(round(total_prompt / opt.images, 1)))
+    print('Prefill positions per image with cache:    ' + str(round((total_prompt - total_cached) / opt.images, 1)))
+    print('Saved per image: ' + str(round(total_cached / opt.images, 1)) + ' (' + str(round(100 * total_cached / max(total_prompt, 1), 1)) + '%)')
+    print('Server kv_cache: ' + str(kv['prefill_tokens']) + ' tokens prefilled, ' + str(kv['reused_tokens']) + ' reused (ratio ' + str(kv['reuse_ratio']) + ')')
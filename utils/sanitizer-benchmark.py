@@ -0,0 +1,304 @@
+# Copyright 2021 - 2023, Bill Kennedy (https://github.com/rbbrdckybk/MiniGPT-4)
+# SPDX-License-Identifier: MIT
+
+# Sanitizer Benchmark
+# Times the metadata tagger's answer sanitization (metadata_sanitizer.py) against the original
+# chains of startswith/replace calls over a corpus of raw MiniGPT-4 answers, and counts the
+# answers where the two disagree. The corpus comes from a tagger manifest (--manifest), a JSONL
+# file of {"title": ..., "description": ..., "keywords": ...} lines (--corpus), or is generated.
+# Runs on CPU; no model or server required.
+
+# usage:
+# python sanitizer-benchmark.py --manifest metadata-tagger-manifest.db
+# python sanitizer-benchmark.py --answers 5000 --show-diffs 5
+
+import argparse
+import json
+import random
+import time
+
+import metadata_sanitizer
+
+# stand-in raw answers for the generated corpus
+TITLE_PREFIXES = ['', '', 'Title: ', 'Image Title: ', 'The image shows ', 'This painting depicts ', 'Image: ']
+TITLES = ['a family sitting on a couch', 'Sunset Over The Mountains', 'A red barn in a snowy field.',
+          '"Dog On The Beach"', 'an old man reading a newspaper', 'City Street At Night']
+DESCRIPTION_PREFIXES = ['', '', 'The image shows ', 'This image depicts ', 'Description: ', 'This is a painting of ']
+DESCRIPTIONS = ['a cartoon family of five sits together on a brown couch. there is a painting of a sailboat behind them.',
+                'the sun sets behind snowy mountains, casting an orange glow over a lake..',
+                '"a small dog runs along the shoreline with a ball in its mouth."',
+                'a busy street at night with neon signs and people walking in the rain']
+KEYWORDS = ['family', 'cartoon', 'couch', 'living room', 'painting', 'sailboat', 'television', 'sunset',
+            'mountains', 'lake', 'dog', 'beach', 'ocean waves', 'city street', 'neon lights', 'rain',
+            'image', 'visual elements', 'eye-catching colors', 'keywords: landscape', "artist's", 'detail',
+            'the night sky', 'vibrant color palette', 'focal point.', '<img>']
+
+
+# the original sanitizers from metadata-tagger.py, for comparison
+# common replacements to both title/description
+def legacy_sanitize_common(str):
+    # common things to remove at the start of text responses
+    if str.startswith('The image is of '):
+        str = str.replace('The image is of ', '')
+    if str.startswith('The image shows '):
+        str = str.replace('The image shows ', '')
+    if str.startswith('The image depicts '):
+        str = str.replace('The image depicts ', '')
+    if str.startswith('This image shows '):
+        str = str.replace('This image shows ', '')
+    if str.startswith('This image depicts '):
+        str = str.replace('This image depicts ', '')
+    if str.startswith('The painting is of '):
+        str = str.replace('The painting is of ', '')
+    if str.startswith('The painting shows '):
+        str = str.replace('The painting shows ', '')
+    if str.startswith('The painting depicts '):
+        str = str.replace('The painting depicts ', '')
+    if str.startswith('This painting shows '):
+        str = str.replace('This painting shows ', '')
+    if str.startswith('This painting depicts '):
+        str = str.replace('This painting depicts ', '')
+    if str.startswith('This is an image of '):
+        str = str.replace('This is an image of ', '')
+    if str.startswith('This is a painting of '):
+        str = str.replace('This is a painting of ', '')
+    if str.startswith('This image features '):
+        str = str.replace('This image features ', '')
+    if str.startswith('The image is '):
+        str = str.replace('The image is ', '')
+    if str.startswith('This image is '):
+        str = str.replace('This image is ', '')
+    if str.startswith('The painting is '):
+        str = str.replace('The painting is ', '')
+    if str.startswith('This painting is '):
+        str = str.replace('This painting is ', '')
+    if str.startswith('Image of a '):
+        str = str.replace('Image of a ', '')
+    if str.startswith('Image content: '):
+        str = str.replace('Image content: ', '')
+    if str.startswith('Image: '):
+        str = str.replace('Image: ', '')
+
+    # common things to replace/remove
+    str = str.replace('<Img>', '')
+    str = str.replace('</Img>', '')
+    str = str.replace('<img>', '')
+    str = str.replace('</img>', '')
+
+    return str
+
+# for sanitizing MiniGPT-4 output
+def legacy_sanitize_title(title):
+    if '"' in title:
+        temp = title.split('"', 1)[1]
+        if '"' in temp:
+            title = temp.split('"', 1)[0]
+    if '>' in title:
+        temp = title.split('>', 1)[1]
+        if '<' in temp:
+            title = temp.split('<', 1)[0]
+
+    title = legacy_sanitize_common(title)
+    if title.startswith('Image Title: '):
+        title = title.replace('Image Title: ', '')
+    if title.startswith('Title: '):
+        title = title.replace('Title: ', '')
+
+    title = title.strip()
+    if title.endswith('.'):
+        title = title[:-1]
+
+    # capitalize just the first letter; leave rest of title intact
+    if ' ' in title:
+        temp = title.split(' ', 1)
+        title = temp[0].capitalize() + ' ' + temp[1]
+
+    return title
+
+def legacy_sanitize_description(description):
+    description = description.strip()
+    if description.startswith('"') and description.endswith('"'):
+        description = description.replace('"', '')
+    description = description.capitalize()
+
+    # remove some common MiniGPT-4 extra wordiness
+    description = legacy_sanitize_common(description)
+    if description.startswith('Image Description: '):
+        description = description.replace('Image Description: ', '')
+    if description.startswith('Description: '):
+        description = description.replace('Description: ', '')
+
+    # capitalize every sentence
+    sentences = description.split('. ')
+    final = ''
+    for sentence in sentences:
+        final += sentence.capitalize()
+        final += '. '
+    final = final.strip()
+    description = final
+
+    if not description.endswith('.'):
+        description += '.'
+    else:
+        while description.endswith('..'):
+            description = description[:-1]
+
+    description = description.capitalize()
+    return description
+
+def legacy_sanitize_keywords(keywords):
+    keywords = keywords.split(',')
+    final_keywords = []
+
+    # remove/sanitize unwanted keywords
+    for kw in keywords:
+        if kw.endswith('.'):
+            kw = kw[:-1]
+
+        kw = kw.lower()
+        if kw.endswith('.'):
+            kw = kw[:-1]
+        if kw.endswith("'s"):
+            kw = kw[:-2]
+        kw = kw.replace('keywords: ', '')
+        kw = kw.replace('keyword: ', '')
+        kw = kw.replace('keywords', '')
+        kw = kw.replace('keyword', '')
+        kw = kw.replace('image metadata', '')
+        kw = kw.replace('visual elements', '')
+        kw = kw.replace('visual pattern', '')
+        kw = kw.replace('intricate designs', '')
+        kw = kw.replace('no other elements visible', '')
+        kw = kw.replace('description', '')
+        kw = kw.replace('descriptive words', '')
+        kw = kw.replace('descriptive language', '')
+        kw = kw.replace('visual interest', '')
+        kw = kw.replace('additional information', '')
+        kw = kw.replace('visually appealing', '')
+        kw = kw.replace('details', '')
+        kw = kw.replace('detail', '')
+        kw = kw.replace('</img>', '')
+        kw = kw.replace('<img>', '')
+        kw = kw.replace('eye-catching', '')
+
+        kw = kw.replace(' appearance', '')
+        kw = kw.replace(' element', '')
+        kw = kw.replace(' position', '')
+
+        kw = kw.strip()
+
+        if kw == 'image' or kw == 'metadata' or kw == 'appropriate':
+            kw = ''
+
+        if kw == 'descriptive' or kw == 'detail':
+            kw = ''
+
+        if kw != '':
+            final_keywords.append(kw)
+    final_keywords = [*set(final_keywords)]
+
+    # break multi-word keywords into single words
+    temp = []
+    for kw in final_keywords:
+        if ' ' in kw:
+            p = kw.split(' ')
+            for k in p:
+                k = k.strip()
+                if k == 'a' or k == 'in' or k == 'with' or k == 'the' or k == 'and':
+                    k = ''
+                if k == 'for' or k == 'not' or k == 'of' or k == '1.' or k == 'context':
+                    k = ''
+                if k == 'no' or k == 'setting' or k == 'colors' or k == 'color' or k == 'quality':
+                    k = ''
+                if k == 'focal' or k == 'appropriate' or k == 'image' or k == 'this':
+                    k = ''
+                if k == 'an' or k == 'or' or k == '-' or k == 'on' or k == 'image:':
+                    k = ''
+                if k == 'are':
+                    k = ''
+
+                if k != '':
+                    temp.append(k)
+        else:
+            temp.append(kw)
+    final_keywords = [*set(temp)]
+
+    return final_keywords
+
+
+def generate_corpus(rng, n):
+    corpus = []
+    for _ in range(n):
+        keywords = rng.sample(KEYWORDS, rng.randint(6, 14))
+        corpus.append((rng.choice(TITLE_PREFIXES) + rng.choice(TITLES),
+                       rng.choice(DESCRIPTION_PREFIXES) + rng.choice(DESCRIPTIONS),
+                       ', '.join(keywords) + rng.choice(['', '.'])))
+    return corpus
+
+def load_corpus(opt):
+    if opt.manifest != '':
+        import tagger_manifest
+        manifest = tagger_manifest.Manifest(opt.manifest)
+        rows = [row[1:] for row in manifest.answered()]
+        manifest.close()
+        return rows
+    if opt.corpus != '':
+        with open(opt.corpus, 'r', encoding='utf-8') as f:
+            lines = [json.loads(line) for line in f if line.strip() != '']
+        return [(line.get('title', ''), line.get('description', ''), line.get('keywords', '')) for line in lines]
+    return generate_corpus(random.Random(opt.seed), opt.answers)
+
+def run(corpus, title, description, keywords):
+    return [(title(t), description(d), keywords(k)) for t, d, k in corpus]
+
+# best of several runs, in seconds
+def time_run(corpus, repeat, *fns):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run(corpus, *fns)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+# entry point
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--manifest", type=str, default='', help="tagger manifest whose stored raw answers make up the corpus")
+    parser.add_argument("--corpus", type=str, default='', help="JSONL file of raw title/description/keywords answers")
+    parser.add_argument("--answers", type=int, default=2000, help="size of the generated corpus")
+    parser.add_argument("--config", type=str, default='', help="sanitizer config (default metadata-sanitizer.json)")
+    parser.add_argument("--repeat", type=int, default=5, help="timed runs per implementation (best is reported)")
+    parser.add_argument("--show-diffs", type=int, default=0, help="print up to this many answers where the two disagree")
+    parser.add_argument("--seed", type=int, default=0)
+    opt = parser.parse_args()
+
+    corpus = load_corpus(opt)
+    if len(corpus) == 0:
+        print('Error: the corpus is empty!')
+        raise SystemExit(1)
+    start = time.perf_counter()
+    sanitizer = metadata_sanitizer.Sanitizer.load(opt.config or None)
+    compile_ms = (time.perf_counter() - start) * 1000
+
+    legacy_fns = (legacy_sanitize_title, legacy_sanitize_description, legacy_sanitize_keywords)
+    fns = (sanitizer.title, sanitizer.description, sanitizer.keywords)
+    legacy_seconds = time_run(corpus, opt.repeat, *legacy_fns)
+    seconds = time_run(corpus, opt.repeat, *fns)
+
+    # keywords are compared as sets; the original implementation returns them in arbitrary order
+    diffs = []
+    for raw, old, new in zip(corpus, run(corpus, *legacy_fns), run(corpus, *fns)):
+        if old[0] != new[0] or old[1] != new[1] or set(old[2]) != set(new[2]):
+            diffs.append((raw, old, new))
+
+    print('Sanitized ' + str(len(corpus)) + ' answer sets (best of ' + str(opt.repeat) + ' runs)')
+    print('Config load & compile: ' + str(round(compile_ms, 2)) + ' ms')
+    print('Original:  ' + str(round(legacy_seconds * 1e6 / len(corpus), 1)) + ' us per answer set')
+    print('Sanitizer: ' + str(round(seconds * 1e6 / len(corpus), 1)) + ' us per answer set (' + str(round(legacy_seconds / seconds, 2)) + 'x)')
+    print('Answer sets with different output: ' + str(len(diffs)) + ' (' + str(round(100 * len(diffs) / len(corpus), 1)) + '%)')
+    for raw, old, new in diffs[:opt.show_diffs]:
+        print('\nRaw:       ' + json.dumps(raw))
+        print('Original:  ' + json.dumps([old[0], old[1], sorted(old[2])]))
+        print('Sanitizer: ' + json.dumps([new[0], new[1], sorted(new[2])]))
@@ -0,0 +1,128 @@
+# Copyright 2021 - 2023, Bill Kennedy (https://github.com/rbbrdckybk/MiniGPT-4)
+# SPDX-License-Identifier: MIT
+
+# image discovery for metadata-tagger.py
+# walks a directory tree lazily, yielding matching images as they are found (so tagging starts
+# right away, even on trees with millions of files), with glob, extension, size & mtime filters
+# and stable hash sharding so several tagger processes can split one tree between them
+
+import fnmatch
+import os
+import zlib
+from datetime import datetime
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.tif', '.tiff')
+# subdirectories the tagger writes its own output to; never scanned
+OUTPUT_DIRS = ('tagged',)
+
+# '10M' -> 10485760; plain numbers are bytes
+def parse_size(text):
+    text = text.strip().upper()
+    units = { 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3 }
+    if text != '' and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+# '2023-05-01' or '2023-05-01T12:00:00' -> POSIX timestamp (local time)
+def parse_time(text):
+    return datetime.fromisoformat(text.strip()).timestamp()
+
+# '1/4' -> (1, 4): this process takes the images whose path hashes to 1 out of 4 shards
+def parse_shard(text):
+    index, count = (int(x) for x in text.split('/'))
+    if count < 1 or not 0 <= index < count:
+        raise ValueError('shard must be INDEX/COUNT with 0 <= INDEX < COUNT')
+    return index, count
+
+# shard of a path relative to the scanned directory, so every process (and every rerun) agrees
+# no matter where the tree is mounted
+def shard_of(rel_path, count):
+    return zlib.crc32(rel_path.encode('utf-8', 'surrogateescape')) % count
+
+
+class ImageFinder:
+    # include/exclude are glob lists matched against the path relative to dir (with '/'
+    # separators) or the file name; excluded directories are not descended into
+    # min_size/max_size are bytes, newer_than/older_than POSIX timestamps (None = no limit)
+    # keep is an optional last check (e.g. Manifest.needs_tagging); images it turns down are
+    # counted as skipped
+    def __init__(self, dir, recursive=True, include=None, exclude=None, extensions=IMAGE_EXTENSIONS,
+                 min_size=None, max_size=None, newer_than=None, older_than=None, shard=None, keep=None):
+        self.dir = dir
+        self.recursive = recursive
+        self.include = include or []
+        self.exclude = exclude or []
+        self.extensions = tuple(ext.lower() for ext in extensions)
+        self.min_size = min_size
+        self.max_size = max_size
+        self.newer_than = newer_than
+        self.older_than = older_than
+        self.shard = shard
+        self.keep = keep
+        # files looked at, images yielded and images turned down by keep so far
+        self.scanned = 0
+        self.matched = 0
+        self.skipped = 0
+
+    def matches(self, patterns, rel_path, name):
+        return any(fnmatch.fnmatch(rel_path, p) or fnmatch.fnmatch(name, p) for p in patterns)
+
+    def wanted(self, entry, rel_path):
+        if not entry.name.lower().endswith(self.extensions):
+            return False
+        if len(self.include) > 0 and not self.matches(self.include, rel_path, entry.name):
+            return False
+        if self.matches(self.exclude, rel_path, entry.name):
+            return False
+        if self.shard is not None and shard_of(rel_path, self.shard[1]) != self.shard[0]:
+            return False
+        if self.min_size is None and self.max_size is None and self.newer_than is None and self.older_than is None:
+            return True
+        # only stat when a filter needs it (scandir usually has it cached anyway)
+        st = entry.stat()
+        if self.min_size is not None and st.st_size < self.min_size:
+            return False
+        if self.max_size is not None and st.st_size > self.max_size:
+            return False
+        if self.newer_than is not None and st.st_mtime < self.newer_than:
+            return False
+        if self.older_than is not None and st.st_mtime > self.older_than:
+            return False
+        return True
+
+    # image paths in a stable order: each directory's files by name, then its subdirectories
+    # only one directory listing is held in memory at a time
+    def __iter__(self):
+        pending = [('', self.dir)]
+        while len(pending) > 0:
+            rel_dir, path = pending.pop()
+            try:
+                with os.scandir(path) as it:
+                    entries = sorted(it, key=lambda e: e.name)
+            except OSError as e:
+                print('Error: unable to read directory ' + path + ': ' + str(e))
+                continue
+            subdirs = []
+            for entry in entries:
+                rel_path = rel_dir + entry.name
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    continue
+                if is_dir:
+                    if self.recursive and entry.name not in OUTPUT_DIRS and not self.matches(self.exclude, rel_path, entry.name):
+                        subdirs.append((rel_path + '/', entry.path))
+                    continue
+                self.scanned += 1
+                try:
+                    if not self.wanted(entry, rel_path):
+                        continue
+                    if self.keep is not None and not self.keep(entry.path):
+                        self.skipped += 1
+                        continue
+                except OSError:
+                    continue
+                self.matched += 1
+                yield entry.path
+            # reversed so the stack hands them back in name order
+            pending.extend(reversed(subdirs))
@@ -0,0 +1,124 @@
+# Copyright 2021 - 2023, Bill Kennedy (https://github.com/rbbrdckybk/MiniGPT-4)
+# SPDX-License-Identifier: MIT
+
+# persistent job manifest for metadata-tagger.py (SQLite, one row per image)
+# records each image's status, fingerprint, raw MiniGPT-4 answers and sanitized metadata so
+# interrupted runs can resume, changed files get re-tagged and sanitization can be re-run offline
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# image status values
+ANSWERED = 'answered'   # model answers received, metadata not written yet
+DONE = 'done'           # metadata written
+FAILED = 'failed'
+
+class Manifest:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('''CREATE TABLE IF NOT EXISTS images (
+            path TEXT PRIMARY KEY,
+            size INTEGER,
+            mtime REAL,
+            sha256 TEXT,
+            status TEXT,
+            raw_title TEXT,
+            raw_description TEXT,
+            raw_keywords TEXT,
+            title TEXT,
+            description TEXT,
+            keywords TEXT,
+            error TEXT,
+            updated REAL
+        )''')
+        self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    @staticmethod
+    def key(img):
+        return os.path.abspath(img)
+
+    @staticmethod
+    def sha256(img):
+        h = hashlib.sha256()
+        with open(img, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                h.update(chunk)
+        return h.hexdigest()
+
+    # whether an image still needs tagging: it has never been tagged, its last attempt failed,
+    # or its contents changed since it was tagged (size/mtime first, then content hash)
+    def needs_tagging(self, img):
+        st = os.stat(img)
+        with self.lock:
+            row = self.db.execute('SELECT size, mtime, sha256, status FROM images WHERE path = ?', (self.key(img),)).fetchone()
+        if row is None or row[3] != DONE:
+            return True
+        size, mtime, sha, _ = row
+        if size == st.st_size and mtime == st.st_mtime:
+            return False
+        if sha is not None and sha == self.sha256(img):
+            # touched but not modified; remember the new fingerprint
+            with self.lock:
+                self.db.execute('UPDATE images SET size = ?, mtime = ? WHERE path = ?', (st.st_size, st.st_mtime, self.key(img)))
+                self.db.commit()
+            return False
+        return True
+
+    # store the raw model answers for an image, along with its current fingerprint
+    def record_answers(self, img, title, description, keywords):
+        st = os.stat(img)
+        sha = self.sha256(img)
+        with self.lock:
+            self.db.execute('''INSERT INTO images (path, size, mtime, sha256, status, raw_title, raw_description, raw_keywords, error, updated)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, NULL, ?)
+                ON CONFLICT(path) DO UPDATE SET size = excluded.size, mtime = excluded.mtime, sha256 = excluded.sha256,
+                    status = excluded.status, raw_title = excluded.raw_title, raw_description = excluded.raw_description,
+                    raw_keywords = excluded.raw_keywords, error = NULL, updated = excluded.updated''',
+                (self.key(img), st.st_size, st.st_mtime, sha, ANSWERED, title, description, keywords, time.time()))
+            self.db.commit()
+
+    # store the sanitized metadata that was written to an image
+    # refresh takes a new fingerprint, for metadata written into the image itself (otherwise
+    # the next run would see it as changed)
+    def record_done(self, img, title, description, keywords, refresh=False):
+        if refresh:
+            st = os.stat(img)
+            sha = self.sha256(img)
+            with self.lock:
+                self.db.execute('UPDATE images SET size = ?, mtime = ?, sha256 = ? WHERE path = ?',
+                    (st.st_size, st.st_mtime, sha, self.key(img)))
+        with self.lock:
+            self.db.execute('UPDATE images SET status = ?, title = ?, description = ?, keywords = ?, updated = ? WHERE path = ?',
+                (DONE, title, description, json.dumps(keywords), time.time(), self.key(img)))
+            self.db.commit()
+
+    def record_error(self, img, error):
+        with self.lock:
+            self.db.execute('''INSERT INTO images (path, status, error, updated) VALUES (?, ?, ?, ?)
+                ON CONFLICT(path) DO UPDATE SET status = excluded.status, error = excluded.error, updated = excluded.updated''',
+                (self.key(img), FAILED, error, time.time()))
+            self.db.commit()
+
+    # (path, raw title, raw description, raw keywords) for every image with stored answers,
+    # optionally limited to images under a directory
+    def answered(self, dir=None):
+        with self.lock:
+            rows = self.db.execute('SELECT path, raw_title, raw_description, raw_keywords FROM images WHERE raw_title IS NOT NULL ORDER BY path').fetchall()
+        if dir is not None:
+            prefix = os.path.join(os.path.abspath(dir), '')
+            rows = [row for row in rows if row[0].startswith(prefix)]
+        return rows
+
+    def counts(self):
+        with self.lock:
+            return dict(self.db.execute('SELECT status, COUNT(*) FROM images GROUP BY status').fetchall())
@@ -0,0 +1,55 @@
+# Copyright 2021 - 2023, Bill Kennedy (https://github.com/rbbrdckybk/MiniGPT-4)
+# SPDX-License-Identifier: MIT
+
+# tests for the XMP sidecars written by metadata_export.py
+# usage (from the utils directory):
+# python -m unittest test_metadata_export
+
+import os
+import tempfile
+import unittest
+
+import metadata_export
+
+
+class SidecarPathTest(unittest.TestCase):
+    def setUp(self):
+        self.temp = tempfile.TemporaryDirectory()
+        self.root = os.path.join(self.temp.name, 'photos')
+        self.out = os.path.join(self.temp.name, 'sidecars')
+
+    def tearDown(self):
+        self.temp.cleanup()
+
+    def read(self, path):
+        with open(path, 'r', encoding='utf-8') as f:
+            return f.read()
+
+    # photo.jpg & photo.png in the same directory
+    def test_same_name_different_extension(self):
+        writer = metadata_export.SidecarWriter()
+        jpg = writer.write(os.path.join(self.root, 'photo.jpg'), 'JPEG title', '', [])
+        png = writer.write(os.path.join(self.root, 'photo.png'), 'PNG title', '', [])
+        self.assertNotEqual(jpg, png)
+        self.assertIn('JPEG title', self.read(jpg))
+        self.assertNotIn('PNG title', self.read(jpg))
+        self.assertIn('PNG title', self.read(png))
+
+    # a/photo.jpg & b/photo.jpg (--recursive) with --sidecar-dir
+    def test_same_name_different_directory(self):
+        writer = metadata_export.SidecarWriter(self.out, root=self.root)
+        a = writer.write(os.path.join(self.root, 'a', 'photo.jpg'), 'Title A', '', ['a'])
+        b = writer.write(os.path.join(self.root, 'b', 'photo.jpg'), 'Title B', '', ['b'])
+        self.assertEqual(a, os.path.join(self.out, 'a', 'photo.jpg.xmp'))
+        self.assertEqual(b, os.path.join(self.out, 'b', 'photo.jpg.xmp'))
+        self.assertNotIn('Title B', self.read(a))
+        self.assertNotIn('Title A', self.read(b))
+
+    def test_image_outside_root(self):
+        writer = metadata_export.SidecarWriter(self.out, root=self.root)
+        with self.assertRaises(ValueError):
+            writer.sidecar_path(os.path.join(self.temp.name, 'elsewhere', 'photo.jpg'))
+
+
+if __name__ == '__main__':
+    unittest.main()